@@ -0,0 +1,92 @@
+"""Compare loading and querying a raw and a compiled account scheme.
+
+A synthetic account scheme with thousands of accounts and whitelist entries
+is loaded the way the wrapper used to (JSON parse then list membership
+checks) and from the compiled binary form stored in the cache (unmarshal
+then set lookups).
+
+    python benchmarks/account_scheme.py [--accounts N] [--whitelist N]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cdflow import AccountScheme  # noqa: E402
+
+
+def synthetic_account_scheme(accounts, whitelist):
+    return {
+        'release-bucket': 'release-bucket',
+        'classic-metadata-handling': False,
+        'accounts': {
+            'account-{}'.format(i): {
+                'id': str(100000000000 + i),
+                'role': 'arn:aws:iam::{}:role/admin'.format(
+                    100000000000 + i,
+                ),
+            }
+            for i in range(accounts)
+        },
+        'environments': {
+            'env-{}'.format(i): 'account-{}'.format(i)
+            for i in range(accounts)
+        },
+        'upgrade-account-scheme': {
+            'team-whitelist': [
+                'team-{}'.format(i) for i in range(whitelist)
+            ],
+            'component-whitelist': [
+                'component-{}'.format(i) for i in range(whitelist)
+            ],
+            'new-url': 's3://new-bucket/account-scheme.json',
+        },
+    }
+
+
+def raw_lookup(body):
+    account_scheme = json.loads(body)
+    upgrade = account_scheme['upgrade-account-scheme']
+    return (
+        'not-a-team' in upgrade['team-whitelist']
+        or 'not-a-component' in upgrade['component-whitelist']
+    )
+
+
+def compiled_lookup(body):
+    account_scheme = AccountScheme.from_bytes(body)
+    return account_scheme.forwards('not-a-team', 'not-a-component')
+
+
+def report(name, function, body, number, repeat):
+    samples = [
+        sample / number for sample in timeit.repeat(
+            lambda: function(body), number=number, repeat=repeat,
+        )
+    ]
+    print('{:<9} {:8.1f} KB  min {:8.3f} ms  median {:8.3f} ms'.format(
+        name, len(body) / 1024, min(samples) * 1000,
+        statistics.median(samples) * 1000,
+    ))
+
+
+def main(accounts, whitelist, number, repeat):
+    data = synthetic_account_scheme(accounts, whitelist)
+    json_body = json.dumps(data).encode('utf-8')
+    compiled_body = AccountScheme(data).to_bytes()
+    report('json', raw_lookup, json_body, number, repeat)
+    report('compiled', compiled_lookup, compiled_body, number, repeat)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--accounts', type=int, default=5000)
+    parser.add_argument('--whitelist', type=int, default=5000)
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    main(args.accounts, args.whitelist, args.number, args.repeat)
@@ -0,0 +1,78 @@
+"""Compare cold and warm start-up of the zipapp and the pip entry point.
+
+Each run executes ``cdflow release`` against a Docker host that does not
+exist, so the wall time covers interpreter start, imports and the wrapper's
+own work up to its first Docker API call.
+
+A cold zipapp run starts with an empty extraction cache; a cold entry point
+run starts with an empty bytecode cache, as on a freshly installed runner.
+
+    python build_zipapp.py
+    pip install .
+    python benchmarks/cold_start.py [--runs N]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def timed_run(command, environment):
+    start = time.perf_counter()
+    subprocess.run(
+        command, env=environment, cwd=tempfile.gettempdir(),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+def measure(command, cold_variable, runs):
+    results = {'cold': [], 'warm': []}
+    for _ in range(runs):
+        scratch = tempfile.mkdtemp(prefix='cdflow-bench-')
+        environment = dict(
+            os.environ, DOCKER_HOST='unix:///nonexistent',
+            **{cold_variable: scratch}
+        )
+        results['cold'].append(timed_run(command, environment))
+        results['warm'].append(timed_run(command, environment))
+        shutil.rmtree(scratch)
+    return results
+
+
+def report(name, results):
+    for phase in ('cold', 'warm'):
+        samples = results[phase]
+        print('{:<12} {:<5} min {:7.1f} ms  median {:7.1f} ms'.format(
+            name, phase, min(samples) * 1000,
+            statistics.median(samples) * 1000,
+        ))
+
+
+def main(zipapp, entry_point, runs):
+    report('zipapp', measure(
+        [sys.executable, zipapp, 'release'], 'CDFLOW_CACHE_DIR', runs,
+    ))
+    if entry_point:
+        report('entry point', measure(
+            [entry_point, 'release'], 'PYTHONPYCACHEPREFIX', runs,
+        ))
+    else:
+        print('cdflow entry point not found, install it with: pip install .')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--zipapp', default=os.path.join(ROOT, 'dist', 'cdflow.pyz'),
+    )
+    parser.add_argument('--entry-point', default=shutil.which('cdflow'))
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    main(args.zipapp, args.entry_point, args.runs)
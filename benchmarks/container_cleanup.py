@@ -0,0 +1,83 @@
+"""Measure how long the wrapper takes to exit once its container finishes.
+
+Each sample is a child process running docker_run against a fake engine
+that answers every call after a fixed round-trip latency, runs each
+container for a fixed time, and takes longer still to remove one. The
+child reports when the engine said its last container had exited. The
+parent reports how much later the process ended, and how many containers
+existed at once, with the default cleanup at exit and with
+CDFLOW_CONTAINER_CLEANUP=reaper.
+
+    python benchmarks/container_cleanup.py [--latency MS] [--runtime MS]
+        [--remove MS] [--containers N] [--samples N]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdflow  # noqa: E402
+from test.engine import FakeEngine  # noqa: E402
+
+OUTPUT = [b'Apply complete! Resources: 0 added, 0 changed, 0 destroyed.\n']
+
+
+def child(latency, runtime, removal, containers):
+    engine = FakeEngine(
+        latency, runtime, costs={'remove': removal}, output=OUTPUT,
+    )
+    for _ in range(containers):
+        cdflow.docker_run(engine, 'image-id', ['deploy'], '/tmp', {})
+    print(engine.finished, engine.most_existing, file=sys.stderr)
+
+
+def sample(mode, latency, runtime, removal, containers):
+    environment = dict(os.environ)
+    environment.pop(cdflow.CONTAINER_CLEANUP_VARIABLE, None)
+    if mode:
+        environment[cdflow.CONTAINER_CLEANUP_VARIABLE] = mode
+    process = subprocess.Popen(
+        [sys.executable, __file__, '--child', '--latency', str(latency),
+         '--runtime', str(runtime), '--remove', str(removal),
+         '--containers', str(containers)],
+        env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    report = process.communicate()[1]
+    ended = time.time()
+    finished, most_existing = report.split()
+    return ended - float(finished), int(most_existing)
+
+
+def main(latency, runtime, removal, containers, samples):
+    for name, mode in (('at exit', None), ('reaper', 'reaper')):
+        results = [
+            sample(mode, latency, runtime, removal, containers)
+            for _ in range(samples)
+        ]
+        delays = [delay for delay, _ in results]
+        print('{:<8} exit {:7.1f} ms after the last container  '
+              'at most {} containers'.format(
+                  name, statistics.median(delays) * 1000,
+                  max(most_existing for _, most_existing in results),
+              ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=2.0)
+    parser.add_argument('--runtime', type=float, default=100.0)
+    parser.add_argument('--remove', type=float, default=30.0)
+    parser.add_argument('--containers', type=int, default=10)
+    parser.add_argument('--samples', type=int, default=5)
+    parser.add_argument('--child', action='store_true')
+    args = parser.parse_args()
+    if args.child:
+        child(args.latency / 1000, args.runtime / 1000, args.remove / 1000,
+              args.containers)
+    else:
+        main(args.latency, args.runtime, args.remove, args.containers,
+             args.samples)
@@ -0,0 +1,82 @@
+"""Count the engine API calls and wall time of running one container.
+
+A fake engine answers each HTTP call after a fixed round-trip latency and
+counts run as its create and start. A started container runs for a fixed
+time, and its output stream ends, and wait answers, half a round trip
+after it exits. Each run goes through the previous run, logs and reload
+sequence, through create, attach, start and then wait, and through
+docker_run, which sends the wait while the output is still being relayed.
+The output is relayed to /dev/null.
+
+    python benchmarks/container_lifecycle.py [--latency MS] [--runtime MS]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdflow  # noqa: E402
+from test.engine import FakeEngine  # noqa: E402
+
+OUTPUT = [b'Refreshing state... [id=%d]\n' % i for i in range(200)]
+
+
+def run_logs_and_reload(engine):
+    container = engine.containers.run('image-id', detach=True)
+    for message in container.logs(
+        stream=True, follow=True, stdout=True, stderr=True,
+    ):
+        sys.stdout.write(message.decode('utf-8'))
+    container.reload()
+    return container.attrs['State']['ExitCode']
+
+
+def create_attach_start_then_wait(engine):
+    container = engine.containers.create('image-id')
+    sock = cdflow._attach_output(container)
+    container.start()
+    cdflow._print_logs(sock)
+    return cdflow.handle_finished_container(container)[0]
+
+
+def docker_run(engine):
+    return cdflow.docker_run(engine, 'image-id', ['plan'], '/tmp', {})[0]
+
+
+def measure(function, latency, runtime, runs):
+    engine = FakeEngine(latency, runtime, output=OUTPUT)
+    samples = []
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for _ in range(runs):
+            start = time.perf_counter()
+            function(engine)
+            samples.append(time.perf_counter() - start)
+    calls = sum(engine.calls.values()) / runs
+    return calls, samples
+
+
+def main(latency, runtime, runs):
+    for name, function in (
+        ('run, logs, reload', run_logs_and_reload),
+        ('create, attach, start, wait', create_attach_start_then_wait),
+        ('docker_run', docker_run),
+    ):
+        calls, samples = measure(function, latency / 1000, runtime / 1000,
+                                 runs)
+        print('{:<28} {:3.0f} calls  min {:7.2f} ms  median {:7.2f} ms'.format(
+            name, calls, min(samples) * 1000,
+            statistics.median(samples) * 1000,
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=2.0)
+    parser.add_argument('--runtime', type=float, default=20.0)
+    parser.add_argument('--runs', type=int, default=50)
+    args = parser.parse_args()
+    main(args.latency, args.runtime, args.runs)
@@ -0,0 +1,50 @@
+"""Compare reading the origin url natively with running ``git config``.
+
+Run it from inside a repository with an origin remote, or pass one:
+
+    python benchmarks/git_remote.py [--repo PATH] [--runs N]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdflow  # noqa: E402
+
+
+def timed(function, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = function()
+        samples.append(time.perf_counter() - start)
+    return result, samples
+
+
+def report(name, result, samples):
+    print('{:<10} min {:8.3f} ms  median {:8.3f} ms  {}'.format(
+        name, min(samples) * 1000, statistics.median(samples) * 1000,
+        result.strip(),
+    ))
+
+
+def main(repo, runs):
+    os.chdir(repo)
+    result, samples = timed(lambda: cdflow.read_git_remote_url(repo), runs)
+    if result is None:
+        # git config would fail too, so there is nothing to compare.
+        print('No origin remote found in {}'.format(repo))
+        return
+    report('native', result, samples)
+    report('git', *timed(cdflow._get_git_remote_url_from_git, runs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repo', default=os.getcwd())
+    parser.add_argument('--runs', type=int, default=100)
+    args = parser.parse_args()
+    main(os.path.abspath(args.repo), args.runs)
@@ -0,0 +1,87 @@
+"""Compare demultiplexing a container's attach stream with docker-py.
+
+A synthetic multiplexed stream of stdout and stderr frames is sent over a
+socket pair and split into two /dev/null files, once with docker-py's
+frames_iter and demux_adaptor, and once with relay_frames.
+
+    python benchmarks/log_demux.py [--megabytes N] [--repeat N]
+"""
+import argparse
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+from docker.utils.socket import demux_adaptor, frames_iter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdflow  # noqa: E402
+
+
+def synthetic_stream(megabytes):
+    rng = random.Random(0)
+    frames, size = [], 0
+    while size < megabytes * 1024 * 1024:
+        payload = bytes(rng.randint(32, 4096))
+        stream = cdflow.STDERR if rng.random() < 0.1 else cdflow.STDOUT
+        frames.append(cdflow.FRAME_HEADER.pack(stream, len(payload)))
+        frames.append(payload)
+        size += len(payload)
+    return b''.join(frames), size
+
+
+def docker_py(sock, stdout, stderr):
+    for stream, data in frames_iter(sock, tty=False):
+        out, err = demux_adaptor(stream, data)
+        if out is not None:
+            stdout.write(out)
+        else:
+            stderr.write(err)
+
+
+def frame_parser(sock, stdout, stderr):
+    cdflow.relay_frames(sock, {cdflow.STDOUT: stdout, cdflow.STDERR: stderr})
+
+
+def send(sock, data):
+    sock.sendall(data)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def measure(function, data, size, repeat):
+    best = float('inf')
+    with open(os.devnull, 'wb') as stdout, open(os.devnull, 'wb') as stderr:
+        for _ in range(repeat):
+            reader, writer = socket.socketpair()
+            sender = threading.Thread(target=send, args=(writer, data))
+            start = time.perf_counter()
+            sender.start()
+            function(reader, stdout, stderr)
+            best = min(best, time.perf_counter() - start)
+            sender.join()
+            reader.close()
+            writer.close()
+    return size / best / (1024 * 1024)
+
+
+def main(megabytes, repeat):
+    data, size = synthetic_stream(megabytes)
+    print('Stream: {:.1f} MB'.format(size / (1024 * 1024)))
+    for name, function in (
+        ('docker-py demux', docker_py),
+        ('frame parser', frame_parser),
+    ):
+        print('{:<16} {:8.1f} MB/s'.format(
+            name, measure(function, data, size, repeat),
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megabytes', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    main(args.megabytes, args.repeat)
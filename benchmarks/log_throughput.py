@@ -0,0 +1,108 @@
+"""Measure how fast container output is relayed to stdout.
+
+A synthetic log stream, chunked the way the Docker API delivers it, is fed
+through the previous decode-and-print loop and through _print_logs, with
+stdout redirected to /dev/null both line buffered, as on a terminal, and
+block buffered, as on a pipe. The last row also archives the output, as
+a run with a cache does.
+
+    python benchmarks/log_throughput.py [--megabytes N] [--repeat N]
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdflow  # noqa: E402
+from test.engine import FakeEngine  # noqa: E402
+
+LINES = [
+    '  # module.service.aws_ecs_service.service will be updated in-place\n',
+    '      ~ task_definition = "arn:aws:ecs:eu-west-1:1:task/svc:41" -> '
+    '(known after apply)\n',
+    'module.service.data.aws_iam_policy_document.task: Refreshing state... '
+    '[id=1234567890]\n',
+    '  ✓ état vérifié\n',
+]
+
+
+def synthetic_chunks(megabytes):
+    rng = random.Random(0)
+    chunks, size = [], 0
+    while size < megabytes * 1024 * 1024:
+        chunk = ''.join(
+            rng.choice(LINES) for _ in range(rng.randint(1, 4))
+        ).encode('utf-8')
+        chunks.append(chunk)
+        size += len(chunk)
+    return chunks, size
+
+
+def print_logs_with_print(container):
+    for message in container.logs(
+        stream=True, follow=True, stdout=True, stderr=True
+    ):
+        print(message.decode('utf-8'), end='')
+
+
+def print_coalesced_logs(container):
+    cdflow._print_logs(container.attach_socket())
+
+
+def print_and_archive_logs(container):
+    with tempfile.TemporaryDirectory() as log_dir:
+        archive = cdflow.LogArchive(
+            os.path.join(log_dir, 'run.log.gz'), ['deploy'],
+        )
+        cdflow._print_logs(container.attach_socket(), copies=[archive])
+        archive.close(0)
+
+
+def measure(function, container, size, repeat, line_buffering):
+    best = float('inf')
+    stdout = sys.stdout
+    sys.stdout = io.TextIOWrapper(
+        open(os.devnull, 'wb'), line_buffering=line_buffering,
+    )
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function(container)
+            sys.stdout.flush()
+            best = min(best, time.perf_counter() - start)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return size / best / (1024 * 1024)
+
+
+def main(megabytes, repeat):
+    chunks, size = synthetic_chunks(megabytes)
+    # Already exited, so the whole stream can be read straight away.
+    container = FakeEngine(output=chunks).run('image-id')
+    print('Stream: {:.1f} MB in {} chunks'.format(
+        size / (1024 * 1024), len(chunks),
+    ))
+    for name, function in (
+        ('decode and print', print_logs_with_print),
+        ('coalesced bytes', print_coalesced_logs),
+        ('and archived', print_and_archive_logs),
+    ):
+        print('{:<18} terminal {:8.1f} MB/s  pipe {:8.1f} MB/s'.format(
+            name,
+            measure(function, container, size, repeat, True),
+            measure(function, container, size, repeat, False),
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megabytes', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    main(args.megabytes, args.repeat)
@@ -0,0 +1,88 @@
+"""Compare ways of loading a large cdflow.yml.
+
+A synthetic manifest with many services and settings is parsed with the
+pure-Python and libyaml safe loaders, then loaded through
+get_manifest_data from the in-memory and on-disk manifest caches.
+
+    python benchmarks/manifest.py [--services N] [--number N]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import timeit
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdflow  # noqa: E402
+
+
+def synthetic_manifest(services):
+    return yaml.dump({
+        'team': 'a-team',
+        'type': 'ecs',
+        'account-scheme-url': 's3://bucket/account-scheme.json',
+        'terraform-version': '0.12.29',
+        'services': {
+            'service-{}'.format(i): {
+                'image': 'org/service-{}:latest'.format(i),
+                'memory': 512,
+                'ports': [80, 443, 8000 + i],
+                'environment': {
+                    'VARIABLE_{}'.format(j): 'value-{}'.format(j)
+                    for j in range(10)
+                },
+            }
+            for i in range(services)
+        },
+    })
+
+
+def report(name, function, number, repeat):
+    samples = [
+        sample / number for sample in timeit.repeat(
+            function, number=number, repeat=repeat,
+        )
+    ]
+    print('{:<24} min {:9.3f} ms  median {:9.3f} ms'.format(
+        name, min(samples) * 1000, statistics.median(samples) * 1000,
+    ))
+
+
+def main(services, number, repeat):
+    text = synthetic_manifest(services)
+    print('Manifest: {:.1f} KB'.format(len(text) / 1024))
+    report('SafeLoader', lambda: yaml.load(text, Loader=yaml.SafeLoader),
+           number, repeat)
+    if hasattr(yaml, 'CSafeLoader'):
+        report('CSafeLoader', lambda: yaml.load(text, Loader=yaml.CSafeLoader),
+               number, repeat)
+    project_dir = tempfile.mkdtemp()
+    try:
+        cdflow.MANIFEST_PATH = os.path.join(project_dir, 'cdflow.yml')
+        with open(cdflow.MANIFEST_PATH, 'w') as manifest_file:
+            manifest_file.write(text)
+        cache = cdflow.CacheStore(os.path.join(project_dir, 'cache.db'))
+        cdflow.get_manifest_data(cache)
+        report('in-memory cache', cdflow.get_manifest_data, number, repeat)
+
+        def from_disk_cache():
+            cdflow._manifests.clear()
+            cdflow.get_manifest_data(cache)
+
+        report('on-disk cache', from_disk_cache, number, repeat)
+    finally:
+        shutil.rmtree(project_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--services', type=int, default=500)
+    parser.add_argument('--number', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    main(args.services, args.number, args.repeat)
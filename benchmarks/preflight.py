@@ -0,0 +1,123 @@
+"""Compare per-step timings of the concurrent and the serial deploy preflight.
+
+Every step of ``cdflow deploy`` before the container starts is replaced by a
+sleep of a typical latency, so the comparison shows how much of the work
+overlaps rather than how fast any one service is. Latencies in milliseconds
+can be overridden, e.g. ``--latency pull=5000``.
+
+    python benchmarks/preflight.py [--latency STEP=MS ...]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdflow  # noqa: E402
+
+LATENCIES = {
+    'docker client': 30,
+    'cache': 5,
+    'config': 10,
+    'credentials': 150,
+    'component name': 20,
+    's3': 40,
+    'account scheme': 80,
+    'deploy image id': 60,
+    'pull': 2000,
+}
+
+TARGETS = {
+    'docker client': 'get_docker_client',
+    'cache': 'open_cache',
+    'config': 'get_manifest_data',
+    'credentials': 'resolve_aws_credentials',
+    'component name': 'get_component_name',
+    's3': 'get_s3_resource',
+    'account scheme': 'fetch_config_account_scheme',
+    'deploy image id': 'fetch_release_image_id',
+    'pull': 'pull_image',
+}
+
+RESULTS = {
+    # No cache, so nothing is archived or pooled under a mock's name.
+    'cache': None,
+    'config': {'team': 'a-team', 'account-scheme-url': 's3://a/b'},
+    'credentials': ('key', 'secret', 'token'),
+    'component name': 'a-component',
+    'deploy image id': 'image@sha256:abc',
+}
+
+
+def simulated(step, latency):
+    def function(*args, **kwargs):
+        time.sleep(latency / 1000.0)
+        return RESULTS[step] if step in RESULTS else MagicMock()
+    return function
+
+
+def run(mode, latencies):
+    patchers = [
+        patch('cdflow.{}'.format(TARGETS[step]), simulated(step, latency))
+        for step, latency in latencies.items()
+    ]
+    patchers.append(patch.dict('cdflow.os.environ', {
+        cdflow.PREFLIGHT_VARIABLE: mode,
+    }))
+    timings = {}
+    original_log_timings = cdflow.Pipeline.log_timings
+
+    def log_timings(pipeline):
+        timings.update(pipeline.timings)
+        original_log_timings(pipeline)
+
+    patchers.append(patch('cdflow.Pipeline.log_timings', log_timings))
+    for patcher in patchers:
+        patcher.start()
+    try:
+        start = time.monotonic()
+        cdflow.preflight(['deploy', 'aslive', '42'])
+        total = time.monotonic() - start
+    finally:
+        for patcher in reversed(patchers):
+            patcher.stop()
+    return timings, total
+
+
+def main(latencies):
+    logging.disable(logging.CRITICAL)
+    results = {
+        mode: run(mode, latencies) for mode in ('serial', 'concurrent')
+    }
+    print('{:<20} {:>20} {:>20}'.format('step', 'serial', 'concurrent'))
+    for step in sorted(results['serial'][0], key=results['serial'][0].get):
+        print('{:<20} {:>20} {:>20}'.format(step, *(
+            '{:6.0f} - {:6.0f} ms'.format(*(
+                seconds * 1000 for seconds in results[mode][0][step]
+            ))
+            for mode in ('serial', 'concurrent')
+        )))
+    print('{:<20} {:>17.0f} ms {:>17.0f} ms'.format(
+        'total', results['serial'][1] * 1000,
+        results['concurrent'][1] * 1000,
+    ))
+
+
+def parse_latency(value):
+    step, _, milliseconds = value.partition('=')
+    if step not in LATENCIES:
+        raise argparse.ArgumentTypeError('unknown step {}'.format(step))
+    return step, float(milliseconds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--latency', type=parse_latency, action='append', default=[],
+        metavar='STEP=MS',
+    )
+    args = parser.parse_args()
+    main(dict(LATENCIES, **dict(args.latency)))
@@ -0,0 +1,85 @@
+"""Report start-up time of the cdflow wrapper for each command.
+
+Runs ``python -X importtime cdflow.py <command>`` in a fresh interpreter for
+every command, against a fake Docker engine and S3 from the test suite, so
+each command imports whatever its code path really loads. Prints the wall
+time and total import time of the best run, along with the most expensive
+top-level packages. The shell command needs a terminal, so is not measured.
+
+    python benchmarks/startup.py [--runs N] [--top N]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from test.engine import fake_host  # noqa: E402
+
+COMMANDS = {
+    'import-only': ['-c', 'import cdflow'],
+    'release': ['release', '--platform-config', 'platform-config', '1'],
+    'deploy': ['deploy', 'aslive', '1', '--component', 'service'],
+    'destroy': ['destroy', 'aslive', '--component', 'service'],
+}
+
+
+def run_command(argv, project, environment):
+    if argv[0] != '-c':
+        argv = [os.path.join(ROOT, 'cdflow.py')] + argv
+    environment = dict(environment, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + argv, cwd=project,
+        env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        check=True,
+    ).stderr.decode('utf-8')
+    return time.perf_counter() - start, parse_import_times(stderr)
+
+
+def parse_import_times(report):
+    packages = defaultdict(int)
+    for line in report.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit() and not name.startswith('   '):
+            packages[name.strip()] += int(cumulative)
+    return packages
+
+
+def measure(runs, top, project, environment):
+    for command, argv in COMMANDS.items():
+        samples = [
+            run_command(argv, project, environment) for _ in range(runs)
+        ]
+        wall_time, best = min(samples, key=lambda sample: sample[0])
+        print('{:<12} {:8.1f} ms, imports {:8.1f} ms'.format(
+            command, wall_time * 1000, sum(best.values()) / 1000,
+        ))
+        heaviest = sorted(best.items(), key=lambda item: -item[1])[:top]
+        for name, microseconds in heaviest:
+            print('    {:<24} {:8.1f} ms'.format(name, microseconds / 1000))
+
+
+def main(runs, top):
+    project = tempfile.mkdtemp()
+    try:
+        with fake_host(project) as (environment, _, _):
+            measure(runs, top, project, environment)
+    finally:
+        shutil.rmtree(project)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=3)
+    args = parser.parse_args()
+    main(args.runs, args.top)
@@ -0,0 +1,77 @@
+"""Compare running commands in fresh containers with a warm pool.
+
+A fake engine answers every HTTP call after a fixed round-trip latency,
+and charges the time given for creating a container, for setting up its
+namespaces when it starts, and for the command's own start-up, which an
+exec pays as well. Each command runs through docker_run, first with a new
+container each time, then with a WarmPool kept in a temporary cache.
+
+    python benchmarks/warm_pool.py [--latency MS] [--create MS]
+        [--namespaces MS] [--startup MS] [--runs N]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdflow  # noqa: E402
+from test.engine import FakeEngine  # noqa: E402
+
+OUTPUT = [b'No changes. Infrastructure is up-to-date.\n']
+
+
+def measure(engine, runs, warm_pool=None):
+    samples = []
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for _ in range(runs):
+            start = time.perf_counter()
+            cdflow.docker_run(
+                engine, 'image@sha256:1', ['deploy', 'live', '--plan-only'],
+                '/tmp', {}, warm_pool=warm_pool,
+            )
+            samples.append(time.perf_counter() - start)
+    return samples
+
+
+def report(name, engine, samples):
+    print('{:<16} first {:7.1f} ms  median {:7.1f} ms  {:4.1f} calls'.format(
+        name, samples[0] * 1000, statistics.median(samples) * 1000,
+        sum(engine.calls.values()) / len(samples),
+    ))
+
+
+def fake_engine(latency, create, namespaces, startup):
+    # The command starts up inside the container, or the exec, and then
+    # exits straight away.
+    return FakeEngine(
+        latency / 1000, startup / 1000,
+        costs={'create': create / 1000, 'start': namespaces / 1000},
+        output=OUTPUT,
+    )
+
+
+def main(latency, create, namespaces, startup, runs):
+    costs = (latency, create, namespaces, startup)
+    engine = fake_engine(*costs)
+    report('fresh container', engine, measure(engine, runs))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = cdflow.CacheStore(os.path.join(cache_dir, 'cache.db'))
+        engine = fake_engine(*costs)
+        pool = cdflow.WarmPool(cache, max_size=4)
+        report('warm pool', engine, measure(engine, runs, pool))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=2.0)
+    parser.add_argument('--create', type=float, default=40.0)
+    parser.add_argument('--namespaces', type=float, default=250.0)
+    parser.add_argument('--startup', type=float, default=400.0)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+    main(args.latency, args.create, args.namespaces, args.startup, args.runs)
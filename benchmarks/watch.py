@@ -0,0 +1,80 @@
+"""Measure how soon deploy --plan-only --watch notices a change.
+
+A project of the given number of files is written to a temporary
+directory. Each sample saves one of its files from another thread and times
+how long wait_for_changes takes to return, which is when the next plan
+starts, with inotify and with the polling fallback. Both include the
+debounce.
+
+    python benchmarks/watch.py [--files N] [--samples N]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cdflow  # noqa: E402
+
+
+def make_project(root, files):
+    for index in range(files):
+        directory = os.path.join(root, 'modules', str(index // 50))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, '{}.tf'.format(index)), 'w') as f:
+            f.write('# module {}\n'.format(index))
+
+
+def save(path, saved):
+    time.sleep(0.05)
+    saved.append(time.perf_counter())
+    with open(path, 'a') as f:
+        f.write('# changed\n')
+
+
+def measure(watcher, path, samples):
+    delays = []
+    for _ in range(samples):
+        saved = []
+        thread = threading.Thread(target=save, args=(path, saved))
+        thread.start()
+        cdflow.wait_for_changes(watcher)
+        delays.append(time.perf_counter() - saved[0])
+        thread.join()
+    return delays
+
+
+def main(files, samples):
+    root = tempfile.mkdtemp()
+    try:
+        make_project(root, files)
+        path = os.path.join(root, 'modules', '0', '0.tf')
+        for name, watcher_class in (
+            ('inotify', cdflow.InotifyWatcher),
+            ('polling', cdflow.PollingWatcher),
+        ):
+            watcher = watcher_class(root)
+            try:
+                delays = measure(watcher, path, samples)
+            finally:
+                watcher.close()
+            print('{:<8} plan starts {:7.1f} ms after a save '
+                  '(debounce {:.0f} ms)'.format(
+                      name, statistics.median(delays) * 1000,
+                      cdflow.WATCH_DEBOUNCE * 1000,
+                  ))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=500)
+    parser.add_argument('--samples', type=int, default=10)
+    args = parser.parse_args()
+    main(args.files, args.samples)
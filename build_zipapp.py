@@ -0,0 +1,167 @@
+"""Build a self-contained, precompiled zipapp of the cdflow wrapper.
+
+The archive bundles cdflow and a trimmed copy of its dependencies with their
+bytecode already compiled. On first run it extracts itself to a per-build
+directory under the cache directory (shiv-style, as botocore and certifi need
+real files on disk) and every later run imports straight from there, so a
+fresh CI runner can execute it with no install or compile step.
+
+The bytecode and any C extensions target the interpreter used for the build.
+"""
+import argparse
+import compileall
+import hashlib
+import os
+import py_compile
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Runtime dependencies, as listed in setup.py's install_requires.
+REQUIREMENTS = ['boto3', 'docker', 'pyyaml>=4.2b1', 'dockerpty']
+
+# Only the service models the wrapper talks to are kept from botocore/boto3,
+# which otherwise account for most of the archive.
+KEEP_SERVICE_DATA = {'s3', 'sts', 'sso', 'sso-oidc'}
+PRUNE_DIRECTORIES = {'__pycache__', 'bin', 'tests', 'test'}
+
+BOOTSTRAP = '''\
+import os
+import sys
+import zipfile
+
+BUILD_ID = {build_id!r}
+
+
+def extract(archive, target):
+    staging = '{{}}.{{}}'.format(target, os.getpid())
+    with zipfile.ZipFile(archive) as zip_file:
+        members = [
+            name for name in zip_file.namelist()
+            if name.startswith('site-packages/')
+        ]
+        zip_file.extractall(staging, members)
+    try:
+        os.rename(staging, target)
+    except OSError:
+        # Another process extracted the same build first.
+        import shutil
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def site_packages():
+    cache_dir = os.environ.get('CDFLOW_CACHE_DIR') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'cdflow',
+    )
+    target = os.path.join(cache_dir, 'zipapp', BUILD_ID)
+    if not os.path.isdir(target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        extract(os.path.dirname(os.path.abspath(__file__)), target)
+    return os.path.join(target, 'site-packages')
+
+
+sys.path.insert(0, site_packages())
+
+import cdflow  # noqa: E402
+
+cdflow.run()
+'''
+
+
+def install(site_packages, requirements):
+    subprocess.check_call([
+        sys.executable, '-m', 'pip', 'install', '--quiet', '--no-compile',
+        '--target', site_packages,
+    ] + REQUIREMENTS + requirements)
+    shutil.copy(os.path.join(ROOT, 'cdflow.py'), site_packages)
+
+
+def prune_service_data(site_packages):
+    for package in ('botocore', 'boto3'):
+        data_dir = os.path.join(site_packages, package, 'data')
+        for name in os.listdir(data_dir):
+            path = os.path.join(data_dir, name)
+            if os.path.isdir(path) and name not in KEEP_SERVICE_DATA:
+                shutil.rmtree(path)
+
+
+def prune(site_packages):
+    prune_service_data(site_packages)
+    for directory, subdirectories, _ in os.walk(site_packages):
+        for name in PRUNE_DIRECTORIES.intersection(subdirectories):
+            shutil.rmtree(os.path.join(directory, name))
+            subdirectories.remove(name)
+
+
+def compile_bytecode(site_packages):
+    # Unchecked hash-based pycs stay valid after extraction resets the
+    # source mtimes, so nothing is recompiled on the runner.
+    compileall.compile_dir(
+        site_packages, quiet=1, workers=0,
+        invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+    )
+
+
+def build_id(site_packages):
+    digest = hashlib.sha256(sys.implementation.cache_tag.encode('utf-8'))
+    for directory, subdirectories, files in os.walk(site_packages):
+        subdirectories.sort()
+        for name in sorted(files):
+            path = os.path.join(directory, name)
+            digest.update(os.path.relpath(path, site_packages).encode())
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def write_archive(build_dir, output, interpreter):
+    site_packages = os.path.join(build_dir, 'site-packages')
+    main_source = BOOTSTRAP.format(build_id=build_id(site_packages))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'wb') as f:
+        f.write('#!{}\n'.format(interpreter).encode('utf-8'))
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr('__main__.py', main_source)
+            for directory, _, files in os.walk(site_packages):
+                for name in sorted(files):
+                    path = os.path.join(directory, name)
+                    zip_file.write(path, os.path.relpath(path, build_dir))
+    os.chmod(output, 0o755)
+
+
+def main(output, interpreter, requirements):
+    build_dir = tempfile.mkdtemp(prefix='cdflow-zipapp-')
+    site_packages = os.path.join(build_dir, 'site-packages')
+    try:
+        install(site_packages, requirements)
+        prune(site_packages)
+        compile_bytecode(site_packages)
+        write_archive(build_dir, output, interpreter)
+    finally:
+        shutil.rmtree(build_dir)
+    print('Built {} ({:.1f} MB)'.format(
+        output, os.path.getsize(output) / 1024 / 1024,
+    ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--output', default=os.path.join(ROOT, 'dist', 'cdflow.pyz'),
+        help='Path of the archive to write',
+    )
+    parser.add_argument(
+        '--python', default='/usr/bin/env python3',
+        help='Interpreter for the archive shebang line',
+    )
+    parser.add_argument(
+        'requirements', nargs='*',
+        help='Extra requirement specifiers, e.g. pinned versions',
+    )
+    args = parser.parse_args()
+    main(args.output, args.python, args.requirements)
@@ -1,30 +1,190 @@
 #!/usr/bin/env python
 from __future__ import print_function
 
+from array import array
 import atexit
+from bisect import bisect_right
+import codecs
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
 from copy import copy
 from contextlib import contextmanager
+from importlib import import_module
+from itertools import chain
+import gzip
+import hashlib
 import json
 import logging
+import marshal
 import os
 from os.path import abspath
+import queue
+import re
+import shutil
+import signal
+import socket
+import socketserver
+import sqlite3
+import struct
 import sys
-from io import BytesIO
+import threading
+import time
 from subprocess import CalledProcessError, check_output
+import tempfile
 
-import docker
-import dockerpty
-import yaml
-from boto3.session import Session
-from docker.errors import DockerException, ImageNotFound
-from requests.exceptions import ReadTimeout
 
+class _LazyModule(object):
+    """Defers importing a module until one of its attributes is used.
+
+    docker, boto3 and friends dominate the wrapper's start-up time, so they
+    are only imported by the code paths that actually need them.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        return getattr(import_module(self._name), attribute)
+
+
+docker = _LazyModule('docker')
+dockerpty = _LazyModule('dockerpty')
+yaml = _LazyModule('yaml')
 CDFLOW_IMAGE_NAME = 'mergermarket/cdflow-commands'
 CDFLOW_IMAGE_TAG = 'latest'
 CDFLOW_IMAGE_ID = '{}:{}'.format(CDFLOW_IMAGE_NAME, CDFLOW_IMAGE_TAG)
 
 MANIFEST_PATH = 'cdflow.yml'
 
+DAEMON_SOCKET_VARIABLE = 'CDFLOW_DAEMON_SOCKET'
+STANDARD_FDS = (0, 1, 2)
+
+CACHE_DIR_VARIABLE = 'CDFLOW_CACHE_DIR'
+CACHE_MAX_SIZE_VARIABLE = 'CDFLOW_CACHE_MAX_SIZE'
+DEFAULT_CACHE_MAX_SIZE = 50 * 1024 * 1024
+CACHE_MAX_AGE_VARIABLE = 'CDFLOW_CACHE_MAX_AGE'
+DEFAULT_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+IMAGE_DIGEST_TTL_VARIABLE = 'CDFLOW_IMAGE_DIGEST_TTL'
+DEFAULT_IMAGE_DIGEST_TTL = 60
+
+S3_MAX_POOL_CONNECTIONS_VARIABLE = 'CDFLOW_S3_MAX_POOL_CONNECTIONS'
+DEFAULT_S3_MAX_POOL_CONNECTIONS = 10
+S3_MAX_ATTEMPTS_VARIABLE = 'CDFLOW_S3_MAX_ATTEMPTS'
+DEFAULT_S3_MAX_ATTEMPTS = 5
+S3_TIMEOUT_VARIABLE = 'CDFLOW_S3_TIMEOUT'
+DEFAULT_S3_TIMEOUT = 5
+S3_DEADLINE_VARIABLE = 'CDFLOW_S3_DEADLINE'
+DEFAULT_S3_DEADLINE = 20
+S3_HEDGE_VARIABLE = 'CDFLOW_S3_HEDGE'
+DEFAULT_S3_HEDGE_DELAY = 0.5
+S3_LATENCY_SAMPLES = 100
+AWS_CREDENTIALS_MIN_LIFETIME_VARIABLE = 'CDFLOW_AWS_CREDENTIALS_MIN_LIFETIME'
+DEFAULT_AWS_CREDENTIALS_MIN_LIFETIME = 15 * 60
+# Only deploy needs AWS credentials in the wrapper, to read from S3. With
+# CDFLOW_AWS_CREDENTIALS=resolve they are resolved for every command and
+# passed to the container, so it does not resolve them again.
+AWS_CREDENTIALS_VARIABLE = 'CDFLOW_AWS_CREDENTIALS'
+AWS_CREDENTIALS_COMMANDS = ('deploy',)
+# Where botocore finds credentials besides the config and credentials files.
+AWS_CREDENTIALS_SOURCE_VARIABLES = (
+    'AWS_WEB_IDENTITY_TOKEN_FILE',
+    'AWS_CONTAINER_CREDENTIALS_RELATIVE_URI',
+    'AWS_CONTAINER_CREDENTIALS_FULL_URI',
+)
+MIN_S3_HEDGE_SAMPLES = 20
+
+PREFLIGHT_VARIABLE = 'CDFLOW_PREFLIGHT'
+
+# Container output is written once this much is buffered, or this long after
+# the first unwritten byte arrived.
+LOG_FLUSH_SIZE = 64 * 1024
+LOG_FLUSH_INTERVAL = 0.05
+# Container output not yet written is held in memory up to this size, and
+# spilled to a temporary file beyond it.
+LOG_BUFFER_SIZE = 8 * 1024 * 1024
+
+# The end of the container's output is kept, to show again when it fails.
+LOG_TAIL_SIZE = 16 * 1024
+LOG_TAIL_LINES = 30
+
+# Docker prefixes each chunk of a non-TTY container's output with a header
+# naming the stream it was written to and the length of the chunk.
+FRAME_HEADER = struct.Struct('>BxxxL')
+STDOUT = 1
+STDERR = 2
+
+# Each run's output is archived in the cache, in independently compressed
+# blocks of about this size.
+LOG_RETENTION_VARIABLE = 'CDFLOW_LOG_RETENTION'
+DEFAULT_LOG_RETENTION = 20
+LOG_ARCHIVE_BLOCK_SIZE = 256 * 1024
+LOG_ARCHIVE_LEVEL = 1
+LOG_ARCHIVE_COMPRESSORS = 4
+RELEASE_ARTIFACT_VARIABLE = 'CDFLOW_RELEASE_ARTIFACT'
+# With CDFLOW_PREFETCH_RELEASE set, deploy downloads the release zip into the
+# cache while the image is pulled, for images that use it.
+RELEASE_PREFETCH_VARIABLE = 'CDFLOW_PREFETCH_RELEASE'
+
+# With CDFLOW_CONTAINER_CLEANUP=reaper, each finished container is removed in
+# the background as soon as its exit status is read, with at most this many
+# waiting their turn. At exit, removals still pending are given this long.
+CONTAINER_CLEANUP_VARIABLE = 'CDFLOW_CONTAINER_CLEANUP'
+REAPER_QUEUE_SIZE = 16
+REAPER_EXIT_TIMEOUT = 10
+
+# Containers are labelled with the wrapper that started them, so that
+# cdflow gc can find those left behind when it was killed.
+PID_LABEL = 'cdflow.pid'
+HOST_LABEL = 'cdflow.host'
+COMPONENT_LABEL = 'cdflow.component'
+STARTED_LABEL = 'cdflow.started'
+
+# With CDFLOW_WARM_POOL set to the most containers to keep, commands run by
+# exec in a container kept running from an earlier command, instead of in a
+# new container each. One idle for longer than CDFLOW_WARM_POOL_IDLE seconds
+# is removed.
+WARM_POOL_VARIABLE = 'CDFLOW_WARM_POOL'
+WARM_POOL_IDLE_VARIABLE = 'CDFLOW_WARM_POOL_IDLE'
+DEFAULT_WARM_POOL_IDLE = 15 * 60
+POOL_LABEL = 'cdflow.pool'
+# Keeps a pooled container running between commands.
+WARM_CONTAINER_ENTRYPOINT = ['tail', '-f', '/dev/null']
+# The engine may record an exec's exit code just after its output ends.
+EXEC_EXIT_POLL_INTERVAL = 0.01
+EXEC_EXIT_TIMEOUT = 10
+
+# deploy --plan-only --watch plans again whenever the project changes, once
+# nothing more has changed for WATCH_DEBOUNCE seconds, so that saving several
+# files runs one plan. Without inotify the project is scanned for changes
+# every WATCH_POLL_INTERVAL seconds instead.
+WATCH_FLAG = '--watch'
+WATCH_DEBOUNCE = 0.1
+WATCH_POLL_INTERVAL = 0.5
+# inotify(7) event masks.
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_EVENTS = (
+    IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+)
+INOTIFY_EVENT = struct.Struct('iIII')
+
+DOCKER_HUB_REGISTRY = 'registry-1.docker.io'
+REGISTRY_TIMEOUT = 5
+MANIFEST_MEDIA_TYPES = (
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+)
+
 logging.basicConfig(format='[%(asctime)s] %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
 logger = logging.getLogger(__name__)
@@ -54,18 +214,506 @@ class MissingPlatformConfigError(CDFlowWrapperException):
     message = 'error: --platform-config parameter is required'
 
 
+class CacheUsageError(CDFlowWrapperException):
+    message = 'usage: cdflow cache stats|prune'
+
+
+class VersionsUsageError(CDFlowWrapperException):
+    message = 'usage: cdflow versions [--component NAME] [--fast]'
+
+
+class S3DeadlineError(CDFlowWrapperException):
+    message = 'error: timed out reading from S3'
+
+
+class CacheUnavailableError(CDFlowWrapperException):
+    message = 'error: could not open the cdflow cache'
+
+
+class LogStageError(CDFlowWrapperException):
+    message = 'error: log-stages in cdflow.yml must be a list of: {}'.format(
+        ', '.join(sorted(
+            ('collapse-refreshing', 'mask-secrets', 'tags', 'timestamps'),
+        )),
+    )
+
+
+class LogsUsageError(CDFlowWrapperException):
+    message = (
+        'usage: cdflow logs [RUN] [--phase init|refresh|plan|apply] '
+        '[--offset BYTES]'
+    )
+
+
+class LogNotFoundError(CDFlowWrapperException):
+    message = 'error: no such run or phase; run cdflow logs to list runs'
+
+
+class GcUsageError(CDFlowWrapperException):
+    message = 'usage: cdflow gc [--dry-run]'
+
+
+class WatchUsageError(CDFlowWrapperException):
+    message = (
+        'usage: cdflow deploy <environment> <version> --plan-only --watch'
+    )
+
+
+class MissingDaemonSocketError(CDFlowWrapperException):
+    message = 'error: {} must be set to run the daemon'.format(
+        DAEMON_SOCKET_VARIABLE,
+    )
+
+
+class CacheStore(object):
+    """SQLite-backed cache shared by every cdflow invocation on the host.
+
+    Release metadata never changes once published, so it is kept until
+    evicted. Other S3 objects are stored with their ETag and revalidated
+    with a conditional request on every use.
+    """
+
+    # Bumped whenever the schema or the format of cached values changes.
+    VERSION = 9
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS image_digests (
+            image_id TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            stored_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS s3_objects (
+            bucket TEXT NOT NULL,
+            key TEXT NOT NULL,
+            etag TEXT,
+            body BLOB NOT NULL,
+            immutable INTEGER NOT NULL,
+            accessed_at REAL NOT NULL,
+            PRIMARY KEY (bucket, key)
+        );
+        CREATE TABLE IF NOT EXISTS release_versions (
+            bucket TEXT NOT NULL,
+            key TEXT NOT NULL,
+            version TEXT NOT NULL,
+            digest TEXT,
+            last_modified REAL NOT NULL,
+            PRIMARY KEY (bucket, key)
+        );
+        CREATE TABLE IF NOT EXISTS bucket_regions (
+            bucket TEXT PRIMARY KEY,
+            region TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS s3_latencies (
+            seconds REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS aws_credentials (
+            profile TEXT NOT NULL,
+            role_arn TEXT NOT NULL,
+            source TEXT NOT NULL,
+            access_key TEXT NOT NULL,
+            secret_key TEXT NOT NULL,
+            token TEXT,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (profile, role_arn, source)
+        );
+        CREATE TABLE IF NOT EXISTS release_artifacts (
+            bucket TEXT NOT NULL,
+            key TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            accessed_at REAL NOT NULL,
+            PRIMARY KEY (bucket, key)
+        );
+        CREATE TABLE IF NOT EXISTS manifests (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS warm_containers (
+            container_id TEXT PRIMARY KEY,
+            pool_key TEXT NOT NULL,
+            entrypoint TEXT NOT NULL,
+            busy_pid INTEGER,
+            last_used REAL NOT NULL
+        );
+    '''
+
+    STATS_QUERIES = (
+        ('image digests', '''
+            SELECT COUNT(*), COALESCE(SUM(LENGTH(digest)), 0)
+            FROM image_digests
+        '''),
+        ('release metadata', '''
+            SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0)
+            FROM s3_objects WHERE immutable
+        '''),
+        ('revalidated objects', '''
+            SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0)
+            FROM s3_objects WHERE NOT immutable
+        '''),
+        ('release versions', '''
+            SELECT COUNT(*), COALESCE(SUM(
+                LENGTH(key) + LENGTH(version) + COALESCE(LENGTH(digest), 0)
+            ), 0)
+            FROM release_versions
+        '''),
+        ('release artifacts', '''
+            SELECT COUNT(DISTINCT digest), COALESCE(SUM(size), 0)
+            FROM (SELECT DISTINCT digest, size FROM release_artifacts)
+        '''),
+    )
+
+    def __init__(
+        self, path, max_size=DEFAULT_CACHE_MAX_SIZE,
+        max_age=DEFAULT_CACHE_MAX_AGE,
+    ):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        # Event hooks on the S3 client may record bucket regions from
+        # worker threads; every statement runs on its own in autocommit mode.
+        self.connection = sqlite3.connect(
+            path, timeout=10, isolation_level=None, check_same_thread=False,
+        )
+        version = self.connection.execute('PRAGMA user_version').fetchone()
+        if version[0] != self.VERSION:
+            self._reset()
+
+    @property
+    def artifact_dir(self):
+        """Directory of release zips, each named by its SHA-256."""
+        return os.path.join(os.path.dirname(self.path), 'releases')
+
+    @property
+    def log_dir(self):
+        """Directory of archived container output, one file per run."""
+        return os.path.join(os.path.dirname(self.path), 'logs')
+
+    def _reset(self):
+        tables = self.connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        ).fetchall()
+        for table, in tables:
+            self.connection.execute('DROP TABLE {}'.format(table))
+        self.connection.executescript(self.SCHEMA)
+        self.connection.execute('PRAGMA user_version = {}'.format(
+            self.VERSION,
+        ))
+
+    def get_image_digest(self, image_id, max_age):
+        row = self.connection.execute(
+            'SELECT digest FROM image_digests '
+            'WHERE image_id = ? AND stored_at >= ?',
+            (image_id, time.time() - max_age),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put_image_digest(self, image_id, digest):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO image_digests VALUES (?, ?, ?)',
+            (image_id, digest, time.time()),
+        )
+
+    def get_object(self, bucket, key):
+        """Return the cached (etag, body) of an S3 object, if any."""
+        row = self.connection.execute(
+            'SELECT etag, body FROM s3_objects WHERE bucket = ? AND key = ?',
+            (bucket, key),
+        ).fetchone()
+        if row:
+            self.connection.execute(
+                'UPDATE s3_objects SET accessed_at = ? '
+                'WHERE bucket = ? AND key = ?',
+                (time.time(), bucket, key),
+            )
+        return row
+
+    def put_object(self, bucket, key, body, etag=None, immutable=False):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO s3_objects VALUES (?, ?, ?, ?, ?, ?)',
+            (bucket, key, etag, body, immutable, time.time()),
+        )
+        self.prune()
+
+    def get_release_versions(self, bucket, prefix):
+        """Return indexed (key, version, digest, last_modified) rows.
+
+        Rows are ordered by key, as S3 lists them.
+        """
+        return self.connection.execute(
+            'SELECT key, version, digest, last_modified '
+            'FROM release_versions '
+            'WHERE bucket = ? AND SUBSTR(key, 1, ?) = ? ORDER BY key',
+            (bucket, len(prefix), prefix),
+        ).fetchall()
+
+    def put_release_versions(self, bucket, rows):
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO release_versions VALUES (?, ?, ?, ?, ?)',
+            [(bucket,) + tuple(row) for row in rows],
+        )
+
+    def get_bucket_regions(self):
+        return dict(self.connection.execute(
+            'SELECT bucket, region FROM bucket_regions'
+        ).fetchall())
+
+    def put_bucket_region(self, bucket, region):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO bucket_regions VALUES (?, ?)',
+            (bucket, region),
+        )
+
+    def get_s3_latencies(self, limit=S3_LATENCY_SAMPLES):
+        """Return the most recent S3 read latencies, oldest first."""
+        rows = self.connection.execute(
+            'SELECT seconds FROM s3_latencies ORDER BY rowid DESC LIMIT ?',
+            (limit,),
+        ).fetchall()
+        return [seconds for seconds, in reversed(rows)]
+
+    def put_s3_latency(self, seconds, limit=S3_LATENCY_SAMPLES):
+        self.connection.execute(
+            'INSERT INTO s3_latencies VALUES (?)', (seconds,),
+        )
+        self.connection.execute(
+            'DELETE FROM s3_latencies WHERE rowid <= '
+            '(SELECT MAX(rowid) FROM s3_latencies) - ?', (limit,),
+        )
+
+    def get_aws_credentials(self, profile, role_arn, source, min_expiry):
+        """Return (access key, secret key, token, expiry) still valid at
+        min_expiry, if any."""
+        return self.connection.execute(
+            'SELECT access_key, secret_key, token, expires_at '
+            'FROM aws_credentials '
+            'WHERE profile = ? AND role_arn = ? AND source = ? '
+            'AND expires_at >= ?',
+            (profile, role_arn, source, min_expiry),
+        ).fetchone()
+
+    def put_aws_credentials(self, profile, role_arn, source, credentials):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO aws_credentials '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (profile, role_arn, source) + tuple(credentials),
+        )
+
+    def get_manifest(self, path, mtime_ns, size):
+        """Return the marshalled manifest parsed from this version of the
+        file, if any."""
+        row = self.connection.execute(
+            'SELECT data FROM manifests '
+            'WHERE path = ? AND mtime_ns = ? AND size = ?',
+            (path, mtime_ns, size),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put_manifest(self, path, mtime_ns, size, data):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO manifests VALUES (?, ?, ?, ?)',
+            (path, mtime_ns, size, data),
+        )
+
+    def get_release_artifact(self, bucket, key):
+        """Return the path of a cached release zip, if any."""
+        row = self.connection.execute(
+            'SELECT digest FROM release_artifacts '
+            'WHERE bucket = ? AND key = ?',
+            (bucket, key),
+        ).fetchone()
+        if row is None:
+            return None
+        path = os.path.join(self.artifact_dir, '{}.zip'.format(row[0]))
+        if not os.path.exists(path):
+            return None
+        self.connection.execute(
+            'UPDATE release_artifacts SET accessed_at = ? '
+            'WHERE bucket = ? AND key = ?',
+            (time.time(), bucket, key),
+        )
+        return path
+
+    def put_release_artifact(self, bucket, key, digest, size):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO release_artifacts VALUES (?, ?, ?, ?, ?)',
+            (bucket, key, digest, size, time.time()),
+        )
+        self.prune()
+
+    def claim_warm_container(self, pool_key, pid):
+        """Mark the most recently used idle container in the pool under
+        pool_key as in use by process pid, returning its (container id,
+        entrypoint), if there is one."""
+        # A single statement, so two processes never claim the same one.
+        self.connection.execute(
+            'UPDATE warm_containers SET busy_pid = ? '
+            'WHERE busy_pid IS NULL AND container_id = ('
+            '    SELECT container_id FROM warm_containers'
+            '    WHERE pool_key = ? AND busy_pid IS NULL'
+            '    ORDER BY last_used DESC LIMIT 1'
+            ')',
+            (pid, pool_key),
+        )
+        row = self.connection.execute(
+            'SELECT container_id, entrypoint FROM warm_containers '
+            'WHERE pool_key = ? AND busy_pid = ?',
+            (pool_key, pid),
+        ).fetchone()
+        return row and (row[0], json.loads(row[1]))
+
+    def put_warm_container(self, container_id, pool_key, entrypoint, pid):
+        """Add a container to the pool, in use by process pid."""
+        self.connection.execute(
+            'INSERT OR REPLACE INTO warm_containers VALUES (?, ?, ?, ?, ?)',
+            (container_id, pool_key, json.dumps(entrypoint), pid, time.time()),
+        )
+
+    def release_warm_container(self, container_id):
+        self.connection.execute(
+            'UPDATE warm_containers SET busy_pid = NULL, last_used = ? '
+            'WHERE container_id = ?',
+            (time.time(), container_id),
+        )
+
+    def get_warm_containers(self):
+        """Return the (container id, busy pid, last used) of each pooled
+        container, most recently used first."""
+        return self.connection.execute(
+            'SELECT container_id, busy_pid, last_used FROM warm_containers '
+            'ORDER BY last_used DESC'
+        ).fetchall()
+
+    def forget_warm_container(self, container_id, busy_pid=None):
+        """Remove a container from the pool if it is still in use by
+        busy_pid, or idle if that is None, returning whether it was."""
+        return self.connection.execute(
+            'DELETE FROM warm_containers '
+            'WHERE container_id = ? AND busy_pid IS ?',
+            (container_id, busy_pid),
+        ).rowcount > 0
+
+    def prune(self):
+        cutoff = time.time() - self.max_age
+        self.connection.execute(
+            'DELETE FROM aws_credentials WHERE expires_at < ?', (time.time(),),
+        )
+        removed = self.connection.execute(
+            'DELETE FROM image_digests WHERE stored_at < ?', (cutoff,),
+        ).rowcount
+        removed += self.connection.execute(
+            'DELETE FROM s3_objects WHERE accessed_at < ?', (cutoff,),
+        ).rowcount
+        removed += self.connection.execute(
+            'DELETE FROM release_artifacts WHERE accessed_at < ?', (cutoff,),
+        ).rowcount
+        removed += self._evict_to_max_size()
+        self._remove_unreferenced_artifacts()
+        return removed
+
+    def _remove_unreferenced_artifacts(self):
+        # A zip is recorded before it is renamed into place, so one not
+        # recorded is never a download another process is finishing.
+        referenced = {
+            '{}.zip'.format(digest) for digest, in self.connection.execute(
+                'SELECT digest FROM release_artifacts'
+            ).fetchall()
+        }
+        with _suppress(FileNotFoundError):
+            for name in os.listdir(self.artifact_dir):
+                # Partial downloads are left to the process writing them.
+                if name.endswith('.zip') and name not in referenced:
+                    os.remove(os.path.join(self.artifact_dir, name))
+
+    def _evict_to_max_size(self):
+        rows = self.connection.execute('''
+            SELECT 's3_objects', bucket, key, LENGTH(body), NULL, accessed_at
+            FROM s3_objects
+            UNION ALL
+            SELECT 'release_artifacts', bucket, key, size, digest, accessed_at
+            FROM release_artifacts
+            ORDER BY accessed_at DESC
+        ''').fetchall()
+        evicted = list(self._beyond_max_size(rows))
+        for table in ('s3_objects', 'release_artifacts'):
+            self.connection.executemany(
+                'DELETE FROM {} WHERE bucket = ? AND key = ?'.format(table),
+                [row[1:] for row in evicted if row[0] == table],
+            )
+        return len(evicted)
+
+    def _beyond_max_size(self, rows):
+        total_size = 0
+        digests = set()
+        for table, bucket, key, size, digest, _ in rows:
+            # Releases with the same zip share its file.
+            if digest is None or digest not in digests:
+                total_size += size
+                digests.add(digest)
+            if total_size > self.max_size:
+                yield table, bucket, key
+
+    def stats(self):
+        return [
+            (name,) + self.connection.execute(query).fetchone()
+            for name, query in self.STATS_QUERIES
+        ]
+
+
+def get_cache_dir(environment):
+    if CACHE_DIR_VARIABLE in environment:
+        return environment[CACHE_DIR_VARIABLE]
+    return os.path.join(
+        environment.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'cdflow',
+    )
+
+
+def open_cache(environment):
+    cache_dir = get_cache_dir(environment)
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        path = os.path.join(cache_dir, 'cache.db')
+        # The cache holds temporary AWS credentials.
+        os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+        return CacheStore(
+            path,
+            int(environment.get(
+                CACHE_MAX_SIZE_VARIABLE, DEFAULT_CACHE_MAX_SIZE,
+            )),
+            int(environment.get(
+                CACHE_MAX_AGE_VARIABLE, DEFAULT_CACHE_MAX_AGE,
+            )),
+        )
+    except (OSError, sqlite3.Error) as e:
+        logger.debug('Not using cache in {}: {}'.format(cache_dir, e))
+        return None
+
+
 def fetch_release_metadata(
     s3_resource, bucket_name, component_name, version, team_name=None,
+    cache=None,
 ):
-    if team_name:
-        key = _get_release_storage_key(team_name, component_name, version)
-    else:
-        key = _get_release_storage_key_classic(component_name, version)
+    key = get_release_key(component_name, version, team_name)
+    cached = cache.get_object(bucket_name, key) if cache else None
+    if cached:
+        logger.debug('Using cached metadata on {}'.format(key))
+        return json.loads(cached[1])
     logger.debug(
         'Getting metadata on {} from {} bucket'.format(key, bucket_name)
     )
-    release_object = s3_resource.Object(bucket_name, key)
-    return release_object.metadata
+    # Through the client, which unlike the resource is safe to share with
+    # the threads a hedged read, or the concurrent preflight, makes calls in.
+    s3_client = s3_resource.meta.client
+    metadata = read_from_s3(
+        lambda: s3_client.head_object(Bucket=bucket_name, Key=key)['Metadata']
+    )
+    if cache:
+        cache.put_object(
+            bucket_name, key, json.dumps(metadata), immutable=True,
+        )
+    return metadata
 
 
 def get_version(argv):
@@ -120,7 +768,100 @@ def _get_component_name_from_cli_args(argv):
         return argv[component_flag_index + 1]
 
 
-def _get_component_name_from_git_remote():
+# A section header such as [core] or [remote "origin"].
+_GIT_SECTION = re.compile(
+    r'\s*\[\s*([^\s\]"]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]'
+)
+
+
+def _git_config_value(raw_value):
+    value = []
+    quoted = False
+    characters = iter(raw_value.strip())
+    for character in characters:
+        if character == '"':
+            quoted = not quoted
+        elif character == '\\':
+            escaped = next(characters, '')
+            value.append({'n': '\n', 't': '\t'}.get(escaped, escaped))
+        elif character in '#;' and not quoted:
+            break
+        else:
+            value.append(character)
+    return ''.join(value).strip()
+
+
+def parse_git_remote_url(config_text, remote='origin'):
+    """Return the last url of the remote in a git config file, if any."""
+    section = None
+    url = None
+    for line in config_text.splitlines():
+        match = _GIT_SECTION.match(line)
+        if match:
+            section = (match.group(1).lower(), match.group(2))
+            continue
+        key, _, value = line.partition('=')
+        if section == ('remote', remote) and key.strip().lower() == 'url':
+            url = _git_config_value(value)
+    return url
+
+
+def _read_gitdir_file(path):
+    with open(path) as gitdir_file:
+        content = gitdir_file.read().strip()
+    if not content.startswith('gitdir:'):
+        return None
+    return os.path.join(os.path.dirname(path), content[7:].strip())
+
+
+def _parent_directories(directory):
+    yield directory
+    while os.path.dirname(directory) != directory:
+        directory = os.path.dirname(directory)
+        yield directory
+
+
+def find_git_dir(start):
+    """Find the git directory of the repository containing start, following
+    the gitdir: files used by worktrees and submodules."""
+    if 'GIT_DIR' in os.environ:
+        return os.environ['GIT_DIR']
+    for directory in _parent_directories(os.path.abspath(start)):
+        dot_git = os.path.join(directory, '.git')
+        if os.path.isdir(dot_git):
+            return dot_git
+        if os.path.isfile(dot_git):
+            return _read_gitdir_file(dot_git)
+    return None
+
+
+def _git_common_dir(git_dir):
+    # A worktree's git directory points at the repository's shared one.
+    with _suppress(FileNotFoundError):
+        with open(os.path.join(git_dir, 'commondir')) as commondir_file:
+            return os.path.join(git_dir, commondir_file.read().strip())
+    return git_dir
+
+
+def read_git_remote_url(start):
+    """Read the origin url from the git config without running git.
+
+    Returns None if it cannot be found this way, e.g. because it is set in
+    an included file, so that git itself can be asked instead.
+    """
+    try:
+        git_dir = find_git_dir(start)
+        if git_dir is None:
+            return None
+        config_path = os.path.join(_git_common_dir(git_dir), 'config')
+        with open(config_path) as config_file:
+            return parse_git_remote_url(config_file.read())
+    except (OSError, UnicodeDecodeError) as e:
+        logger.debug('Could not read git config: {}'.format(e))
+        return None
+
+
+def _get_git_remote_url_from_git():
     try:
         remote = check_output(['git', 'config', 'remote.origin.url'])
     except CalledProcessError:
@@ -128,7 +869,14 @@ def _get_component_name_from_git_remote():
             'error: could not get remote from git repo '
             ' (git config remote.origin.url)'
         )
-    name = remote.decode('utf-8').strip('\t\n /').split('/')[-1]
+    return remote.decode('utf-8')
+
+
+def _get_component_name_from_git_remote():
+    remote = read_git_remote_url(os.getcwd())
+    if remote is None:
+        remote = _get_git_remote_url_from_git()
+    name = remote.strip('\t\n /').split('/')[-1]
     if name.endswith('.git'):
         return name[:-4]
     return name
@@ -164,7 +912,209 @@ def _get_release_storage_key(team_name, component_name, version):
     )
 
 
+def get_release_key(component_name, version, team_name=None):
+    if team_name:
+        return _get_release_storage_key(team_name, component_name, version)
+    return _get_release_storage_key_classic(component_name, version)
+
+
+def _get_release_storage_prefix(component_name, team_name=None):
+    if team_name:
+        key = _get_release_storage_key(team_name, component_name, '')
+    else:
+        key = _get_release_storage_key_classic(component_name, '')
+    return key[:-len('.zip')]
+
+
+def list_release_keys(s3_client, bucket_name, prefix, start_after=None):
+    """Yield (key, last modified timestamp) of each release zip."""
+    kwargs = {'StartAfter': start_after} if start_after else {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(
+        Bucket=bucket_name, Prefix=prefix, **kwargs
+    ):
+        for s3_object in page.get('Contents', []):
+            if s3_object['Key'].endswith('.zip'):
+                yield (
+                    s3_object['Key'], s3_object['LastModified'].timestamp(),
+                )
+
+
+def _head_release_metadata(s3_client, bucket_name, key):
+    return s3_client.head_object(Bucket=bucket_name, Key=key)['Metadata']
+
+
+def _fetch_release_digests(s3_client, bucket_name, keys):
+    concurrency = s3_client.meta.config.max_pool_connections
+    with ThreadPoolExecutor(concurrency) as executor:
+        return list(executor.map(
+            lambda key: _head_release_metadata(
+                s3_client, bucket_name, key,
+            ).get('cdflow_image_digest'),
+            keys,
+        ))
+
+
+def index_release_versions(
+    s3_client, bucket_name, prefix, cache=None, fast=False,
+):
+    """Return (key, version, digest, last_modified) of every release.
+
+    Every release is listed, but metadata is only fetched for those not in
+    the index yet, as release zips never change once published. The fast
+    mode only lists keys after the last indexed one, which misses versions
+    that sort before it, such as 10 after 9.
+    """
+    indexed = cache.get_release_versions(bucket_name, prefix) if cache else []
+    start_after = indexed[-1][0] if indexed and fast else None
+    listed = list(list_release_keys(
+        s3_client, bucket_name, prefix, start_after,
+    ))
+    indexed_rows = {row[0]: row for row in indexed}
+    missing = [
+        (key, last_modified) for key, last_modified in listed
+        if key not in indexed_rows
+    ]
+    logger.debug('Fetching metadata for {} new releases'.format(len(missing)))
+    digests = _fetch_release_digests(
+        s3_client, bucket_name, [key for key, _ in missing],
+    )
+    new = [
+        (key, key[len(prefix):-len('.zip')], digest, last_modified)
+        for (key, last_modified), digest in zip(missing, digests)
+    ]
+    if cache:
+        cache.put_release_versions(bucket_name, new)
+    if not fast:
+        # Releases deleted since they were indexed are no longer listed.
+        indexed = [
+            indexed_rows[key] for key, _ in listed if key in indexed_rows
+        ]
+    return sorted(indexed + new, key=lambda row: row[3])
+
+
+def parse_image_reference(image_id):
+    name, tag = image_id, 'latest'
+    if ':' in image_id.rsplit('/', 1)[-1]:
+        name, tag = image_id.rsplit(':', 1)
+    first, _, rest = name.partition('/')
+    if rest and ('.' in first or ':' in first or first == 'localhost'):
+        return first, rest, tag
+    repository = name if rest else 'library/{}'.format(name)
+    return DOCKER_HUB_REGISTRY, repository, tag
+
+
+def _image_name(image_id):
+    if ':' in image_id.rsplit('/', 1)[-1]:
+        return image_id.rsplit(':', 1)[0]
+    return image_id
+
+
+def _fetch_registry_token(challenge):
+    from urllib.parse import urlencode
+    from urllib.request import urlopen
+
+    params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+    url = '{}?{}'.format(params.pop('realm'), urlencode(params))
+    with urlopen(url, timeout=REGISTRY_TIMEOUT) as response:
+        body = json.loads(response.read().decode('utf-8'))
+    return body.get('token') or body['access_token']
+
+
+def _registry_head(url, headers={}):
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+    request = Request(url, method='HEAD', headers=dict(
+        headers, Accept=', '.join(MANIFEST_MEDIA_TYPES),
+    ))
+    try:
+        with urlopen(request, timeout=REGISTRY_TIMEOUT) as response:
+            return response.headers
+    except HTTPError as e:
+        challenge = e.headers.get('WWW-Authenticate', '')
+        if e.code != 401 or headers or not challenge.startswith('Bearer '):
+            raise
+    token = _fetch_registry_token(challenge)
+    return _registry_head(url, {'Authorization': 'Bearer {}'.format(token)})
+
+
+def fetch_manifest_digest(image_id):
+    registry, repository, tag = parse_image_reference(image_id)
+    scheme = 'http' if registry.split(':')[0] in (
+        'localhost', '127.0.0.1',
+    ) else 'https'
+    url = '{}://{}/v2/{}/manifests/{}'.format(
+        scheme, registry, repository, tag,
+    )
+    logger.debug('Getting manifest digest from {}'.format(url))
+    try:
+        return _registry_head(url).get('Docker-Content-Digest')
+    except (OSError, ValueError, KeyError) as e:
+        logger.debug('Could not get manifest digest: {}'.format(e))
+
+
+def lookup_manifest_digest(image_id, cache, ttl):
+    digest = cache.get_image_digest(image_id, ttl) if cache else None
+    if digest is None:
+        digest = fetch_manifest_digest(image_id)
+        if digest and cache:
+            cache.put_image_digest(image_id, digest)
+    return digest
+
+
+def _find_up_to_date_local_image(docker_client, image_id, cache, ttl):
+    from docker.errors import ImageNotFound
+
+    digest = lookup_manifest_digest(image_id, cache, ttl)
+    if digest is None:
+        return None
+    repo_digest = '{}@{}'.format(_image_name(image_id), digest)
+    try:
+        image = docker_client.images.get(image_id)
+    except ImageNotFound:
+        return None
+    if repo_digest in image.attrs['RepoDigests']:
+        logger.info('Image {} is up to date'.format(image_id))
+        return repo_digest
+
+
+def resolve_image_sha(
+    docker_client, image_id, cache=None, ttl=DEFAULT_IMAGE_DIGEST_TTL,
+):
+    if '@' not in image_id:
+        repo_digest = _find_up_to_date_local_image(
+            docker_client, image_id, cache, ttl,
+        )
+        if repo_digest:
+            return repo_digest
+    return get_image_sha(docker_client, image_id)
+
+
+def get_image_digest_ttl(environment):
+    return int(environment.get(
+        IMAGE_DIGEST_TTL_VARIABLE, DEFAULT_IMAGE_DIGEST_TTL,
+    ))
+
+
+def pull_image(docker_client, image_id):
+    """Pull the image unless it is present, leaving any failure for
+    running the container to report."""
+    from docker.errors import DockerException, ImageNotFound
+
+    try:
+        docker_client.images.get(image_id)
+    except ImageNotFound:
+        logger.info('Pulling image {}'.format(image_id))
+        try:
+            docker_client.images.pull(image_id)
+        except DockerException as e:
+            logger.debug('Could not pull {}: {}'.format(image_id, e))
+
+
 def get_image_sha(docker_client, image_id):
+    from docker.errors import ImageNotFound
+
     logger.info('Pulling image {}'.format(image_id))
     try:
         image = docker_client.images.pull(image_id)
@@ -180,237 +1130,2788 @@ def get_image_sha(docker_client, image_id):
     return digests[0] if len(digests) else image_id
 
 
+def _volumes(project_root, read_only_paths):
+    volumes = {
+        project_root: {
+            'bind': project_root,
+            'mode': 'rw',
+        },
+        '/var/run/docker.sock': {
+            'bind': '/var/run/docker.sock',
+            'mode': 'ro',
+        }
+    }
+    for path in read_only_paths:
+        volumes[path] = {
+            'bind': path,
+            'mode': 'ro',
+        }
+    return volumes
+
+
 def docker_run(
     docker_client, image_id, command, project_root,
-    environment_variables, platform_config_paths=[],
+    environment_variables, platform_config_paths=[], release_artifact=None,
+    log_stages=(), log_archive=None, component_name=None, warm_pool=None,
 ):
+    from docker.errors import DockerException
+
     exit_status = 0
     output = 'Done'
     try:
-        volumes = {
-            project_root: {
-                'bind': project_root,
-                'mode': 'rw',
-            },
-            '/var/run/docker.sock': {
-                'bind': '/var/run/docker.sock',
-                'mode': 'ro',
-            }
-        }
-        for platform_config_path in platform_config_paths:
-            volumes[platform_config_path] = {
-                'bind': platform_config_path,
-                'mode': 'ro',
-            }
+        volumes = _volumes(project_root, _read_only_paths(
+            platform_config_paths, release_artifact,
+        ))
+        labels = container_labels(component_name)
         if _command(command) == 'shell':
-            columns = int(check_output(['tput', 'cols']))
-            lines = int(check_output(['tput', 'lines']))
-            environment_variables['COLUMNS'] = columns
-            environment_variables['LINES'] = lines
-            container = docker_client.containers.create(
-                image_id,
-                command=command,
-                environment=environment_variables,
-                volumes=volumes,
-                working_dir=project_root,
-                tty=True,
-                stdin_open=True,
+            _run_shell(
+                docker_client, image_id, command, project_root,
+                environment_variables, volumes, labels,
             )
-            dockerpty.start(docker_client.api, container.id)
             output = 'Shell end'
+        elif warm_pool is not None:
+            return warm_pool.run(
+                docker_client, image_id, command, project_root,
+                environment_variables, volumes, labels, log_stages,
+                log_archive,
+            )
         else:
-            container = docker_client.containers.run(
+            container = docker_client.containers.create(
                 image_id,
                 command=command,
                 environment=environment_variables,
-                detach=True,
                 volumes=volumes,
                 working_dir=project_root,
+                labels=labels,
             )
-            _print_logs(container)
-            return handle_finished_container(container)
+            return _relay_until_finished(container, log_stages, log_archive)
     except DockerException as error:
         exit_status = 1
         output = str(error)
     return exit_status, output
 
 
-def handle_finished_container(container):
-    atexit.register(_remove_container, container)
-    container.reload()
-    exit_status = container.attrs['State']['ExitCode']
+def _read_only_paths(platform_config_paths, release_artifact):
+    read_only_paths = list(platform_config_paths)
+    if release_artifact:
+        read_only_paths.append(release_artifact)
+    return read_only_paths
+
+
+def _run_shell(
+    docker_client, image_id, command, project_root, environment_variables,
+    volumes, labels,
+):
+    columns = int(check_output(['tput', 'cols']))
+    lines = int(check_output(['tput', 'lines']))
+    environment_variables['COLUMNS'] = columns
+    environment_variables['LINES'] = lines
+    container = docker_client.containers.create(
+        image_id,
+        command=command,
+        environment=environment_variables,
+        volumes=volumes,
+        working_dir=project_root,
+        tty=True,
+        stdin_open=True,
+        labels=labels,
+    )
+    dockerpty.start(docker_client.api, container.id)
+
+
+def container_labels(component_name=None):
+    return {
+        PID_LABEL: str(os.getpid()),
+        HOST_LABEL: socket.gethostname(),
+        COMPONENT_LABEL: component_name or '',
+        STARTED_LABEL: str(int(time.time())),
+    }
+
+
+def _relay_until_finished(container, log_stages, log_archive):
+    # Attaching before the container starts means none of its output can be
+    # written before anyone is reading it, so no separate logs call is needed.
+    sock = _attach_output(container)
+    container.start()
+    waited = _wait_in_background(container)
+    exit_status = None
+    try:
+        tail = _relay_output(sock, log_stages, log_archive)
+        exit_status, output = handle_finished_container(
+            container, tail, waited,
+        )
+    finally:
+        _close_log_archive(log_archive, exit_status)
+    return exit_status, output
+
+
+def _close_log_archive(log_archive, exit_status):
+    # Closed even if relaying fails, so the output so far is still indexed,
+    # with no exit status.
+    if log_archive is not None:
+        log_archive.close(exit_status)
+
+
+def _relay_output(sock, log_stages, log_archive):
+    tail = TailBuffer()
+    copies = [tail] if log_archive is None else [tail, log_archive]
+    _print_logs(sock, log_stages, copies)
+    return tail
+
+
+def _wait_in_background(container):
+    """Sends the wait request in a daemon thread as soon as the container
+    has started, so its answer arrives as the container exits rather than a
+    round trip after the output ends."""
+    future = Future()
+
+    def wait():
+        try:
+            future.set_result(container.wait())
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=wait, daemon=True).start()
+    return future
+
+
+def handle_finished_container(container, tail=None, waited=None):
+    reaper = container_reaper(os.environ)
+    if reaper is None:
+        _remove_at_exit(container)
+    if waited is None:
+        waited = _wait_in_background(container)
+    exit_status = waited.result()['StatusCode']
+    if reaper is not None:
+        reaper.put(container)
     output = ''
-    if exit_status != 0:
-        output = ''
+    if exit_status != 0 and tail is not None:
+        output = _failure_summary(exit_status, tail.lines(LOG_TAIL_LINES))
     return exit_status, output
 
 
-def _print_logs(container):
-    for message in container.logs(
-        stream=True, follow=True, stdout=True, stderr=True
-    ):
-        print(message.decode('utf-8'), end='')
+def _failure_summary(exit_status, lines):
+    if not lines:
+        return ''
+    return '\n'.join([
+        'cdflow: exited with status {}; the last {} lines of output were:'
+        .format(exit_status, len(lines)),
+    ] + lines)
 
 
-def _remove_container(container):
-    try:
-        container.stop()
-    # An HTTP timeout is thrown until this issue is addressed, then we can
-    # stop catching any exception:
-    # https://github.com/docker/docker-py/issues/1374
-    except ReadTimeout:
-        pass
-    container.remove()
+class TailBuffer(object):
+    """Keeps the last size bytes written to it in a fixed-size ring, so
+    memory use does not grow with the amount written."""
 
+    def __init__(self, size=LOG_TAIL_SIZE):
+        self.ring = bytearray(size)
+        self.end = 0
+        self.wrapped = False
 
-def get_environment():
-    return {
-        'AWS_ACCESS_KEY_ID': os.environ.get('AWS_ACCESS_KEY_ID'),
-        'AWS_SECRET_ACCESS_KEY': os.environ.get('AWS_SECRET_ACCESS_KEY'),
-        'AWS_SESSION_TOKEN': os.environ.get('AWS_SESSION_TOKEN'),
-        'FASTLY_API_KEY': os.environ.get('FASTLY_API_KEY'),
-        'GITHUB_TOKEN': os.environ.get('GITHUB_TOKEN'),
-        'LOGENTRIES_ACCOUNT_KEY': os.environ.get('LOGENTRIES_ACCOUNT_KEY'),
-        'DATADOG_APP_KEY': os.environ.get('DATADOG_APP_KEY'),
-        'DATADOG_API_KEY': os.environ.get('DATADOG_API_KEY'),
-    }
+    def write(self, data):
+        size = len(self.ring)
+        data = memoryview(data)[-size:]
+        first = min(len(data), size - self.end)
+        self.ring[self.end:self.end + first] = data[:first]
+        self.ring[:len(data) - first] = data[first:]
+        self.wrapped = self.wrapped or self.end + len(data) >= size
+        self.end = (self.end + len(data)) % size
 
+    def writelines(self, chunks):
+        for chunk in chunks:
+            self.write(chunk)
 
-def _command(argv):
-    try:
-        return argv[0]
-    except IndexError:
-        pass
+    def getvalue(self):
+        if self.wrapped:
+            return bytes(self.ring[self.end:] + self.ring[:self.end])
+        return bytes(self.ring[:self.end])
 
+    def lines(self, count):
+        """Return up to the last count whole lines, decoded."""
+        lines = self.getvalue().decode('utf-8', 'replace').splitlines()
+        if self.wrapped:
+            # The oldest line was probably cut short.
+            lines = lines[1:]
+        return lines[-count:]
 
-def get_manifest_data():
-    if not os.path.exists(MANIFEST_PATH):
-        return {}
 
-    with open(MANIFEST_PATH) as config_file:
-        return yaml.safe_load(config_file.read())
+class _DecodingWriter(object):
+    """Writes bytes to a text stream, decoding UTF-8 incrementally so that
+    characters split between writes are not mangled."""
 
+    def __init__(self, stream):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
 
-def get_image_id(environment, config):
-    if 'CDFLOW_IMAGE_ID' in environment:
-        return environment['CDFLOW_IMAGE_ID']
+    def write(self, data):
+        self.stream.write(self.decoder.decode(data))
 
-    if 'terraform-version' in config:
-        return "{}:terraform{}".format(
-            CDFLOW_IMAGE_NAME,
-            config['terraform-version']
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.stream.write(self.decoder.decode(b'', final=True))
+        self.stream.flush()
+
+
+def binary_stream(stream):
+    """Return a stream accepting bytes that writes through to stream."""
+    stream.flush()
+    if hasattr(stream, 'buffer'):
+        return stream.buffer
+    return _DecodingWriter(stream)
+
+
+class CoalescingWriter(object):
+    """Buffers writes and passes them on in large blocks.
+
+    A block is written once max_size bytes are buffered, or max_delay
+    seconds after its first byte arrived, so a quiet stream is not held
+    back.
+    """
+
+    def __init__(
+        self, stream, max_size=LOG_FLUSH_SIZE, max_delay=LOG_FLUSH_INTERVAL,
+    ):
+        self.stream = stream
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.closed = False
+        threading.Thread(target=self._flush_when_due, daemon=True).start()
+
+    def write(self, data):
+        self.writelines((data,))
+
+    def writelines(self, chunks):
+        with self.lock:
+            if not self.buffer:
+                self.pending.set()
+            for chunk in chunks:
+                self.buffer += chunk
+            if len(self.buffer) >= self.max_size:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self.closed = True
+        self.pending.set()
+        self.flush()
+        if isinstance(self.stream, _DecodingWriter):
+            self.stream.close()
+
+    def _flush(self):
+        self.pending.clear()
+        if self.buffer:
+            self.stream.write(bytes(self.buffer))
+            self.stream.flush()
+            del self.buffer[:]
+
+    def _flush_when_due(self):
+        while self.pending.wait() and not self.closed:
+            time.sleep(self.max_delay)
+            self.flush()
+
+
+class FrameParser(object):
+    """Splits a container's multiplexed output into its streams.
+
+    Payloads are passed to the writer for their stream as slices of the data
+    fed in, so they are not copied on the way, and consecutive payloads for
+    the same stream are passed in one writelines call. Frames and their
+    headers may be split across any number of feeds.
+    """
+
+    def __init__(self, writers):
+        self.writers = writers
+        self.stream = None
+        self.writer = None
+        self.payloads = []
+        self.remaining = 0
+        self.header = bytearray()
+
+    def feed(self, data):
+        data = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            if self.remaining:
+                offset = self._payload(data, offset)
+            elif self.header or len(data) - offset < FRAME_HEADER.size:
+                offset = self._header(data, offset)
+            else:
+                offset = self._frames(data, offset)
+        self._write_payloads()
+
+    def _frames(self, data, offset):
+        last_header = len(data) - FRAME_HEADER.size
+        while offset <= last_header:
+            stream, length = FRAME_HEADER.unpack_from(data, offset)
+            if stream != self.stream:
+                self._select(stream)
+            offset += FRAME_HEADER.size
+            self.payloads.append(data[offset:offset + length])
+            offset += length
+        if offset > len(data):
+            self.remaining = offset - len(data)
+        return min(offset, len(data))
+
+    def _payload(self, data, offset):
+        end = min(offset + self.remaining, len(data))
+        self.payloads.append(data[offset:end])
+        self.remaining -= end - offset
+        return end
+
+    def _header(self, data, offset):
+        end = min(offset + FRAME_HEADER.size - len(self.header), len(data))
+        self.header += data[offset:end]
+        if len(self.header) == FRAME_HEADER.size:
+            stream, self.remaining = FRAME_HEADER.unpack(self.header)
+            self._select(stream)
+            del self.header[:]
+        return end
+
+    def _select(self, stream):
+        if self.writer is not None:
+            # Keep the order of output interleaved between the streams.
+            self._write_payloads()
+            self.writer.flush()
+        self.stream = stream
+        self.writer = self.writers.get(stream, self.writers[STDOUT])
+
+    def _write_payloads(self):
+        if self.payloads:
+            self.writer.writelines(self.payloads)
+            self.payloads = []
+
+
+class SpillingBuffer(object):
+    """Passes chunks of bytes from a producer thread to a consumer thread.
+
+    Up to max_memory bytes are held in memory. Beyond that, chunks are
+    appended to a temporary file until the consumer has caught up, so the
+    producer never waits for the consumer. high_water records the most bytes
+    held in memory at once, and spilled the total written to disk.
+    """
+
+    def __init__(self, max_memory=LOG_BUFFER_SIZE, read_size=LOG_FLUSH_SIZE):
+        self.max_memory = max_memory
+        self.read_size = read_size
+        self.chunks = deque()
+        self.memory = 0
+        self.spill_file = None
+        self.spill_start = 0
+        self.spill_end = 0
+        self.high_water = 0
+        self.spilled = 0
+        self.finished = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def put(self, data):
+        if not data:
+            return
+        with self.condition:
+            if self.spill_end > self.spill_start or \
+                    self.memory + len(data) > self.max_memory:
+                self._spill(data)
+            else:
+                self.chunks.append(data)
+                self.memory += len(data)
+                self.high_water = max(self.high_water, self.memory)
+            self.condition.notify()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.finished = True
+            self.error = error
+            self.condition.notify()
+
+    def get(self):
+        """Return the next chunk, or b'' once the producer has finished."""
+        with self.condition:
+            self.condition.wait_for(self._readable)
+            if self.chunks:
+                data = self.chunks.popleft()
+                self.memory -= len(data)
+                return data
+            if self.spill_end > self.spill_start:
+                return self._unspill()
+            if self.error is not None:
+                raise self.error
+            return b''
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+
+    def _readable(self):
+        return self.chunks or self.spill_end > self.spill_start or \
+            self.finished
+
+    def _spill(self, data):
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix='cdflow-logs-')
+        os.pwrite(self.spill_file.fileno(), data, self.spill_end)
+        self.spill_end += len(data)
+        self.spilled += len(data)
+
+    def _unspill(self):
+        data = os.pread(
+            self.spill_file.fileno(),
+            min(self.read_size, self.spill_end - self.spill_start),
+            self.spill_start,
         )
+        self.spill_start += len(data)
+        if self.spill_start == self.spill_end:
+            self.spill_file.truncate(0)
+            self.spill_start = self.spill_end = 0
+        return data
+
+
+def _reader(sock):
+    """Return a function reading up to n bytes from sock, without a timeout
+    so that a quiet container is waited on."""
+    raw = getattr(sock, '_sock', sock)
+    if hasattr(raw, 'settimeout'):
+        raw.settimeout(None)
+    if hasattr(sock, 'recv'):
+        return sock.recv
+    return sock.read
+
+
+def _read_socket(sock, buffer):
+    read = _reader(sock)
+    try:
+        data = read(LOG_FLUSH_SIZE)
+        while data:
+            buffer.put(data)
+            data = read(LOG_FLUSH_SIZE)
+    except Exception as error:
+        buffer.finish(error)
+    else:
+        buffer.finish()
 
-    return CDFLOW_IMAGE_ID
 
+def relay_frames(sock, writers, buffer=None):
+    """Write a container's multiplexed output to writers.
 
-def find_image_id_from_release(component_name, version, config):
-    session = Session()
-    s3_resource = session.resource('s3')
-    account_scheme_url = config['account-scheme-url']
-    bucket, key = parse_s3_url(account_scheme_url)
-    team = config['team']
-    account_scheme = fetch_account_scheme(
-        s3_resource, bucket, key, team, component_name,
-    )
-    kwargs = {}
-    if not account_scheme.get('classic-metadata-handling'):
-        kwargs['team_name'] = team
-    release_metadata = fetch_release_metadata(
-        s3_resource, account_scheme['release-bucket'], component_name, version,
-        **kwargs
+    The socket is read on a separate thread into buffer, so the container
+    is not held up when the writers are slow.
+    """
+    if buffer is None:
+        buffer = SpillingBuffer()
+    threading.Thread(
+        target=_read_socket, args=(sock, buffer), daemon=True,
+    ).start()
+    parser = FrameParser(writers)
+    try:
+        data = buffer.get()
+        while data:
+            parser.feed(data)
+            data = buffer.get()
+    finally:
+        buffer.close()
+    logger.debug(
+        'Container output buffer peaked at %d bytes, %d bytes spilled to '
+        'disk', buffer.high_water, buffer.spilled,
     )
-    return release_metadata['cdflow_image_digest']
+    return buffer
 
 
-def parse_s3_url(s3_url):
-    if not s3_url.startswith('s3://'):
-        raise InvalidURLError('URL must start with s3://')
-    bucket_and_key = s3_url[5:].split('/', 1)
-    if len(bucket_and_key) != 2:
-        raise InvalidURLError('URL must contain a bucket and a key')
-    return bucket_and_key
-
+def _attach_output(container):
+    return container.attach_socket(params={
+        'stdout': 1, 'stderr': 1, 'stream': 1, 'logs': 1,
+    })
 
-def download_json_from_s3(s3_resource, bucket, key):
-    s3_object = s3_resource.Object(bucket, key)
-    with BytesIO() as f:
-        s3_object.download_fileobj(f)
-        f.seek(0)
-        return json.loads(f.read())
 
+def _print_logs(sock, log_stages=(), copies=()):
+    writers = {
+        STDOUT: CoalescingWriter(binary_stream(sys.stdout)),
+        STDERR: CoalescingWriter(binary_stream(sys.stderr)),
+    }
+    if copies:
+        writers = {
+            stream: TeeWriter(writer, copies)
+            for stream, writer in writers.items()
+        }
+    if log_stages:
+        writers = {
+            stream: LinePipeline(writer, [stage() for stage in log_stages])
+            for stream, writer in writers.items()
+        }
+    try:
+        relay_frames(sock, writers)
+    finally:
+        sock.close()
+        for writer in writers.values():
+            writer.close()
+
+
+class LinePipeline(object):
+    """Passes the complete lines written to it through stages to writer.
+
+    A stage is a function, usually a generator, taking and returning an
+    iterable of lines of bytes. A stage holding lines back may have a finish
+    method returning them once the output has ended. An unfinished last line
+    is held until a newline arrives or the pipeline is closed.
+    """
+
+    def __init__(self, writer, stages):
+        self.writer = writer
+        self.stages = stages
+        self.partial = b''
+
+    def write(self, data):
+        self.writelines((data,))
+
+    def writelines(self, chunks):
+        data = self.partial + b''.join(chunks)
+        end = data.rfind(b'\n') + 1
+        self.partial = data[end:]
+        if end:
+            lines = data[:end].splitlines(keepends=True)
+            for stage in self.stages:
+                lines = stage(lines)
+            self.writer.writelines(lines)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        lines = [self.partial] if self.partial else []
+        self.partial = b''
+        for stage in self.stages:
+            lines = chain(stage(lines), _finish_stage(stage))
+        self.writer.writelines(lines)
+        self.writer.close()
+
+
+def _finish_stage(stage):
+    if hasattr(stage, 'finish'):
+        yield from stage.finish()
+
+
+def timestamp_lines(lines):
+    """Prefix lines with the UTC time they were relayed, to the second."""
+    stamp = time.strftime('%Y-%m-%dT%H:%M:%SZ ', time.gmtime()).encode()
+    for line in lines:
+        yield stamp + line
+
+
+def prefix_lines(prefix):
+    def prefixed_lines(lines):
+        for line in lines:
+            yield prefix + line
+    return prefixed_lines
+
+
+def mask_lines(secrets, mask=b'****'):
+    """Return a stage replacing each of secrets with mask."""
+    if not secrets:
+        return lambda lines: lines
+    # Longest first, so a secret containing another is masked whole.
+    pattern = re.compile(b'|'.join(
+        re.escape(secret) for secret in sorted(secrets, key=len, reverse=True)
+    ))
+
+    def masked_lines(lines):
+        # Secrets are rare, so look for them in the batch as a whole first.
+        lines = list(lines)
+        block = b''.join(lines)
+        if any(secret in block for secret in secrets):
+            return [pattern.sub(mask, line) for line in lines]
+        return lines
+    return masked_lines
+
+
+class CollapseRefreshing(object):
+    """Replaces all but the first of a run of terraform's "Refreshing
+    state..." lines with a count of those left out."""
+
+    MARKER = b'Refreshing state...'
+
+    def __init__(self):
+        self.in_run = False
+        self.collapsed = 0
+
+    def __call__(self, lines):
+        marker = self.MARKER
+        for line in lines:
+            if marker in line:
+                if self.in_run:
+                    self.collapsed += 1
+                    continue
+                self.in_run = True
+            elif self.in_run:
+                yield from self.finish()
+            yield line
+
+    def finish(self):
+        collapsed, self.collapsed, self.in_run = self.collapsed, 0, False
+        if collapsed:
+            return [
+                '({} more "Refreshing state..." lines)\n'.format(collapsed)
+                .encode()
+            ]
+        return []
+
+
+# Values shorter than this are too likely to appear by chance to be masked.
+MIN_SECRET_LENGTH = 4
+
+
+def _timestamp_stage(environment_variables, argv):
+    return lambda: timestamp_lines
+
+
+def _tag_stage(environment_variables, argv):
+    tag = get_component_name(argv)
+    local_argv = remove_argv_options(argv)
+    if local_argv[0] == 'deploy' and len(local_argv) > 1:
+        tag = '{}/{}'.format(tag, local_argv[1])
+    stage = prefix_lines('[{}] '.format(tag).encode('utf-8'))
+    return lambda: stage
 
-def fetch_account_scheme(s3_resource, bucket, key, team, component):
-    account_scheme = download_json_from_s3(s3_resource, bucket, key)
-    upgrade = account_scheme.get('upgrade-account-scheme')
 
-    def whitelisted(team, component):
-        team_whitelist = upgrade.get('team-whitelist', [])
-        component_whitelist = upgrade.get('component-whitelist', [])
-        logger.debug(
-            'Checking whitelists: {}, {}'.format(
-                team_whitelist, component_whitelist,
-            )
+def _mask_stage(environment_variables, argv):
+    secrets = {
+        value.encode('utf-8') for value in environment_variables.values()
+        if isinstance(value, str) and len(value) >= MIN_SECRET_LENGTH
+    }
+    stage = mask_lines(secrets)
+    return lambda: stage
+
+
+def _collapse_stage(environment_variables, argv):
+    return CollapseRefreshing
+
+
+LOG_STAGES = {
+    'timestamps': _timestamp_stage,
+    'tags': _tag_stage,
+    'mask-secrets': _mask_stage,
+    'collapse-refreshing': _collapse_stage,
+}
+
+
+def get_log_stages(config, environment_variables, argv):
+    """Return factories for the log stages listed under log-stages in
+    cdflow.yml, in the order they are applied."""
+    names = config.get('log-stages') or []
+    if not isinstance(names, list) or not set(names) <= set(LOG_STAGES):
+        raise LogStageError()
+    return [LOG_STAGES[name](environment_variables, argv) for name in names]
+
+
+class TeeWriter(object):
+    """Passes writes on to writer, copying them to each of copies, such as a
+    LogArchive or TailBuffer."""
+
+    def __init__(self, writer, copies):
+        self.writer = writer
+        self.copies = copies
+
+    def write(self, data):
+        self.writelines((data,))
+
+    def writelines(self, chunks):
+        chunks = list(chunks)
+        for target in self.copies:
+            target.writelines(chunks)
+        self.writer.writelines(chunks)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+# The first line matching each of these marks the start of a phase of a
+# terraform run.
+LOG_PHASES = (
+    ('init', re.compile(rb'Initializing (the backend|provider plugins)')),
+    ('refresh', re.compile(rb'Refreshing state\.\.\.')),
+    ('plan', re.compile(
+        rb'Terraform will perform the following actions|No changes\.'
+    )),
+    ('apply', re.compile(rb': (Creating|Modifying|Destroying)\.\.\.')),
+)
+
+
+class LogArchive(object):
+    """Archives a run's output as a gzip file of independently compressed
+    blocks, so it can be read from any block without decompressing the ones
+    before it.
+
+    Blocks end at a line break where possible, and are compressed in
+    parallel on other threads and written in order. On close, an index is
+    written alongside the archive recording where each block starts, in the
+    output and in the file, where each phase in LOG_PHASES was first seen,
+    and the run's exit status. The file is only created once there is
+    output, or the run has finished.
+    """
+
+    def __init__(self, path, argv, block_size=LOG_ARCHIVE_BLOCK_SIZE):
+        self.path = path
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.blocks = queue.Queue(maxsize=16)
+        self.compressors = None
+        self.writer = threading.Thread(
+            target=self._write_blocks, daemon=True,
         )
-        return team in team_whitelist or component in component_whitelist
+        self.file = None
+        self.size = 0
+        self.compressed_size = 0
+        self.index = {
+            'command': argv, 'started': time.time(), 'blocks': [],
+            'phases': {},
+        }
 
-    component_flag_passed = _get_component_name_from_cli_args(sys.argv)
+    def writelines(self, chunks):
+        for chunk in chunks:
+            self.buffer += chunk
+        if len(self.buffer) >= self.block_size:
+            end = self.buffer.rfind(b'\n') + 1 or len(self.buffer)
+            self._put(bytes(self.buffer[:end]))
+            del self.buffer[:end]
+
+    def close(self, exit_status=None):
+        self._put(bytes(self.buffer))
+        self.blocks.put(None)
+        self.writer.join()
+        self.compressors.shutdown()
+        self.index.update({
+            'finished': time.time(), 'exit_status': exit_status,
+            'size': self.size,
+        })
+        try:
+            self._open().close()
+            with open(self.path + '.idx.tmp', 'w') as index_file:
+                json.dump(self.index, index_file)
+            os.rename(self.path + '.idx.tmp', self.path + '.idx')
+        except OSError as e:
+            logger.debug('Could not index {}: {}'.format(self.path, e))
+
+    def _put(self, block):
+        if self.compressors is None:
+            self.compressors = ThreadPoolExecutor(LOG_ARCHIVE_COMPRESSORS)
+            self.writer.start()
+        if block:
+            self.blocks.put((block, self.compressors.submit(
+                gzip.compress, block, LOG_ARCHIVE_LEVEL, mtime=0,
+            )))
+
+    def _open(self):
+        if self.file is None:
+            # Output can include anything the container printed.
+            self.file = os.fdopen(os.open(
+                self.path, os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o600,
+            ), 'wb')
+        return self.file
+
+    def _write_blocks(self):
+        for block, compressed in iter(self.blocks.get, None):
+            try:
+                self._write_block(block, compressed.result())
+            except OSError as e:
+                logger.debug('Could not archive to {}: {}'.format(
+                    self.path, e,
+                ))
+
+    def _write_block(self, block, data):
+        self._find_phases(block)
+        self._open().write(data)
+        self.index['blocks'].append([self.size, self.compressed_size])
+        self.size += len(block)
+        self.compressed_size += len(data)
+
+    def _find_phases(self, block):
+        for name, pattern in LOG_PHASES:
+            match = None
+            if name not in self.index['phases']:
+                match = pattern.search(block)
+            if match:
+                line_start = block.rfind(b'\n', 0, match.start()) + 1
+                self.index['phases'][name] = self.size + line_start
+
+
+def open_log_archive(cache, argv, environment):
+    """Return a LogArchive for this run in the cache, after removing
+    archives beyond the retention limit, or None if there is no cache or
+    archiving is turned off."""
+    retention = int(environment.get(
+        LOG_RETENTION_VARIABLE, DEFAULT_LOG_RETENTION,
+    ))
+    if cache is None or retention <= 0:
+        return None
+    try:
+        os.makedirs(cache.log_dir, mode=0o700, exist_ok=True)
+        rotate_log_archives(cache.log_dir, retention - 1, cache.max_age)
+    except OSError as e:
+        logger.debug('Not archiving output: {}'.format(e))
+        return None
+    name = '{}-{}.log.gz'.format(
+        time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()), os.getpid(),
+    )
+    return LogArchive(os.path.join(cache.log_dir, name), argv)
+
+
+def list_log_archives(log_dir):
+    """Return the paths of archived runs, newest first."""
+    with _suppress(FileNotFoundError):
+        return [
+            os.path.join(log_dir, name)
+            for name in sorted(os.listdir(log_dir), reverse=True)
+            if name.endswith('.log.gz')
+        ]
+    return []
+
+
+def rotate_log_archives(log_dir, keep, max_age):
+    """Remove all but the newest keep archives, and any not written to
+    within max_age seconds."""
+    cutoff = time.time() - max_age
+    for number, path in enumerate(list_log_archives(log_dir)):
+        if number < keep and os.stat(path).st_mtime >= cutoff:
+            continue
+        for removed in (path, path + '.idx'):
+            with _suppress(FileNotFoundError):
+                os.remove(removed)
+
+
+def read_log_index(path):
+    """Return the index of an archive, or one describing it as a single
+    block if the run has not finished."""
+    try:
+        with open(path + '.idx') as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return {'blocks': [[0, 0]], 'phases': {}}
+
+
+def copy_log_archive(path, index, output, offset=0):
+    """Write an archive's output from offset on, decompressing only the
+    blocks from the one containing offset."""
+    blocks = index['blocks'] or [[0, 0]]
+    block = blocks[max(bisect_right([b[0] for b in blocks], offset) - 1, 0)]
+    with open(path, 'rb') as archive_file:
+        archive_file.seek(block[1])
+        with gzip.GzipFile(fileobj=archive_file) as archive:
+            archive.seek(offset - block[0])
+            shutil.copyfileobj(archive, output)
+
+
+class ContainerReaper(object):
+    """Removes finished containers on a daemon thread as they are put, so
+    neither the rest of the run nor the exit of the wrapper waits for it.
+
+    At most max_pending containers wait their turn; putting another blocks
+    until there is room.
+    """
+
+    def __init__(self, max_pending=REAPER_QUEUE_SIZE):
+        self.pending = queue.Queue(max_pending)
+        threading.Thread(target=self._remove_forever, daemon=True).start()
+
+    def put(self, container):
+        self.pending.put(container)
+
+    def _remove_forever(self):
+        from docker.errors import DockerException
+
+        while True:
+            container = self.pending.get()
+            try:
+                container.remove(force=True)
+            except DockerException as e:
+                logger.debug('Could not remove container {}: {}'.format(
+                    container.id, e,
+                ))
+            finally:
+                self.pending.task_done()
+
+    def drain(self, timeout=REAPER_EXIT_TIMEOUT):
+        """Wait up to timeout seconds for every container put so far to be
+        removed, returning whether they all were."""
+        deadline = time.monotonic() + timeout
+        with self.pending.all_tasks_done:
+            while self.pending.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.pending.all_tasks_done.wait(remaining)
+        return True
+
+
+# Keyed by process id, so a forked daemon worker starts its own thread.
+_reapers = {}
+
+
+def container_reaper(environment):
+    """Return this process's ContainerReaper when the environment asks for
+    finished containers to be removed in the background, or None."""
+    if environment.get(CONTAINER_CLEANUP_VARIABLE) != 'reaper':
+        return None
+    pid = os.getpid()
+    if pid not in _reapers:
+        _reapers[pid] = ContainerReaper()
+        atexit.register(_reapers[pid].drain)
+    return _reapers[pid]
+
+
+# Finished containers left to be removed when each process exits, by process
+# id, so a forked daemon worker does not inherit its parent's.
+_exit_removals = {}
+
+
+def _remove_at_exit(container):
+    atexit.register(_remove_container, container)
+    _exit_removals.setdefault(os.getpid(), []).append(container)
 
-    if not component_flag_passed and upgrade and whitelisted(team, component):
-        bucket, key = parse_s3_url(upgrade['new-url'])
-        logger.debug(
-            'Account scheme forwarded, fetching from {}/{}'.format(
-                bucket, key,
-            )
-        )
-        account_scheme = download_json_from_s3(s3_resource, bucket, key)
 
-    return account_scheme
+def clean_up_daemon_worker():
+    """Remove the containers this process has finished with.
 
+    Forked daemon workers leave with os._exit, which skips atexit, so they
+    call this once their request is done instead.
+    """
+    from docker.errors import DockerException
 
-def get_deploy_image_id(argv, config):
-    component_name = get_component_name(argv)
-    version = get_version(argv)
-    return find_image_id_from_release(
-        component_name, version, config
+    reaper = _reapers.get(os.getpid())
+    if reaper is not None:
+        reaper.drain()
+    for container in _exit_removals.pop(os.getpid(), []):
+        try:
+            _remove_container(container)
+        except DockerException as e:
+            logger.debug('Could not remove container {}: {}'.format(
+                container.id, e,
+            ))
+
+
+def orphaned_containers(docker_client, host=None, pooled=()):
+    """Return the containers started by cdflow on this host whose wrapper
+    process has gone, other than those in the warm pool, whose ids are
+    given by pooled.
+
+    The list is sparse, so the engine is not asked to inspect each of them,
+    and filtered by label, so other containers are never listed at all.
+    """
+    host = host or socket.gethostname()
+    containers = docker_client.containers.list(
+        all=True, sparse=True, filters={
+            'label': [PID_LABEL, '{}={}'.format(HOST_LABEL, host)],
+        },
     )
+    return [
+        container for container in containers
+        if _is_orphaned(
+            container.id, container.attrs.get('Labels') or {}, pooled,
+        )
+    ]
 
 
-def main(argv):
-    toggle_verbose_logging(argv)
-    docker_client = docker.from_env()
-    environment_variables = get_environment()
-    config = get_manifest_data()
-    image_id = get_image_id(os.environ, config)
-    command = _command(argv)
-
-    kwargs = {
-        'docker_client': docker_client,
-        'image_id': image_id,
-        'command': argv,
-        'project_root': os.getcwd(),
-        'environment_variables': environment_variables,
-    }
+def _is_orphaned(container_id, labels, pooled):
+    # Pooled containers outlive the process that started them on purpose,
+    # and are removed by the pool's own eviction, unless the pool has lost
+    # track of them, as when the cache is reset or cannot be opened.
+    if POOL_LABEL in labels and container_id in pooled:
+        return False
+    return _owner_gone(labels)
 
+
+def _owner_gone(labels):
     try:
-        if command == 'release':
-            kwargs['platform_config_paths'] = get_platform_config_paths(argv)
-            environment_variables['CDFLOW_IMAGE_DIGEST'] = \
-                get_image_sha(docker_client, image_id)
-        elif command == 'deploy':
-            kwargs['image_id'] = get_deploy_image_id(argv, config)
-    except CDFlowWrapperException as e:
-        print(str(e), file=sys.stderr)
-        return 1
+        pid, started = int(labels[PID_LABEL]), int(labels[STARTED_LABEL])
+    except (KeyError, ValueError):
+        return False
+    if not _process_exists(pid):
+        return True
+    # A process that started after the container did cannot have created it,
+    # so its pid has been reused.
+    process_started = _process_start_time(pid)
+    return process_started is not None and process_started > started + 1
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
 
-    exit_status, output = docker_run(**kwargs)
 
-    print(output, file=sys.stderr if exit_status else sys.stdout)
+def _process_start_time(pid):
+    """Return when process pid started, in seconds since the epoch, or None
+    where /proc does not say."""
+    try:
+        with open('/proc/{}/stat'.format(pid), 'rb') as stat_file:
+            stat = stat_file.read()
+        with open('/proc/stat', 'rb') as system_stat_file:
+            boot_time = next(
+                int(line.split()[1]) for line in system_stat_file
+                if line.startswith(b'btime ')
+            )
+    except (OSError, StopIteration):
+        return None
+    # The command name before the remaining fields may contain spaces.
+    ticks = int(stat.rsplit(b')', 1)[1].split()[19])
+    return boot_time + ticks / os.sysconf('SC_CLK_TCK')
+
+
+def run_gc_command(argv, environment):
+    local_argv = remove_argv_options(argv)
+    if local_argv not in (['gc'], ['gc', '--dry-run']):
+        raise GcUsageError()
+    dry_run = '--dry-run' in local_argv
+    docker_client = get_docker_client()
+    if not dry_run:
+        _evict_warm_pool(docker_client, environment)
+    for container in orphaned_containers(
+        docker_client, pooled=_pooled_container_ids(environment),
+    ):
+        labels = container.attrs['Labels']
+        print('{} {} {:<20} {}'.format(
+            'Would remove' if dry_run else 'Removing',
+            container.id[:12],
+            labels.get(COMPONENT_LABEL) or '-',
+            time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(
+                int(labels[STARTED_LABEL]),
+            )),
+        ))
+        if not dry_run:
+            _remove_orphan(container)
+    return 0
+
+
+def _pooled_container_ids(environment):
+    cache = open_cache(environment)
+    if cache is None:
+        return set()
+    return {row[0] for row in cache.get_warm_containers()}
+
+
+def _remove_orphan(container):
+    from docker.errors import DockerException
+
+    try:
+        container.remove(force=True)
+    except DockerException as e:
+        logger.debug('Could not remove container {}: {}'.format(
+            container.id, e,
+        ))
+
+
+def warm_pool_key(image_id, project_root, volumes):
+    """Return the pool a container belongs to: commands only share a
+    container started from the same image, given by its ID rather than a
+    tag, with the same mounts."""
+    return hashlib.sha256(json.dumps(
+        [image_id, project_root, volumes], sort_keys=True,
+    ).encode('utf-8')).hexdigest()
+
+
+class WarmPool(object):
+    """Containers kept running between commands, which are run in them with
+    exec rather than each in a container of its own.
+
+    A container is only shared by commands with the same image, project and
+    mounts, and used by one at a time. Which are in use and when each was
+    last used is kept in the cache, so every cdflow process on the host
+    shares the pool. The environment is passed to each exec, never stored
+    with the container.
+    """
+
+    def __init__(self, cache, max_size, idle_timeout=DEFAULT_WARM_POOL_IDLE):
+        self.cache = cache
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+
+    def run(
+        self, docker_client, image_id, command, project_root,
+        environment_variables, volumes, labels, log_stages=(),
+        log_archive=None,
+    ):
+        # A tag such as latest may have been pulled again since a container
+        # was started from it, so the pool is keyed on the image it names now.
+        image = docker_client.api.inspect_image(image_id)
+        key = warm_pool_key(image['Id'], project_root, volumes)
+        container_id, exec_id = None, None
+        claimed = self.cache.claim_warm_container(key, os.getpid())
+        if claimed:
+            container_id, exec_id = self._reuse(
+                docker_client, claimed, command, environment_variables,
+                project_root,
+            )
+        if exec_id is None:
+            container_id, entrypoint = self._start_container(
+                docker_client, image, key, project_root, volumes, labels,
+            )
+            exec_id = _create_exec(
+                docker_client.api, container_id, entrypoint + command,
+                environment_variables, project_root,
+            )
+        try:
+            result = _exec_until_finished(
+                docker_client.api, exec_id, log_stages, log_archive,
+            )
+        except BaseException:
+            # The command may still be running in it, so it is not reused.
+            self._discard(docker_client, container_id, os.getpid())
+            raise
+        self.cache.release_warm_container(container_id)
+        self._finished_with(docker_client, container_id)
+        return result
+
+    def _finished_with(self, docker_client, container_id):
+        self.evict(docker_client)
+
+    def _reuse(
+        self, docker_client, claimed, command, environment_variables,
+        project_root,
+    ):
+        from docker.errors import APIError
+
+        container_id, entrypoint = claimed
+        try:
+            return container_id, _create_exec(
+                docker_client.api, container_id, entrypoint + command,
+                environment_variables, project_root,
+            )
+        except APIError as e:
+            logger.debug('Warm container {} unusable: {}'.format(
+                container_id, e,
+            ))
+            self._discard(docker_client, container_id, os.getpid())
+            return None, None
+
+    def _start_container(
+        self, docker_client, image, key, project_root, volumes, labels,
+    ):
+        entrypoint = image['Config'].get('Entrypoint') or []
+        container = docker_client.containers.create(
+            image['Id'],
+            entrypoint=WARM_CONTAINER_ENTRYPOINT,
+            volumes=volumes,
+            working_dir=project_root,
+            labels=dict(labels, **{POOL_LABEL: key}),
+        )
+        self.cache.put_warm_container(
+            container.id, key, entrypoint, os.getpid(),
+        )
+        container.start()
+        return container.id, entrypoint
+
+    def evict(self, docker_client):
+        """Remove containers idle for longer than the idle timeout, the
+        least recently used beyond the size limit, and any whose command's
+        process has gone."""
+        for container_id, busy_pid in self._evictable(
+            self.cache.get_warm_containers(),
+        ):
+            self._discard(docker_client, container_id, busy_pid)
+
+    def _evictable(self, rows):
+        cutoff = time.time() - self.idle_timeout
+        kept = 0
+        for container_id, busy_pid, last_used in rows:
+            if busy_pid is not None:
+                if not _process_exists(busy_pid):
+                    yield container_id, busy_pid
+            elif kept < self.max_size and last_used >= cutoff:
+                kept += 1
+            else:
+                yield container_id, None
+
+    def _discard(self, docker_client, container_id, busy_pid):
+        from docker.errors import DockerException
+
+        if not self.cache.forget_warm_container(container_id, busy_pid):
+            return
+        try:
+            docker_client.api.remove_container(container_id, force=True)
+        except DockerException as e:
+            logger.debug('Could not remove container {}: {}'.format(
+                container_id, e,
+            ))
+
+
+class SessionPool(WarmPool):
+    """Keeps one container for the plans of a watch session while the warm
+    pool is turned off.
+
+    Unlike the pool it never evicts the containers of other processes: it
+    only removes the one it last ran a plan in, when a plan needs another
+    (say for a new image) or when the session closes it.
+    """
+
+    def __init__(self, cache):
+        super(SessionPool, self).__init__(cache, 1)
+        self.container_id = None
+
+    def _finished_with(self, docker_client, container_id):
+        if self.container_id not in (None, container_id):
+            self.close(docker_client)
+        self.container_id = container_id
+
+    def close(self, docker_client):
+        if self.container_id is not None:
+            # Left alone if another process has since claimed it.
+            self._discard(docker_client, self.container_id, None)
+            self.container_id = None
+
+
+def open_warm_pool(cache, environment):
+    """Return the WarmPool, or None if there is no cache or the pool is not
+    turned on."""
+    pool = _warm_pool(cache, environment)
+    return pool if pool is not None and pool.max_size > 0 else None
+
+
+def _warm_pool(cache, environment):
+    if cache is None:
+        return None
+    return WarmPool(
+        cache,
+        int(environment.get(WARM_POOL_VARIABLE, 0)),
+        int(environment.get(WARM_POOL_IDLE_VARIABLE, DEFAULT_WARM_POOL_IDLE)),
+    )
+
+
+def _evict_warm_pool(docker_client, environment):
+    # With the pool turned off its size is 0, so every idle container left
+    # in it is removed.
+    pool = _warm_pool(open_cache(environment), environment)
+    if pool is not None:
+        pool.evict(docker_client)
+
+
+def _create_exec(api, container_id, command, environment, workdir):
+    return api.exec_create(
+        container_id, command, environment=environment, workdir=workdir,
+    )['Id']
+
+
+def _exec_until_finished(api, exec_id, log_stages, log_archive):
+    sock = api.exec_start(exec_id, socket=True)
+    exit_status = None
+    try:
+        tail = _relay_output(sock, log_stages, log_archive)
+        exit_status = _exec_exit_status(api, exec_id)
+    finally:
+        _close_log_archive(log_archive, exit_status)
+    output = ''
+    if exit_status != 0:
+        output = _failure_summary(exit_status, tail.lines(LOG_TAIL_LINES))
+    return exit_status, output
+
+
+def _exec_exit_status(api, exec_id):
+    deadline = time.monotonic() + EXEC_EXIT_TIMEOUT
+    state = api.exec_inspect(exec_id)
+    while state['Running'] and time.monotonic() < deadline:
+        time.sleep(EXEC_EXIT_POLL_INTERVAL)
+        state = api.exec_inspect(exec_id)
+    return 1 if state['ExitCode'] is None else state['ExitCode']
+
+
+def _ignored_path(name):
+    # Hidden files and directories, such as .git and the .terraform
+    # directory terraform writes to while planning, never trigger a plan.
+    return name.startswith('.')
+
+
+def _walk_project(root):
+    for directory, subdirectories, names in os.walk(root):
+        subdirectories[:] = [
+            name for name in subdirectories if not _ignored_path(name)
+        ]
+        yield directory, [name for name in names if not _ignored_path(name)]
+
+
+class InotifyWatcher(object):
+    """Reports files changed under root, using inotify.
+
+    Every directory under root is watched, including those created later.
+    Changes are returned as paths relative to root; if the kernel's queue of
+    events overflowed, root itself is returned.
+    """
+
+    def __init__(self, root):
+        import ctypes
+        import ctypes.util
+
+        self.root = root
+        self.directories = {}
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._watch_tree(root)
+
+    def _watch_tree(self, top):
+        for directory, _ in _walk_project(top):
+            descriptor = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(directory), WATCH_EVENTS,
+            )
+            if descriptor >= 0:
+                self.directories[descriptor] = directory
+
+    def changes(self, timeout=None):
+        """Return the paths changed, waiting up to timeout seconds, or
+        forever if it is None, for the first."""
+        import select
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            descriptor, mask, _, length = INOTIFY_EVENT.unpack_from(
+                data, offset,
+            )
+            offset += INOTIFY_EVENT.size + length
+            name = os.fsdecode(data[offset - length:offset].rstrip(b'\0'))
+            changed.add(self._changed_path(descriptor, mask, name))
+        changed.discard(None)
+        return changed
+
+    def _changed_path(self, descriptor, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            return os.curdir
+        if mask & IN_IGNORED or _ignored_path(name):
+            return None
+        path = os.path.join(self.directories[descriptor], name)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self._watch_tree(path)
+        return os.path.relpath(path, self.root)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Reports files changed under root by comparing the modification time
+    and size of each, for systems without inotify."""
+
+    def __init__(self, root, interval=WATCH_POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self.files = self._scan()
+
+    def _scan(self):
+        files = {}
+        for directory, names in _walk_project(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                with _suppress(OSError):
+                    stat = os.stat(path)
+                    files[os.path.relpath(path, self.root)] = (
+                        stat.st_mtime_ns, stat.st_size,
+                    )
+        return files
+
+    def changes(self, timeout=None):
+        """Return the paths changed, waiting up to timeout seconds, or
+        forever if it is None, for the first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            files = self._scan()
+            changed = {
+                path for path in set(files) | set(self.files)
+                if files.get(path) != self.files.get(path)
+            }
+            self.files = files
+            remaining = self.interval if deadline is None else \
+                deadline - time.monotonic()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+def watch_project(root):
+    """Return an InotifyWatcher for root, or a PollingWatcher where inotify
+    is not available."""
+    try:
+        return InotifyWatcher(root)
+    except (AttributeError, OSError) as e:
+        logger.debug('Polling for changes, inotify unavailable: {}'.format(e))
+        return PollingWatcher(root)
+
+
+def wait_for_changes(watcher, debounce=WATCH_DEBOUNCE):
+    """Return the paths changed once a change has been followed by
+    debounce seconds without another."""
+    changed = set()
+    while not changed:
+        changed = watcher.changes()
+    more = watcher.changes(debounce)
+    while more:
+        changed |= more
+        more = watcher.changes(debounce)
+    return changed
+
+
+def _remove_container(container):
+    from requests.exceptions import ReadTimeout
+
+    try:
+        container.stop()
+    # An HTTP timeout is thrown until this issue is addressed, then we can
+    # stop catching any exception:
+    # https://github.com/docker/docker-py/issues/1374
+    except ReadTimeout:
+        pass
+    container.remove()
+
+
+# Credentials resolved by each process, by process id, so that a forked
+# daemon worker never uses those of the daemon or another client.
+_aws_credentials = {}
+
+
+def _aws_credentials_key(session):
+    role_arn = session.get_scoped_config().get('role_arn')
+    return (
+        session.get_config_variable('profile') or 'default',
+        role_arn or os.environ.get('AWS_ROLE_ARN') or '',
+        _aws_credentials_source(session),
+    )
+
+
+def _aws_credentials_source(session):
+    # Changes when another config or credentials file is used, or either is
+    # edited, for example when keys are rotated.
+    source = [os.environ.get(name) for name in (
+        AWS_CREDENTIALS_SOURCE_VARIABLES
+    )]
+    for variable in ('config_file', 'credentials_file'):
+        path = os.path.expanduser(session.get_config_variable(variable))
+        try:
+            stat = os.stat(path)
+            source.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            source.append((path, None, None))
+    return hashlib.sha256(json.dumps(source).encode('utf-8')).hexdigest()
+
+
+def _load_aws_credentials(session):
+    credentials = session.get_credentials()
+    if credentials is None:
+        return None
+    frozen = credentials.get_frozen_credentials()
+    # botocore only exposes the expiry of refreshable credentials privately.
+    expiry = getattr(credentials, '_expiry_time', None)
+    return (
+        frozen.access_key, frozen.secret_key, frozen.token,
+        expiry.timestamp() if expiry else None,
+    )
+
+
+def _find_aws_credentials(key, cache, min_expiry):
+    credentials = _aws_credentials.get((os.getpid(),) + key)
+    if credentials and (credentials[3] or min_expiry) >= min_expiry:
+        return credentials
+    return cache.get_aws_credentials(*key, min_expiry) if cache else None
+
+
+def _store_aws_credentials(key, credentials, cache):
+    _aws_credentials[(os.getpid(),) + key] = credentials
+    if cache and credentials and credentials[3]:
+        cache.put_aws_credentials(*key, credentials)
+
+
+def resolve_aws_credentials(cache=None):
+    """Return the current (access key, secret key, token), if any.
+
+    Temporary credentials, such as those from assuming a role, are cached by
+    profile, role and where they came from until they are about to expire,
+    so the STS calls behind them are not repeated on every run. Credentials
+    given directly in the environment are left alone, and if they cannot be
+    resolved those in the environment are passed on as they are.
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    if 'AWS_ACCESS_KEY_ID' in os.environ:
+        return None
+    try:
+        return _resolve_aws_credentials(cache)
+    except (BotoCoreError, ClientError) as e:
+        logger.debug('Could not resolve AWS credentials: {}'.format(e))
+        return None
+
+
+def _resolve_aws_credentials(cache):
+    import botocore.session
+
+    session = botocore.session.Session()
+    key = _aws_credentials_key(session)
+    min_expiry = time.time() + float(os.environ.get(
+        AWS_CREDENTIALS_MIN_LIFETIME_VARIABLE,
+        DEFAULT_AWS_CREDENTIALS_MIN_LIFETIME,
+    ))
+    credentials = _find_aws_credentials(key, cache, min_expiry)
+    if credentials is None:
+        logger.debug('Resolving AWS credentials for profile {}'.format(
+            key[0],
+        ))
+        credentials = _load_aws_credentials(session)
+        _store_aws_credentials(key, credentials, cache)
+    return credentials and credentials[:3]
+
+
+def container_aws_credentials(argv, cache):
+    """Return the credentials to pass to the container, resolving them only
+    for commands that need them in the wrapper, unless asked to."""
+    if _command(argv) in AWS_CREDENTIALS_COMMANDS or \
+            os.environ.get(AWS_CREDENTIALS_VARIABLE) == 'resolve':
+        return resolve_aws_credentials(cache)
+    return None
+
+
+def add_aws_credentials(environment_variables, credentials):
+    if credentials is None:
+        return
+    (
+        environment_variables['AWS_ACCESS_KEY_ID'],
+        environment_variables['AWS_SECRET_ACCESS_KEY'],
+        environment_variables['AWS_SESSION_TOKEN'],
+    ) = credentials
+
+
+def get_environment():
+    return {
+        'AWS_ACCESS_KEY_ID': os.environ.get('AWS_ACCESS_KEY_ID'),
+        'AWS_SECRET_ACCESS_KEY': os.environ.get('AWS_SECRET_ACCESS_KEY'),
+        'AWS_SESSION_TOKEN': os.environ.get('AWS_SESSION_TOKEN'),
+        'FASTLY_API_KEY': os.environ.get('FASTLY_API_KEY'),
+        'GITHUB_TOKEN': os.environ.get('GITHUB_TOKEN'),
+        'LOGENTRIES_ACCOUNT_KEY': os.environ.get('LOGENTRIES_ACCOUNT_KEY'),
+        'DATADOG_APP_KEY': os.environ.get('DATADOG_APP_KEY'),
+        'DATADOG_API_KEY': os.environ.get('DATADOG_API_KEY'),
+    }
+
+
+def _command(argv):
+    try:
+        return argv[0]
+    except IndexError:
+        pass
+
+
+# Manifests parsed by this process, by (path, mtime, size).
+_manifests = {}
+
+
+def load_yaml(text):
+    """Parse YAML safely, with libyaml when PyYAML was built with it."""
+    return yaml.load(
+        text, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader),
+    )
+
+
+def _manifest_key(path):
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+def _load_manifest(key, cache):
+    cached = cache.get_manifest(*key) if cache else None
+    if cached is not None:
+        return marshal.loads(cached)
+    with open(MANIFEST_PATH) as config_file:
+        manifest = load_yaml(config_file.read())
+    if cache:
+        # Values marshal cannot store, such as dates, are parsed every time.
+        with _suppress(ValueError):
+            cache.put_manifest(*key, marshal.dumps(manifest))
+    return manifest
+
+
+def get_manifest_data(cache=None):
+    """Return the parsed manifest, reusing an earlier parse of the same
+    version of the file. The result is shared, so must not be modified."""
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    key = _manifest_key(MANIFEST_PATH)
+    if key not in _manifests:
+        _manifests[key] = _load_manifest(key, cache)
+    return _manifests[key]
+
+
+def get_image_id(environment, config):
+    if 'CDFLOW_IMAGE_ID' in environment:
+        return environment['CDFLOW_IMAGE_ID']
+
+    if 'terraform-version' in config:
+        return "{}:terraform{}".format(
+            CDFLOW_IMAGE_NAME,
+            config['terraform-version']
+        )
+
+    return CDFLOW_IMAGE_ID
+
+
+def fetch_config_account_scheme(s3_resource, config, component_name, cache):
+    bucket, key = parse_s3_url(config['account-scheme-url'])
+    return fetch_account_scheme(
+        s3_resource, bucket, key, config['team'], component_name, cache,
+    )
+
+
+def _release_team_name(account_scheme, config):
+    if not account_scheme.classic_metadata_handling:
+        return config['team']
+
+
+def fetch_release_image_id(
+    s3_resource, account_scheme, config, component_name, version, cache,
+):
+    release_metadata = fetch_release_metadata(
+        s3_resource, account_scheme.release_bucket, component_name, version,
+        _release_team_name(account_scheme, config), cache,
+    )
+    return release_metadata['cdflow_image_digest']
+
+
+def _download_part(s3_client, bucket, key, directory):
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(
+        dir=directory, suffix='.part', delete=False,
+    ) as download:
+        try:
+            response = s3_client.get_object(Bucket=bucket, Key=key)
+            for chunk in response['Body'].iter_chunks(1024 * 1024):
+                digest.update(chunk)
+                download.write(chunk)
+                size += len(chunk)
+        except BaseException:
+            os.remove(download.name)
+            raise
+    os.chmod(download.name, 0o444)
+    return download.name, digest.hexdigest(), size
+
+
+def prefetch_release_artifact(s3_resource, bucket, key, cache):
+    """Return the path of the release zip in the cache, downloading it
+    first if needed. Zips are stored by content, so releases with the same
+    zip share one file."""
+    path = cache.get_release_artifact(bucket, key)
+    if path:
+        logger.debug('Using cached release {}'.format(path))
+        return path
+    os.makedirs(cache.artifact_dir, mode=0o700, exist_ok=True)
+    s3_client = s3_resource.meta.client
+    size = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+    if not _fits_in_cache(cache, bucket, key, size):
+        return None
+    logger.debug('Downloading release {}/{}'.format(bucket, key))
+    part, digest, size = _download_part(
+        s3_client, bucket, key, cache.artifact_dir,
+    )
+    if not _fits_in_cache(cache, bucket, key, size):
+        os.remove(part)
+        return None
+    cache.put_release_artifact(bucket, key, digest, size)
+    os.replace(part, os.path.join(
+        cache.artifact_dir, '{}.zip'.format(digest),
+    ))
+    return cache.get_release_artifact(bucket, key)
+
+
+def _fits_in_cache(cache, bucket, key, size):
+    # Recording a zip larger than the whole cache would evict everything
+    # else in it, and then the zip itself.
+    if size > cache.max_size:
+        logger.debug(
+            'Release {}/{} is larger than the cache, not prefetching'.format(
+                bucket, key,
+            )
+        )
+        return False
+    return True
+
+
+def fetch_release_artifact(
+    s3_resource, account_scheme, config, component_name, version, cache,
+):
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    if cache is None or RELEASE_PREFETCH_VARIABLE not in os.environ:
+        return None
+    key = get_release_key(
+        component_name, version, _release_team_name(account_scheme, config),
+    )
+    try:
+        return prefetch_release_artifact(
+            s3_resource, account_scheme.release_bucket, key, cache,
+        )
+    except (OSError, BotoCoreError, ClientError) as e:
+        # The cdflow container downloads the release itself as a fallback.
+        logger.debug('Could not prefetch release {}: {}'.format(key, e))
+        return None
+
+
+def find_image_id_from_release(component_name, version, config, cache=None):
+    s3_resource = get_s3_resource(cache)
+    account_scheme = fetch_config_account_scheme(
+        s3_resource, config, component_name, cache,
+    )
+    return fetch_release_image_id(
+        s3_resource, account_scheme, config, component_name, version, cache,
+    )
+
+
+def parse_s3_url(s3_url):
+    if not s3_url.startswith('s3://'):
+        raise InvalidURLError('URL must start with s3://')
+    bucket_and_key = s3_url[5:].split('/', 1)
+    if len(bucket_and_key) != 2:
+        raise InvalidURLError('URL must contain a bucket and a key')
+    return bucket_and_key
+
+
+def _get_s3_object(s3_client, bucket, key, etag=None):
+    from botocore.exceptions import ClientError
+
+    try:
+        return s3_client.get_object(
+            Bucket=bucket, Key=key, **({'IfNoneMatch': etag} if etag else {})
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('304', 'NotModified'):
+            raise
+
+
+class AccountScheme(Mapping):
+    """Account scheme compiled for the lookups the wrapper makes.
+
+    The upgrade whitelists become sets and the forwarding URL is parsed up
+    front. The compiled form round-trips through marshal, so a cached copy
+    loads without parsing any JSON. Only the sets are kept for the
+    whitelists, so they are left out of the mapping of a loaded copy.
+    """
+
+    FORMAT = 2
+
+    def __init__(self, data):
+        self._data = data
+        self.release_bucket = data.get('release-bucket')
+        self.classic_metadata_handling = bool(
+            data.get('classic-metadata-handling')
+        )
+        self.upgrade = _compile_upgrade(data.get('upgrade-account-scheme'))
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def forwards(self, team, component):
+        if self.upgrade is None:
+            return False
+        team_whitelist, component_whitelist, _, _ = self.upgrade
+        logger.debug('Checking whitelists: {} teams, {} components'.format(
+            len(team_whitelist), len(component_whitelist),
+        ))
+        return team in team_whitelist or component in component_whitelist
+
+    def upgrade_location(self):
+        _, _, new_url, location = self.upgrade
+        return location or parse_s3_url(new_url)
+
+    def to_bytes(self):
+        return marshal.dumps((
+            self.FORMAT, _without_whitelists(self._data), self.release_bucket,
+            self.classic_metadata_handling, self.upgrade,
+        ))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Load a copy made by to_bytes, raising ValueError if it was made
+        in another format."""
+        fields = marshal.loads(data)
+        if fields[0] != cls.FORMAT:
+            raise ValueError('Account scheme in format {}, not {}'.format(
+                fields[0], cls.FORMAT,
+            ))
+        account_scheme = cls.__new__(cls)
+        (
+            _, account_scheme._data, account_scheme.release_bucket,
+            account_scheme.classic_metadata_handling, account_scheme.upgrade,
+        ) = fields
+        return account_scheme
+
+
+def _without_whitelists(data):
+    upgrade = data.get('upgrade-account-scheme')
+    if not isinstance(upgrade, dict):
+        return data
+    return dict(data, **{'upgrade-account-scheme': {
+        key: value for key, value in upgrade.items()
+        if key not in ('team-whitelist', 'component-whitelist')
+    }})
+
+
+def _compile_upgrade(upgrade):
+    if not upgrade:
+        return None
+    new_url = upgrade.get('new-url')
+    try:
+        location = tuple(parse_s3_url(new_url))
+    except (InvalidURLError, AttributeError):
+        location = None
+    return (
+        frozenset(upgrade.get('team-whitelist', [])),
+        frozenset(upgrade.get('component-whitelist', [])),
+        new_url, location,
+    )
+
+
+def _read_account_scheme(s3_client, bucket, key, etag):
+    response = _get_s3_object(s3_client, bucket, key, etag)
+    if response is None:
+        return None, None
+    return response['ETag'], AccountScheme(json.load(response['Body']))
+
+
+def _load_cached_account_scheme(cache, bucket, key):
+    etag, cached = (cache and cache.get_object(bucket, key)) or (None, None)
+    if cached is None:
+        return None, None
+    try:
+        return etag, AccountScheme.from_bytes(cached)
+    except (ValueError, TypeError, EOFError, IndexError) as e:
+        logger.debug('Ignoring cached {}/{}: {}'.format(bucket, key, e))
+        return None, None
+
+
+def download_account_scheme(s3_resource, bucket, key, cache=None):
+    etag, cached = _load_cached_account_scheme(cache, bucket, key)
+    etag, account_scheme = read_from_s3(
+        lambda: _read_account_scheme(
+            s3_resource.meta.client, bucket, key, etag,
+        )
+    )
+    if account_scheme is None:
+        logger.debug('{}/{} not modified, using cached copy'.format(
+            bucket, key,
+        ))
+        return cached
+    if cache:
+        cache.put_object(bucket, key, account_scheme.to_bytes(), etag=etag)
+    return account_scheme
+
+
+def fetch_account_scheme(
+    s3_resource, bucket, key, team, component, cache=None,
+):
+    account_scheme = download_account_scheme(s3_resource, bucket, key, cache)
+    component_flag_passed = _get_component_name_from_cli_args(sys.argv)
+
+    if not component_flag_passed and account_scheme.forwards(team, component):
+        bucket, key = account_scheme.upgrade_location()
+        logger.debug(
+            'Account scheme forwarded, fetching from {}/{}'.format(
+                bucket, key,
+            )
+        )
+        account_scheme = download_account_scheme(
+            s3_resource, bucket, key, cache,
+        )
+
+    return account_scheme
+
+
+class _S3Requests(object):
+    """Event hooks on the shared S3 client.
+
+    Counts HTTP round trips for verbose output, and remembers the region of
+    each bucket so that later requests, and later invocations through the
+    cache, address it directly instead of being redirected.
+    """
+
+    def __init__(self):
+        self.round_trips = 0
+        self.regions = {}
+        self.latencies = deque(maxlen=S3_LATENCY_SAMPLES)
+        self.cache = None
+
+    def register(self, events):
+        events.register('before-parameter-build.s3', self.annotate_bucket)
+        events.register(
+            'before-endpoint-resolution.s3', self.use_known_region,
+        )
+        events.register('before-send.s3', self.count_round_trip)
+        events.register('needs-retry.s3', self.record_region)
+
+    def use_cache(self, cache):
+        if cache is self.cache:
+            return
+        self.cache = cache
+        self.regions.update(cache.get_bucket_regions())
+        self.latencies.extend(cache.get_s3_latencies())
+
+    def record_latency(self, seconds):
+        self.latencies.append(seconds)
+        if self.cache:
+            self.cache.put_s3_latency(seconds)
+
+    def hedge_delay(self):
+        if len(self.latencies) < MIN_S3_HEDGE_SAMPLES:
+            return DEFAULT_S3_HEDGE_DELAY
+        return latency_percentile(self.latencies, 95)
+
+    def annotate_bucket(self, params, context, **kwargs):
+        context['cdflow_bucket'] = params.get('Bucket')
+
+    def use_known_region(self, builtins, params, **kwargs):
+        region = self.regions.get(params.get('Bucket'))
+        if region:
+            builtins['AWS::Region'] = region
+
+    def count_round_trip(self, **kwargs):
+        self.round_trips += 1
+
+    def record_region(self, request_dict, response, **kwargs):
+        bucket = request_dict['context'].get('cdflow_bucket')
+        region = response and response[0].headers.get('x-amz-bucket-region')
+        if not bucket or not region or self.regions.get(bucket) == region:
+            return
+        logger.debug('Bucket {} is in {}'.format(bucket, region))
+        self.regions[bucket] = region
+        if self.cache:
+            self.cache.put_bucket_region(bucket, region)
+
+
+_s3_requests = _S3Requests()
+
+
+def latency_percentile(latencies, percentile):
+    ordered = sorted(latencies)
+    return ordered[max(int(len(ordered) * percentile / 100.0 + 0.5), 1) - 1]
+
+
+class _HedgedCall(object):
+    """Identical calls run in daemon threads, so a stuck one never holds
+    up the exit of the wrapper."""
+
+    def __init__(self, function, deadline):
+        self.function = function
+        self.deadline = deadline
+        self.outcomes = queue.Queue()
+        self.pending = 0
+
+    def start(self):
+        self.pending += 1
+        threading.Thread(target=self._call, daemon=True).start()
+
+    def _call(self):
+        try:
+            self.outcomes.put((self.function(), None))
+        except Exception as e:
+            self.outcomes.put((None, e))
+
+    def wait(self, timeout):
+        """Return whether a call finishes within timeout seconds."""
+        try:
+            outcome = self.outcomes.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        self.outcomes.put(outcome)
+        return True
+
+    def result(self):
+        error = None
+        while self.pending:
+            value, error = self._next_outcome()
+            if error is None:
+                return value
+        raise error
+
+    def _next_outcome(self):
+        try:
+            outcome = self.outcomes.get(
+                timeout=max(self.deadline - time.monotonic(), 0),
+            )
+        except queue.Empty:
+            raise S3DeadlineError()
+        self.pending -= 1
+        return outcome
+
+
+def hedged_call(function, hedge_delay, deadline):
+    """Return the result of the first call to function to succeed.
+
+    If the first call has not finished after hedge_delay seconds (None to
+    never hedge) an identical second call is started. S3DeadlineError is
+    raised if no call has succeeded within deadline seconds.
+    """
+    call = _HedgedCall(function, time.monotonic() + deadline)
+    call.start()
+    if hedge_delay is not None and not call.wait(hedge_delay):
+        logger.debug('No response from S3 after {:.0f} ms, hedging'.format(
+            hedge_delay * 1000,
+        ))
+        call.start()
+    return call.result()
+
+
+def read_from_s3(function):
+    """Read a small object or its metadata within the S3 deadline.
+
+    Requests are hedged when CDFLOW_S3_HEDGE is set, after the 95th
+    percentile of recent read latencies.
+    """
+    hedge_delay = None
+    if S3_HEDGE_VARIABLE in os.environ:
+        hedge_delay = _s3_requests.hedge_delay()
+    start = time.monotonic()
+    result = hedged_call(function, hedge_delay, float(os.environ.get(
+        S3_DEADLINE_VARIABLE, DEFAULT_S3_DEADLINE,
+    )))
+    _s3_requests.record_latency(time.monotonic() - start)
+    return result
+
+
+# Clients shared by everything in the process. The daemon creates them
+# ahead of time so that forked workers inherit them.
+_warm_clients = {}
+
+
+def _s3_client_environment():
+    return tuple(
+        os.environ.get(name)
+        for name in (
+            'AWS_PROFILE', 'AWS_DEFAULT_REGION', 'AWS_REGION',
+            S3_MAX_POOL_CONNECTIONS_VARIABLE, S3_MAX_ATTEMPTS_VARIABLE,
+            S3_TIMEOUT_VARIABLE,
+        )
+    )
+
+
+def _s3_config(environment):
+    from botocore.config import Config
+
+    timeout = float(environment.get(S3_TIMEOUT_VARIABLE, DEFAULT_S3_TIMEOUT))
+    return Config(
+        connect_timeout=timeout,
+        read_timeout=timeout,
+        max_pool_connections=int(environment.get(
+            S3_MAX_POOL_CONNECTIONS_VARIABLE, DEFAULT_S3_MAX_POOL_CONNECTIONS,
+        )),
+        tcp_keepalive=True,
+        retries={
+            'mode': 'adaptive',
+            'total_max_attempts': int(environment.get(
+                S3_MAX_ATTEMPTS_VARIABLE, DEFAULT_S3_MAX_ATTEMPTS,
+            )),
+        },
+    )
+
+
+def get_docker_client():
+    if 'docker' in _warm_clients:
+        return _warm_clients['docker']
+    return docker.from_env()
+
+
+def get_s3_resource(cache=None):
+    from boto3.session import Session
+
+    credentials = resolve_aws_credentials(cache)
+    environment = _s3_client_environment() + (credentials,)
+    warm_environment, s3_resource = _warm_clients.get('s3', (None, None))
+    if warm_environment != environment:
+        session = Session(*(credentials or ()))
+        s3_resource = session.resource('s3', config=_s3_config(os.environ))
+        _s3_requests.register(s3_resource.meta.client.meta.events)
+        _warm_clients['s3'] = (environment, s3_resource)
+    if cache:
+        _s3_requests.use_cache(cache)
+    return s3_resource
+
+
+def _warm_up_clients():
+    _warm_clients['docker'] = docker.from_env()
+    get_s3_resource()
+    # Imported now so that forked workers never pay for it.
+    yaml.safe_load
+    dockerpty.start
+
+
+def _reset_warm_connections():
+    # Pooled connections must not be shared with other forked workers.
+    if 'docker' in _warm_clients:
+        _warm_clients['docker'].api.close()
+
+
+_INT = struct.Struct('!i')
+
+
+def _receive_exactly(connection, size):
+    data = b''
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _receive_int(connection):
+    data = _receive_exactly(connection, _INT.size)
+    if data is not None:
+        return _INT.unpack(data)[0]
+
+
+def _send_request(connection, request, fds):
+    data = json.dumps(request).encode('utf-8')
+    connection.sendmsg(
+        [_INT.pack(len(data)), data],
+        [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array('i', fds))],
+    )
+
+
+def _receive_request(connection):
+    fds = array('i')
+    header, ancillary, _, _ = connection.recvmsg(
+        _INT.size, socket.CMSG_SPACE(len(STANDARD_FDS) * fds.itemsize),
+    )
+    for level, kind, data in ancillary:
+        if (level, kind) == (socket.SOL_SOCKET, socket.SCM_RIGHTS):
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    length = _INT.unpack(header)[0]
+    request = json.loads(_receive_exactly(connection, length).decode('utf-8'))
+    return request, list(fds)
+
+
+def _attach_standard_streams(fds):
+    for target_fd, fd in zip(STANDARD_FDS, fds):
+        os.dup2(fd, target_fd)
+        os.close(fd)
+    sys.stdin = open(0, closefd=False)
+    sys.stdout = open(1, 'w', buffering=1 if os.isatty(1) else -1,
+                      closefd=False)
+    sys.stderr = open(2, 'w', buffering=1, closefd=False)
+
+
+def _run_forwarded_request(request, fds):
+    _attach_standard_streams(fds)
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['environment'])
+    sys.argv = ['cdflow'] + request['argv']
+    _reset_warm_connections()
+    try:
+        return main(request['argv'])
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+class _DaemonRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        request, fds = _receive_request(self.request)
+        self.request.sendall(_INT.pack(os.getpid()))
+        exit_status = _run_forwarded_request(request, fds)
+        self.request.sendall(_INT.pack(exit_status))
+        clean_up_daemon_worker()
+
+
+class _ForkingUnixStreamServer(
+    socketserver.ForkingMixIn, socketserver.UnixStreamServer,
+):
+    pass
+
+
+def make_daemon_server(socket_path):
+    with _suppress(FileNotFoundError):
+        os.remove(socket_path)
+    previous_umask = os.umask(0o077)
+    try:
+        return _ForkingUnixStreamServer(socket_path, _DaemonRequestHandler)
+    finally:
+        os.umask(previous_umask)
+
+
+def run_daemon(argv, environment):
+    socket_path = environment.get(DAEMON_SOCKET_VARIABLE)
+    if not socket_path:
+        raise MissingDaemonSocketError()
+    server = make_daemon_server(socket_path)
+    _warm_up_clients()
+    logger.info('cdflow daemon listening on {}'.format(socket_path))
+    with _suppress(KeyboardInterrupt), server:
+        server.serve_forever()
+    os.remove(socket_path)
+    return 0
+
+
+def _wait_for_exit_status(connection):
+    worker_pid = _receive_int(connection)
+    while worker_pid is not None:
+        try:
+            exit_status = _receive_int(connection)
+            break
+        except KeyboardInterrupt:
+            os.kill(worker_pid, signal.SIGINT)
+    else:
+        exit_status = None
+    return 1 if exit_status is None else exit_status
+
+
+def forward_to_daemon(socket_path, argv, fds=STANDARD_FDS):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with connection:
+        try:
+            connection.connect(socket_path)
+        except OSError as e:
+            logger.debug('Not using cdflow daemon: {}'.format(e))
+            return None
+        _send_request(connection, {
+            'argv': argv,
+            'cwd': os.getcwd(),
+            'environment': dict(os.environ),
+        }, fds)
+        return _wait_for_exit_status(connection)
+
+
+def print_cache_stats(cache):
+    print('Cache: {}'.format(cache.path))
+    for name, entries, size in cache.stats():
+        print('{:<20} {:>8} entries {:>12} bytes'.format(name, entries, size))
+    latencies = cache.get_s3_latencies()
+    if latencies:
+        print('{:<20} p50 {:.0f} ms, p95 {:.0f} ms over {} reads'.format(
+            'S3 read latency', latency_percentile(latencies, 50) * 1000,
+            latency_percentile(latencies, 95) * 1000, len(latencies),
+        ))
+    return 0
+
+
+def prune_cache(cache):
+    print('Removed {} cache entries'.format(cache.prune()))
+    return 0
+
+
+CACHE_COMMANDS = {
+    'stats': print_cache_stats,
+    'prune': prune_cache,
+}
+
+
+def run_cache_command(argv, environment):
+    local_argv = remove_argv_options(argv)
+    if len(local_argv) != 2 or local_argv[1] not in CACHE_COMMANDS:
+        raise CacheUsageError()
+    cache = open_cache(environment)
+    if cache is None:
+        raise CacheUnavailableError()
+    return CACHE_COMMANDS[local_argv[1]](cache)
+
+
+def _parse_versions_argv(argv):
+    local_argv = remove_argv_options(argv)
+    if local_argv not in (['versions'], ['versions', '--fast']):
+        raise VersionsUsageError()
+    return get_component_name(argv), '--fast' in local_argv
+
+
+def print_release_versions(argv, environment):
+    component_name, fast = _parse_versions_argv(argv)
+    cache = open_cache(environment)
+    config = get_manifest_data(cache)
+    s3_resource = get_s3_resource(cache)
+    bucket, key = parse_s3_url(config['account-scheme-url'])
+    account_scheme = fetch_account_scheme(
+        s3_resource, bucket, key, config['team'], component_name, cache,
+    )
+    prefix = _get_release_storage_prefix(
+        component_name,
+        None if account_scheme.classic_metadata_handling else config['team'],
+    )
+    for _, version, digest, _ in index_release_versions(
+        s3_resource.meta.client, account_scheme.release_bucket, prefix,
+        cache, fast,
+    ):
+        print('{:<24} {}'.format(version, digest or '-'))
+    return 0
+
+
+# Commands handled by the wrapper itself rather than the cdflow container.
+def _pop_option(argv, option, default):
+    if option not in argv:
+        return default
+    index = argv.index(option)
+    try:
+        value = argv[index + 1]
+    except IndexError:
+        raise LogsUsageError()
+    del argv[index:index + 2]
+    return value
+
+
+def _parse_logs_argv(argv):
+    local_argv = remove_argv_options(argv)[1:]
+    phase = _pop_option(local_argv, '--phase', None)
+    offset = _pop_option(local_argv, '--offset', '0')
+    if len(local_argv) > 1 or not all(
+        value.isdigit() for value in local_argv + [offset]
+    ):
+        raise LogsUsageError()
+    run = int(local_argv[0]) if local_argv else None
+    return run, phase, int(offset)
+
+
+def print_log_archives(paths):
+    print('{:<4} {:<20} {:>4} {:>10}  {}'.format(
+        'RUN', 'STARTED (UTC)', 'EXIT', 'BYTES', 'COMMAND',
+    ))
+    for number, path in enumerate(paths, 1):
+        index = read_log_index(path)
+        print('{:<4} {:<20} {:>4} {:>10}  {}'.format(
+            number,
+            time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(
+                index.get('started', os.stat(path).st_mtime),
+            )),
+            '-' if index.get('exit_status') is None else index['exit_status'],
+            index.get('size', '-'),
+            ' '.join(index.get('command', [])),
+        ))
+    return 0
+
+
+def run_logs_command(argv, environment):
+    run, phase, offset = _parse_logs_argv(argv)
+    cache = open_cache(environment)
+    if cache is None:
+        raise CacheUnavailableError()
+    paths = list_log_archives(cache.log_dir)
+    if run is None:
+        return print_log_archives(paths)
+    if not 1 <= run <= len(paths):
+        raise LogNotFoundError()
+    index = read_log_index(paths[run - 1])
+    copy_log_archive(
+        paths[run - 1], index, binary_stream(sys.stdout),
+        _phase_offset(index, phase) if phase else offset,
+    )
+    return 0
+
+
+def _phase_offset(index, phase):
+    if phase not in index['phases']:
+        raise LogNotFoundError()
+    return index['phases'][phase]
+
+
+WRAPPER_COMMANDS = {
+    'cache': run_cache_command,
+    'daemon': run_daemon,
+    'gc': run_gc_command,
+    'logs': run_logs_command,
+    'versions': print_release_versions,
+}
+
+
+def run_wrapper_command(argv):
+    try:
+        return WRAPPER_COMMANDS[_command(argv)](argv, os.environ)
+    except CDFlowWrapperException as e:
+        print(str(e), file=sys.stderr)
+        return 1
+
+
+class _SerialExecutor(object):
+    """Runs each submitted function straight away, for timing comparisons
+    with the concurrent preflight."""
+
+    def __init__(self, max_workers=None):
+        pass
+
+    def submit(self, function, *args):
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class _StepSkipped(Exception):
+    pass
+
+
+class _StepCounter(object):
+    """Stands in for a Pipeline to count the steps that would be added."""
+
+    def __init__(self):
+        self.steps = 0
+
+    def add(self, name, function, *dependencies):
+        self.steps += 1
+
+
+class Pipeline(object):
+    """Runs steps concurrently, each once the steps it depends on are done.
+
+    A step is called with the results of its dependencies, which must have
+    been added before it. Once a step fails, those not yet started are
+    skipped, and the result of any step raises that failure. When each step
+    starts and finishes is recorded for verbose output.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.futures = {}
+        self.timings = {}
+        self.failure = None
+        self.start = time.monotonic()
+
+    def add(self, name, function, *dependencies):
+        self.futures[name] = self.executor.submit(
+            self._run, name, function,
+            [self.futures[dependency] for dependency in dependencies],
+        )
+
+    def _run(self, name, function, dependencies):
+        arguments = [future.result() for future in dependencies]
+        if self.failure is not None:
+            logger.debug('Skipped {}'.format(name))
+            raise _StepSkipped()
+        started = time.monotonic()
+        try:
+            return function(*arguments)
+        except Exception as e:
+            self.failure = self.failure or e
+            raise
+        finally:
+            self.timings[name] = (
+                started - self.start, time.monotonic() - self.start,
+            )
+
+    def result(self, name):
+        try:
+            return self.futures[name].result()
+        except _StepSkipped:
+            raise self.failure
+
+    def log_timings(self):
+        for name, (started, finished) in sorted(
+            self.timings.items(), key=lambda item: item[1],
+        ):
+            logger.debug('{:<20} {:7.1f} ms - {:7.1f} ms'.format(
+                name, started * 1000, finished * 1000,
+            ))
+
+
+def _add_release_steps(pipeline, argv):
+    pipeline.add(
+        'platform config', lambda: get_platform_config_paths(argv),
+    )
+    pipeline.add(
+        'image digest',
+        lambda docker_client, image_id, cache: resolve_image_sha(
+            docker_client, image_id, cache, get_image_digest_ttl(os.environ),
+        ),
+        'docker client', 'image id', 'cache',
+    )
+
+
+def _prepare_release(pipeline, kwargs):
+    kwargs['platform_config_paths'] = pipeline.result('platform config')
+    kwargs['environment_variables']['CDFLOW_IMAGE_DIGEST'] = \
+        pipeline.result('image digest')
+
+
+def _add_deploy_steps(pipeline, argv):
+    pipeline.add('component name', lambda: get_component_name(argv))
+    pipeline.add(
+        's3', lambda cache, credentials: get_s3_resource(cache),
+        'cache', 'credentials',
+    )
+    pipeline.add(
+        'account scheme', fetch_config_account_scheme,
+        's3', 'config', 'component name', 'cache',
+    )
+    pipeline.add(
+        'deploy image id',
+        lambda s3_resource, account_scheme, config, component_name, cache:
+            fetch_release_image_id(
+                s3_resource, account_scheme, config, component_name,
+                get_version(argv), cache,
+            ),
+        's3', 'account scheme', 'config', 'component name', 'cache',
+    )
+    # The pull starts as soon as the release says which image it needs.
+    pipeline.add('pull', pull_image, 'docker client', 'deploy image id')
+    pipeline.add(
+        'release artifact',
+        lambda s3_resource, account_scheme, config, component_name, cache:
+            fetch_release_artifact(
+                s3_resource, account_scheme, config, component_name,
+                get_version(argv), cache,
+            ),
+        's3', 'account scheme', 'config', 'component name', 'cache',
+    )
+
+
+def _prepare_deploy(pipeline, kwargs):
+    kwargs['image_id'] = pipeline.result('deploy image id')
+    release_artifact = pipeline.result('release artifact')
+    if release_artifact:
+        kwargs['release_artifact'] = release_artifact
+        kwargs['environment_variables'][RELEASE_ARTIFACT_VARIABLE] = \
+            release_artifact
+    pipeline.result('pull')
+
+
+COMMAND_PREFLIGHT = {
+    'release': (_add_release_steps, _prepare_release),
+    'deploy': (_add_deploy_steps, _prepare_deploy),
+}
+
+
+def _container_environment(credentials):
+    environment_variables = get_environment()
+    add_aws_credentials(environment_variables, credentials)
+    return environment_variables
+
+
+def _add_common_steps(pipeline, argv):
+    pipeline.add('docker client', get_docker_client)
+    pipeline.add('cache', lambda: open_cache(os.environ))
+    pipeline.add('config', get_manifest_data, 'cache')
+    pipeline.add(
+        'credentials', lambda cache: container_aws_credentials(argv, cache),
+        'cache',
+    )
+    pipeline.add('environment', _container_environment, 'credentials')
+    pipeline.add(
+        'image id', lambda config: get_image_id(os.environ, config), 'config',
+    )
+
+
+def _add_log_steps(pipeline, argv):
+    pipeline.add(
+        'log stages',
+        lambda config, environment: get_log_stages(config, environment, argv),
+        'config', 'environment',
+    )
+    pipeline.add(
+        'log archive',
+        lambda cache: open_log_archive(cache, argv, os.environ), 'cache',
+    )
+
+
+def _add_container_steps(pipeline, argv):
+    pipeline.add('component label', lambda: _label_component_name(argv))
+    pipeline.add(
+        'warm pool', lambda cache: open_warm_pool(cache, os.environ), 'cache',
+    )
+
+
+def _label_component_name(argv):
+    # Only used to label the container, so a run it cannot be found for,
+    # such as a shell outside a repository, goes ahead without it.
+    with _suppress(CDFlowWrapperException, IndexError):
+        return get_component_name(argv)
+
+
+# Preflight steps whose results are passed to docker_run when there are any.
+OPTIONAL_RUN_ARGUMENTS = (
+    ('log stages', 'log_stages'),
+    ('log archive', 'log_archive'),
+    ('component label', 'component_name'),
+    ('warm pool', 'warm_pool'),
+)
+
+
+def _add_preflight_steps(pipeline, argv, add_steps):
+    _add_common_steps(pipeline, argv)
+    _add_log_steps(pipeline, argv)
+    _add_container_steps(pipeline, argv)
+    add_steps(pipeline, argv)
+
+
+def preflight(argv):
+    """Gather everything needed to run the cdflow container.
+
+    Independent steps run concurrently; set CDFLOW_PREFLIGHT=serial to run
+    them one after another instead.
+    """
+    add_steps, prepare = COMMAND_PREFLIGHT.get(
+        _command(argv), (lambda pipeline, argv: None, lambda *args: None),
+    )
+    executor_class = ThreadPoolExecutor
+    if os.environ.get(PREFLIGHT_VARIABLE) == 'serial':
+        executor_class = _SerialExecutor
+    counter = _StepCounter()
+    _add_preflight_steps(counter, argv, add_steps)
+    # Enough workers for every step to run at once.
+    with executor_class(max_workers=counter.steps) as executor:
+        pipeline = Pipeline(executor)
+        _add_preflight_steps(pipeline, argv, add_steps)
+        kwargs = {
+            'docker_client': pipeline.result('docker client'),
+            'image_id': pipeline.result('image id'),
+            'command': argv,
+            'project_root': os.getcwd(),
+            'environment_variables': pipeline.result('environment'),
+        }
+        for step, argument in OPTIONAL_RUN_ARGUMENTS:
+            result = pipeline.result(step)
+            if result:
+                kwargs[argument] = result
+        prepare(pipeline, kwargs)
+    pipeline.log_timings()
+    return kwargs
+
+
+def main(argv):
+    toggle_verbose_logging(argv)
+    try:
+        return run_command(argv)
+    finally:
+        logger.debug('S3 round trips: {}'.format(_s3_requests.round_trips))
+
+
+def run_command(argv):
+    if _command(argv) in WRAPPER_COMMANDS:
+        return run_wrapper_command(argv)
+    if WATCH_FLAG in argv:
+        return run_watch(argv)
+
+    try:
+        kwargs = preflight(argv)
+    except CDFlowWrapperException as e:
+        print(str(e), file=sys.stderr)
+        return 1
+
+    return _run_prepared(kwargs)
+
+
+def _run_prepared(kwargs):
+    exit_status, output = docker_run(**kwargs)
+
+    print(output, file=sys.stderr if exit_status else sys.stdout)
     return exit_status
 
 
+def run_watch(argv):
+    """Plan a deploy, then plan it again each time the project changes,
+    until interrupted.
+
+    The plans run by exec in one container kept running between them. The
+    preflight is only repeated when cdflow.yml changes, or when the
+    credentials it resolved may be about to expire; otherwise the image,
+    release and credentials found the first time are used again.
+    """
+    argv = [arg for arg in argv if arg != WATCH_FLAG]
+    cache = open_cache(os.environ)
+    session_pool = SessionPool(cache) if cache is not None else None
+    try:
+        kwargs = _watch_preflight(_watch_argv(argv), session_pool)
+    except CDFlowWrapperException as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    watcher = watch_project(kwargs['project_root'])
+    try:
+        _watch(argv, cache, session_pool, kwargs, watcher)
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        watcher.close()
+        if session_pool is not None:
+            session_pool.close(kwargs['docker_client'])
+
+
+def _watch_argv(argv):
+    if _command(argv) != 'deploy' or not {'-p', '--plan-only'} & set(argv):
+        raise WatchUsageError()
+    return argv
+
+
+def _watch_preflight(argv, session_pool):
+    kwargs = preflight(argv)
+    if 'warm_pool' not in kwargs and session_pool is not None:
+        kwargs['warm_pool'] = session_pool
+    return kwargs
+
+
+def _watch(argv, cache, session_pool, kwargs, watcher):
+    prepared_at = time.monotonic()
+    while True:
+        if kwargs is not None:
+            _run_prepared(kwargs)
+        print('Watching {} for changes'.format(os.getcwd()), file=sys.stderr)
+        changed = wait_for_changes(watcher)
+        logger.debug('Changed: {}'.format(', '.join(sorted(changed))))
+        kwargs, prepared_at = _prepare_next_plan(
+            argv, cache, session_pool, kwargs, changed, prepared_at,
+        )
+
+
+def _prepare_next_plan(
+    argv, cache, session_pool, kwargs, changed, prepared_at,
+):
+    if kwargs is not None and not _needs_preflight(changed, prepared_at):
+        if kwargs.get('log_archive') is not None:
+            kwargs['log_archive'] = open_log_archive(cache, argv, os.environ)
+        return kwargs, prepared_at
+    try:
+        return _watch_preflight(argv, session_pool), time.monotonic()
+    except (CDFlowWrapperException, yaml.YAMLError) as e:
+        # Perhaps cdflow.yml is half edited; nothing is planned until the
+        # next change.
+        print(str(e), file=sys.stderr)
+        return None, prepared_at
+
+
+def _needs_preflight(changed, prepared_at):
+    # Credentials are only resolved with at least this long left to run.
+    lifetime = float(os.environ.get(
+        AWS_CREDENTIALS_MIN_LIFETIME_VARIABLE,
+        DEFAULT_AWS_CREDENTIALS_MIN_LIFETIME,
+    ))
+    return bool({MANIFEST_PATH, os.curdir} & changed) or \
+        time.monotonic() - prepared_at >= lifetime
+
+
 def run():
-    sys.exit(main(sys.argv[1:]))
+    argv = sys.argv[1:]
+    socket_path = os.environ.get(DAEMON_SOCKET_VARIABLE)
+    if socket_path and _command(argv) not in WRAPPER_COMMANDS:
+        exit_status = forward_to_daemon(socket_path, argv)
+        if exit_status is not None:
+            sys.exit(exit_status)
+    sys.exit(main(argv))
 
 
 if __name__ == '__main__':
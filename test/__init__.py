@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 from hypothesis import settings, HealthCheck
 
 
@@ -6,3 +9,6 @@ settings.register_profile(
     deadline=None,
     suppress_health_check=(HealthCheck.too_slow,))
 settings.load_profile("default")
+
+# Keep the wrapper's caches out of the home directory of whoever runs tests.
+os.environ['CDFLOW_CACHE_DIR'] = tempfile.mkdtemp(prefix='cdflow-test-')
@@ -0,0 +1,313 @@
+"""Fake Docker engine shared by the tests and the benchmarks.
+
+The engine answers each call after a fixed round-trip latency, plus any
+extra cost given for that call by name (create, start, stop, remove, ...),
+and counts them. A started container, or an exec, runs for a fixed time:
+its output stream ends, and wait answers, half a round trip after it exits.
+The containers the engine has created and not yet removed are counted, as
+is the most that existed at once.
+
+It stands in for a docker client in-process, or, through an EngineServer,
+for the daemon behind DOCKER_HOST.
+"""
+import collections
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from socketserver import ThreadingUnixStreamServer
+from urllib.parse import unquote
+
+import cdflow
+from test.s3 import DelayedS3
+
+IMAGE_ID = 'mergermarket/cdflow-commands@sha256:{}'.format('a' * 64)
+
+
+def frames(chunks, stream=cdflow.STDOUT):
+    """Return the chunks framed as the engine multiplexes output."""
+    return b''.join(
+        cdflow.FRAME_HEADER.pack(stream, len(chunk)) + chunk
+        for chunk in chunks
+    )
+
+
+def sleep_until(deadline):
+    time.sleep(max(deadline - time.perf_counter(), 0))
+
+
+class FakeEngine(object):
+
+    def __init__(self, latency=0, runtime=0, costs=None, output=(b'Done\n',)):
+        self.latency = latency
+        self.runtime = runtime
+        self.costs = costs or {}
+        self.chunks = list(output)
+        self.output = frames(self.chunks)
+        self.calls = collections.Counter()
+        self.ids = iter(range(sys.maxsize))
+        self.lock = threading.Lock()
+        self.created = {}
+        self.existing = 0
+        self.most_existing = 0
+        self.finished = None
+        self.containers = self
+        self.api = self
+
+    def call(self, name):
+        self.calls[name] += 1
+        time.sleep(self.latency + self.costs.get(name, 0))
+
+    def run(self, image_id, **kwargs):
+        container = self.create(image_id, **kwargs)
+        container.start()
+        return container
+
+    def create(self, image_id, **kwargs):
+        self.call('create')
+        container = FakeContainer(self, 'container-{}'.format(next(self.ids)))
+        with self.lock:
+            self.created[container.id] = container
+            self.existing += 1
+            self.most_existing = max(self.most_existing, self.existing)
+        return container
+
+    def removed(self):
+        with self.lock:
+            self.existing -= 1
+
+    def inspect_image(self, image_id):
+        self.call('inspect_image')
+        return {
+            'Id': image_id, 'RepoDigests': [image_id],
+            'Config': {'Entrypoint': ['cdflow']},
+        }
+
+    def exec_create(self, container_id, command, **kwargs):
+        self.call('exec_create')
+        return {'Id': 'exec'}
+
+    def exec_start(self, exec_id, socket):
+        self.call('exec_start')
+        exits = time.perf_counter() + self.runtime
+        return FakeOutput(self, lambda: exits)
+
+    def exec_inspect(self, exec_id):
+        self.call('exec_inspect')
+        return {'Running': False, 'ExitCode': 0}
+
+    def remove_container(self, container_id, force=False):
+        self.call('remove')
+        self.removed()
+
+
+class FakeOutput(io.BytesIO):
+    """Output stream that ends half a round trip after its command exits."""
+
+    def __init__(self, engine, exits):
+        super(FakeOutput, self).__init__(engine.output)
+        self.engine = engine
+        self.exits = exits
+
+    def read(self, size=-1):
+        sleep_until(self.exits() + self.engine.latency / 2)
+        return super(FakeOutput, self).read(size)
+
+
+class FakeContainer(object):
+
+    def __init__(self, engine, container_id):
+        self.engine = engine
+        self.id = container_id
+        self.exits = None
+        self.started = threading.Event()
+        self.attrs = {'State': {'ExitCode': 0}}
+
+    def logs(self, **kwargs):
+        self.engine.call('logs')
+        sleep_until(self.exits + self.engine.latency / 2)
+        return iter(self.engine.chunks)
+
+    def attach_socket(self, **kwargs):
+        self.engine.call('attach')
+        return FakeOutput(self.engine, lambda: self.exits)
+
+    def start(self):
+        self.engine.call('start')
+        self.exits = time.perf_counter() + self.engine.runtime
+        self.started.set()
+
+    def reload(self):
+        self.engine.call('reload')
+
+    def wait(self):
+        # Sent while the container runs, so only half a round trip is
+        # waited for after it exits.
+        self.engine.calls['wait'] += 1
+        sent = time.perf_counter() + self.engine.latency / 2
+        self.started.wait(10)
+        sleep_until(max(sent, self.exits) + self.engine.latency / 2)
+        self.engine.finished = time.time()
+        return {'StatusCode': 0}
+
+    def stop(self):
+        self.engine.call('stop')
+
+    def remove(self, **kwargs):
+        self.engine.call('remove')
+        self.engine.removed()
+
+
+class EngineHandler(BaseHTTPRequestHandler):
+    """Answers the Docker API calls a command makes to run one container,
+    through the server's FakeEngine."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request({
+            r'/version': lambda: {'ApiVersion': '1.41', 'Version': '20.10.0'},
+            r'/images/(.+)/json': self.engine.inspect_image,
+            r'/containers/([^/]+)/json': self.inspect_container,
+        })
+
+    def do_POST(self):
+        if re.search(r'/containers/[^/]+/attach', self.path):
+            return self.attach()
+        self.handle_request({
+            r'/images/create': self.pull,
+            r'/containers/create': self.create,
+            r'/containers/([^/]+)/wait': lambda id: self.container(id).wait(),
+            r'/containers/([^/]+)/start':
+                lambda id: self.container(id).start(),
+            r'/containers/([^/]+)/stop': lambda id: self.container(id).stop(),
+        })
+
+    def do_DELETE(self):
+        self.handle_request({
+            r'/containers/([^/]+)': lambda id: self.container(id).remove(),
+        })
+
+    @property
+    def engine(self):
+        return self.server.engine
+
+    def container(self, container_id):
+        return self.engine.created[container_id]
+
+    def inspect_container(self, container_id):
+        container = self.container(container_id)
+        container.reload()
+        return {'Id': container.id, 'State': container.attrs['State']}
+
+    def pull(self):
+        self.engine.call('pull')
+        return {'status': 'Downloaded'}
+
+    def create(self):
+        container = self.engine.create(json.loads(self.body)['Image'])
+        return {'Id': container.id, 'Warnings': []}
+
+    def handle_request(self, answers):
+        self.body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = unquote(re.sub(r'^/v[0-9.]+', '', self.path.split('?')[0]))
+        for pattern, answer in answers.items():
+            match = re.fullmatch(pattern, path)
+            if match:
+                response = answer(*match.groups())
+                return self.respond(204 if response is None else 200, response)
+        self.respond(404, {'message': 'no such path {}'.format(path)})
+
+    def respond(self, status, response):
+        body = b'' if response is None else json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def attach(self):
+        container_id = re.search(r'/containers/([^/]+)/attach', self.path)
+        container = self.container(container_id.group(1))
+        output = container.attach_socket()
+        self.send_response(101)
+        self.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Upgrade', 'tcp')
+        self.end_headers()
+        self.wfile.flush()
+        # Written once the container starts, after the client has read the
+        # headers, since it reads the stream from the raw socket.
+        container.started.wait(10)
+        self.wfile.write(output.read())
+        # The container has exited once its output ends.
+        self.close_connection = True
+
+
+class EngineServer(object):
+    """Serves a FakeEngine on a Unix socket, as the Docker daemon would.
+
+    Use ``docker_host`` as DOCKER_HOST.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.directory = tempfile.mkdtemp()
+        self.server = ThreadingUnixStreamServer(
+            os.path.join(self.directory, 'docker.sock'), EngineHandler,
+        )
+        self.server.daemon_threads = True
+        self.server.engine = engine
+        self.thread = threading.Thread(target=self.server.serve_forever)
+
+    @property
+    def docker_host(self):
+        return 'unix://{}'.format(self.server.server_address)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.directory)
+
+
+@contextmanager
+def fake_host(project):
+    """Set up a project for the commands of service 'service' in team
+    'platform' and yield the environment running cdflow there needs to use
+    a FakeEngine, and a DelayedS3 holding its account scheme and release 1,
+    instead of the real ones."""
+    with open(os.path.join(project, 'cdflow.yml'), 'w') as f:
+        f.write('account-scheme-url: s3://accounts/scheme.json\n')
+        f.write('team: platform\n')
+    account_scheme = json.dumps({'release-bucket': 'releases'}).encode()
+    engine = FakeEngine()
+    with EngineServer(engine) as server, DelayedS3({
+        '/accounts/scheme.json': (account_scheme, {}),
+        '/releases/platform/service/service-1.zip': (
+            b'', {'cdflow_image_digest': IMAGE_ID},
+        ),
+    }) as s3:
+        yield dict(
+            os.environ, DOCKER_HOST=server.docker_host,
+            CDFLOW_IMAGE_ID=IMAGE_ID, CDFLOW_CACHE_DIR=project,
+            AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing',
+            AWS_DEFAULT_REGION='us-east-1',
+            AWS_ENDPOINT_URL_S3='http://127.0.0.1:{}'.format(
+                s3.server.server_port,
+            ),
+        ), engine, s3
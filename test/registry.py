@@ -0,0 +1,64 @@
+import json
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+
+
+class FakeRegistryHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.registry.requests.append(('GET', self.path))
+        body = json.dumps({'token': self.server.registry.token})
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def do_HEAD(self):
+        registry = self.server.registry
+        registry.requests.append(('HEAD', self.path))
+        if not self.authorised(registry.token):
+            self.send_response(401)
+            self.send_header('WWW-Authenticate', (
+                'Bearer realm="http://{}/token",'
+                'service="registry",scope="pull"'
+            ).format(registry.address))
+        elif self.path in registry.manifests:
+            self.send_response(200)
+            self.send_header(
+                'Docker-Content-Digest', registry.manifests[self.path],
+            )
+        else:
+            self.send_response(404)
+        self.end_headers()
+
+    def authorised(self, token):
+        expected = 'Bearer {}'.format(token)
+        return token is None or self.headers.get('Authorization') == expected
+
+
+class FakeRegistry(object):
+    """Minimal Docker registry that only answers manifest HEAD requests."""
+
+    def __init__(self, manifests, token=None):
+        self.manifests = manifests
+        self.token = token
+        self.requests = []
+        self.server = HTTPServer(('127.0.0.1', 0), FakeRegistryHandler)
+        self.server.registry = self
+        self.thread = Thread(target=self.server.serve_forever)
+
+    @property
+    def address(self):
+        return '127.0.0.1:{}'.format(self.server.server_port)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
@@ -0,0 +1,76 @@
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import boto3
+from botocore.config import Config
+
+
+class DelayedS3Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        s3_object = self.handle_request()
+        if s3_object is not None:
+            self.wfile.write(s3_object[0])
+
+    def do_HEAD(self):
+        self.handle_request()
+
+    def handle_request(self):
+        s3 = self.server.s3
+        s3.requests.append((self.command, self.path))
+        time.sleep(s3.delays.pop(0) if s3.delays else 0)
+        s3_object = s3.objects.get(self.path)
+        if s3_object is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        body, metadata = s3_object
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"etag"')
+        for name, value in metadata.items():
+            self.send_header('x-amz-meta-{}'.format(name), value)
+        self.end_headers()
+        return s3_object
+
+
+class DelayedS3(object):
+    """S3 stand-in serving fixed objects, delaying each request in turn.
+
+    Objects are keyed by their path-style URL path, e.g. /bucket/key.
+    """
+
+    def __init__(self, objects, delays=()):
+        self.objects = objects
+        self.delays = list(delays)
+        self.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), DelayedS3Handler)
+        self.server.s3 = self
+        self.thread = Thread(target=self.server.serve_forever)
+
+    def resource(self):
+        return boto3.resource(
+            's3', region_name='us-east-1',
+            endpoint_url='http://127.0.0.1:{}'.format(
+                self.server.server_port,
+            ),
+            aws_access_key_id='testing', aws_secret_access_key='testing',
+            config=Config(
+                s3={'addressing_style': 'path'},
+                retries={'total_max_attempts': 1},
+            ),
+        )
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
@@ -0,0 +1,124 @@
+import shutil
+import tempfile
+import time
+import unittest
+from os import path
+
+from cdflow import CacheStore, main
+from mock import patch
+
+
+class TestCacheStore(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_path = path.join(self.cache_dir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_objects_round_trip_with_etag(self):
+        cache = CacheStore(self.cache_path)
+
+        cache.put_object('bucket', 'key', b'{}', etag='"abc"')
+
+        assert cache.get_object('bucket', 'key') == ('"abc"', b'{}')
+        assert cache.get_object('bucket', 'other-key') is None
+
+    def test_entries_from_another_cache_version_are_dropped(self):
+        cache = CacheStore(self.cache_path)
+        cache.put_object('bucket', 'key', b'{}', etag='"abc"')
+        cache.connection.execute('PRAGMA user_version = 0')
+
+        cache = CacheStore(self.cache_path)
+
+        assert cache.get_object('bucket', 'key') is None
+        assert cache.connection.execute(
+            'PRAGMA user_version'
+        ).fetchone()[0] == CacheStore.VERSION
+
+    def test_prune_removes_entries_not_used_within_max_age(self):
+        cache = CacheStore(self.cache_path, max_age=60)
+        cache.put_object('bucket', 'old', b'old')
+        cache.put_image_digest('image:tag', 'sha256:old')
+
+        with patch('cdflow.time.time', return_value=time.time() + 120):
+            cache.put_object('bucket', 'new', b'new')
+
+        assert cache.get_object('bucket', 'old') is None
+        assert cache.get_object('bucket', 'new') is not None
+        assert cache.get_image_digest('image:tag', 3600) is None
+
+    def test_least_recently_used_objects_are_evicted_over_max_size(self):
+        cache = CacheStore(self.cache_path, max_size=10)
+        cache.put_object('bucket', 'first', b'12345')
+        cache.put_object('bucket', 'second', b'12345')
+        cache.get_object('bucket', 'first')
+
+        cache.put_object('bucket', 'third', b'12345')
+
+        assert cache.get_object('bucket', 'second') is None
+        assert cache.get_object('bucket', 'first') is not None
+        assert cache.get_object('bucket', 'third') is not None
+
+    def test_stats_by_kind(self):
+        cache = CacheStore(self.cache_path)
+        cache.put_object('bucket', 'release.zip', b'{"a": 1}', immutable=True)
+        cache.put_object('bucket', 'scheme.json', b'{}', etag='"abc"')
+
+        assert cache.stats() == [
+            ('image digests', 0, 0),
+            ('release metadata', 1, 8),
+            ('revalidated objects', 1, 2),
+            ('release versions', 0, 0),
+            ('release artifacts', 0, 0),
+        ]
+
+
+class TestCacheCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def run_main(self, argv):
+        with patch.dict('cdflow.os.environ', {
+            'CDFLOW_CACHE_DIR': self.cache_dir,
+        }), patch('cdflow.print') as print_:
+            exit_status = main(argv)
+        return exit_status, [call[0][0] for call in print_.call_args_list]
+
+    def test_stats(self):
+        exit_status, output = self.run_main(['cache', 'stats'])
+
+        assert exit_status == 0
+        assert output[0] == 'Cache: {}'.format(
+            path.join(self.cache_dir, 'cache.db'),
+        )
+        assert output[1].startswith('image digests')
+
+    def test_stats_include_s3_read_latency(self):
+        cache = CacheStore(path.join(self.cache_dir, 'cache.db'))
+        for seconds in (0.01, 0.02, 0.2):
+            cache.put_s3_latency(seconds)
+
+        exit_status, output = self.run_main(['cache', 'stats'])
+
+        assert output[-1].split() == [
+            'S3', 'read', 'latency', 'p50', '20', 'ms,', 'p95', '200', 'ms',
+            'over', '3', 'reads',
+        ]
+
+    def test_prune(self):
+        exit_status, output = self.run_main(['cache', 'prune'])
+
+        assert exit_status == 0
+        assert output == ['Removed 0 cache entries']
+
+    def test_unknown_subcommand(self):
+        exit_status, output = self.run_main(['cache', 'clear'])
+
+        assert exit_status == 1
+        assert output == ['usage: cdflow cache stats|prune']
@@ -1,11 +1,16 @@
+import shutil
+import tempfile
 import unittest
+from os import path
 from unittest.mock import patch
 from string import printable
 import json
+import marshal
 
+import cdflow
 from cdflow import (
-    CDFLOW_IMAGE_ID, InvalidURLError, fetch_account_scheme, get_image_id,
-    parse_s3_url
+    CDFLOW_IMAGE_ID, AccountScheme, CacheStore, InvalidURLError,
+    fetch_account_scheme, get_image_id, parse_s3_url
 )
 import boto3
 from moto import mock_s3
@@ -384,3 +389,127 @@ class TestFetchAccountScheme(unittest.TestCase):
         assert list(sorted(account_scheme.keys())) == expected_keys
 
         assert account_scheme['release-bucket'] == old_bucket
+
+
+class TestAccountScheme(unittest.TestCase):
+
+    def account_scheme(self, new_url='s3://new-bucket/new-key'):
+        return AccountScheme({
+            'release-bucket': 'release-bucket',
+            'classic-metadata-handling': True,
+            'upgrade-account-scheme': {
+                'team-whitelist': ['a-team'],
+                'component-whitelist': ['a-component'],
+                'new-url': new_url,
+            },
+        })
+
+    def test_compiled_fields(self):
+        account_scheme = self.account_scheme()
+
+        assert account_scheme.release_bucket == 'release-bucket'
+        assert account_scheme.classic_metadata_handling
+        assert account_scheme.upgrade_location() == ('new-bucket', 'new-key')
+        assert account_scheme['release-bucket'] == 'release-bucket'
+
+    def test_forwards_whitelisted_teams_and_components(self):
+        account_scheme = self.account_scheme()
+
+        assert account_scheme.forwards('a-team', 'other-component')
+        assert account_scheme.forwards('other-team', 'a-component')
+        assert not account_scheme.forwards('other-team', 'other-component')
+        assert not AccountScheme({}).forwards('a-team', 'a-component')
+
+    def test_invalid_new_url_only_raises_when_forwarding(self):
+        account_scheme = self.account_scheme(new_url='http://new-bucket/key')
+
+        self.assertRaises(InvalidURLError, account_scheme.upgrade_location)
+
+    def test_round_trips_through_bytes(self):
+        account_scheme = self.account_scheme()
+
+        loaded = AccountScheme.from_bytes(account_scheme.to_bytes())
+
+        assert loaded['upgrade-account-scheme'] == {
+            'new-url': account_scheme['upgrade-account-scheme']['new-url'],
+        }
+        assert loaded.release_bucket == account_scheme.release_bucket
+        assert loaded.upgrade == account_scheme.upgrade
+        assert loaded.forwards('a-team', 'other-component')
+
+
+class TestCachedAccountScheme(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_s3 = mock_s3()
+        self.mock_s3.start()
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = CacheStore(path.join(self.cache_dir, 'cache.db'))
+        self.s3_resource = boto3.resource('s3')
+        boto3.client('s3').create_bucket(Bucket='releases')
+        self.account_scheme_object = self.s3_resource.Object(
+            'releases', 'account-scheme.json',
+        )
+
+    def tearDown(self):
+        self.mock_s3.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def put_account_scheme(self, release_bucket):
+        self.account_scheme_object.put(Body=json.dumps({
+            'release-bucket': release_bucket,
+        }).encode('utf-8'))
+        self.account_scheme_object.reload()
+        return self.account_scheme_object.e_tag
+
+    def fetch(self):
+        return fetch_account_scheme(
+            self.s3_resource, 'releases', 'account-scheme.json',
+            'a-team', 'a-component', self.cache,
+        )
+
+    def test_unchanged_account_scheme_is_served_from_cache(self):
+        etag = self.put_account_scheme('release-bucket')
+        self.fetch()
+
+        requests = []
+
+        def get_s3_object(s3_client, bucket, key, etag=None):
+            response = get_s3_object_without_spy(s3_client, bucket, key, etag)
+            requests.append((etag, response))
+            return response
+
+        get_s3_object_without_spy = cdflow._get_s3_object
+        with patch('cdflow._get_s3_object', get_s3_object):
+            account_scheme = self.fetch()
+
+        assert account_scheme['release-bucket'] == 'release-bucket'
+        assert requests == [(etag, None)]
+
+    def test_account_scheme_cached_in_another_format_is_downloaded_again(
+        self,
+    ):
+        etag = self.put_account_scheme('release-bucket')
+        self.cache.put_object(
+            'releases', 'account-scheme.json',
+            marshal.dumps((AccountScheme.FORMAT - 1, {})), etag=etag,
+        )
+
+        account_scheme = self.fetch()
+
+        assert account_scheme['release-bucket'] == 'release-bucket'
+        assert AccountScheme.from_bytes(self.cache.get_object(
+            'releases', 'account-scheme.json',
+        )[1]).release_bucket == 'release-bucket'
+
+    def test_changed_account_scheme_is_downloaded_again(self):
+        self.put_account_scheme('old-bucket')
+        self.fetch()
+        etag = self.put_account_scheme('new-bucket')
+
+        account_scheme = self.fetch()
+
+        assert account_scheme['release-bucket'] == 'new-bucket'
+        assert self.cache.get_object(
+            'releases', 'account-scheme.json',
+        )[0] == etag
@@ -0,0 +1,173 @@
+import shutil
+import tempfile
+import time
+import unittest
+from os import path
+
+from cdflow import (
+    AWS_CREDENTIALS_VARIABLE, CacheStore, add_aws_credentials,
+    container_aws_credentials, resolve_aws_credentials,
+)
+from mock import patch
+
+AWS_CONFIG = '''
+[profile a-profile]
+role_arn = arn:aws:iam::123456789012:role/a-role
+source_profile = base
+
+[profile other-profile]
+role_arn = arn:aws:iam::123456789012:role/other-role
+source_profile = base
+'''
+
+
+class TestResolveAWSCredentials(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.cache = CacheStore(path.join(self.cache_dir, 'cache.db'))
+        config_path = path.join(self.cache_dir, 'config')
+        with open(config_path, 'w') as config_file:
+            config_file.write(AWS_CONFIG)
+        self.environment = {
+            'AWS_CONFIG_FILE': config_path,
+            'AWS_SHARED_CREDENTIALS_FILE': path.join(self.cache_dir, 'none'),
+            'AWS_PROFILE': 'a-profile',
+        }
+        self.loads = []
+        self.expires_at = time.time() + 3600
+        for patcher in (
+            patch('cdflow._load_aws_credentials', self.load),
+            patch.dict('cdflow._aws_credentials', clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def load(self, session):
+        self.loads.append(session.get_config_variable('profile'))
+        return (
+            'key-{}'.format(len(self.loads)), 'secret', 'token',
+            self.expires_at,
+        )
+
+    def resolve(self, **environment):
+        with patch.dict(
+            'cdflow.os.environ', dict(self.environment, **environment),
+            clear=True,
+        ), patch.dict('cdflow._aws_credentials', clear=True):
+            return resolve_aws_credentials(self.cache)
+
+    def test_temporary_credentials_are_reused_from_the_cache(self):
+        assert self.resolve() == ('key-1', 'secret', 'token')
+        assert self.resolve() == ('key-1', 'secret', 'token')
+        assert self.loads == ['a-profile']
+
+    def test_credentials_are_cached_by_profile(self):
+        self.resolve()
+
+        assert self.resolve(AWS_PROFILE='other-profile')[0] == 'key-2'
+        assert self.loads == ['a-profile', 'other-profile']
+
+    def test_credentials_close_to_expiry_are_resolved_again(self):
+        self.expires_at = time.time() + 60
+        self.resolve()
+
+        assert self.resolve()[0] == 'key-2'
+
+    def test_minimum_lifetime_is_configurable(self):
+        self.expires_at = time.time() + 60
+        self.resolve()
+
+        credentials = self.resolve(CDFLOW_AWS_CREDENTIALS_MIN_LIFETIME='30')
+
+        assert credentials[0] == 'key-1'
+
+    def test_credentials_without_expiry_are_not_cached(self):
+        self.expires_at = None
+        self.resolve()
+        self.resolve()
+
+        assert len(self.loads) == 2
+
+    def test_credentials_in_the_environment_are_left_alone(self):
+        assert self.resolve(AWS_ACCESS_KEY_ID='key') is None
+        assert self.loads == []
+
+    def test_credentials_are_passed_through_when_they_cannot_be_resolved(self):
+        assert self.resolve(AWS_PROFILE='no-such-profile') is None
+        assert self.loads == []
+
+    def test_edited_config_resolves_them_again(self):
+        self.resolve()
+        with open(self.environment['AWS_CONFIG_FILE'], 'a') as config_file:
+            config_file.write('\n[profile another]\n')
+
+        assert self.resolve()[0] == 'key-2'
+
+    def test_another_credentials_file_resolves_them_again(self):
+        self.resolve()
+
+        credentials = self.resolve(
+            AWS_SHARED_CREDENTIALS_FILE=path.join(self.cache_dir, 'other'),
+        )
+
+        assert credentials[0] == 'key-2'
+
+    def test_forked_process_does_not_reuse_its_parents(self):
+        self.expires_at = None
+        with patch.dict('cdflow.os.environ', self.environment, clear=True):
+            resolve_aws_credentials(self.cache)
+            resolve_aws_credentials(self.cache)
+            with patch('cdflow.os.getpid', return_value=-1):
+                resolve_aws_credentials(self.cache)
+
+        assert len(self.loads) == 2
+
+
+class TestContainerAWSCredentials(unittest.TestCase):
+
+    def credentials(self, argv, **environment):
+        with patch(
+            'cdflow.resolve_aws_credentials', return_value=('key', 's', 't'),
+        ), patch.dict('cdflow.os.environ', environment, clear=True):
+            return container_aws_credentials(argv, None)
+
+    def test_resolved_for_deploy(self):
+        assert self.credentials(['deploy', 'live', '1']) == ('key', 's', 't')
+
+    def test_left_to_the_container_for_other_commands(self):
+        assert self.credentials(['release', '1']) is None
+        assert self.credentials(['destroy', 'live']) is None
+
+    def test_resolved_for_every_command_when_asked(self):
+        assert self.credentials(
+            ['release', '1'], **{AWS_CREDENTIALS_VARIABLE: 'resolve'}
+        ) == ('key', 's', 't')
+
+
+class TestAddAWSCredentials(unittest.TestCase):
+
+    def test_resolved_credentials_replace_the_environment(self):
+        environment_variables = {
+            'AWS_ACCESS_KEY_ID': None,
+            'AWS_SECRET_ACCESS_KEY': None,
+            'AWS_SESSION_TOKEN': None,
+        }
+
+        add_aws_credentials(
+            environment_variables, ('key', 'secret', 'token'),
+        )
+
+        assert environment_variables == {
+            'AWS_ACCESS_KEY_ID': 'key',
+            'AWS_SECRET_ACCESS_KEY': 'secret',
+            'AWS_SESSION_TOKEN': 'token',
+        }
+
+    def test_environment_unchanged_without_credentials(self):
+        environment_variables = {'AWS_ACCESS_KEY_ID': 'key'}
+
+        add_aws_credentials(environment_variables, None)
+
+        assert environment_variables == {'AWS_ACCESS_KEY_ID': 'key'}
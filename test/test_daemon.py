@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from io import BytesIO
+from threading import Thread
+
+from cdflow import (
+    CONTAINER_CLEANUP_VARIABLE, DAEMON_SOCKET_VARIABLE, docker_run,
+    forward_to_daemon, main, make_daemon_server,
+)
+from mock import MagicMock, patch
+
+
+def fake_main(argv):
+    print('cwd={} argv={} token={}'.format(
+        os.getcwd(), ' '.join(argv), os.environ.get('TEST_TOKEN'),
+    ))
+    return 3
+
+
+class RecordingContainer(object):
+    """Writes to a file when it is removed, which a forked worker's mocks
+    could not report back to the test."""
+
+    id = 'container-id'
+
+    def __init__(self, removed_path):
+        self.removed_path = removed_path
+
+    def attach_socket(self, **kwargs):
+        return BytesIO()
+
+    def start(self):
+        pass
+
+    def wait(self):
+        return {'StatusCode': 0}
+
+    def stop(self):
+        pass
+
+    def remove(self, **kwargs):
+        with open(self.removed_path, 'a') as removed:
+            removed.write('removed\n')
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, 'daemon.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def serve(self):
+        server = make_daemon_server(self.socket_path)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+    def test_forwards_argv_and_streams_output_back(self):
+        read_fd, write_fd = os.pipe()
+
+        with patch('cdflow.main', fake_main), \
+                patch.dict(os.environ, {'TEST_TOKEN': 'client-token'}):
+            self.serve()
+            exit_status = forward_to_daemon(
+                self.socket_path, ['deploy', 'live', '42'],
+                fds=(0, write_fd, write_fd),
+            )
+
+        os.close(write_fd)
+        with os.fdopen(read_fd) as output:
+            assert output.read() == 'cwd={} argv={} token={}\n'.format(
+                os.getcwd(), 'deploy live 42', 'client-token',
+            )
+        assert exit_status == 3
+
+    def test_worker_removes_its_finished_containers(self):
+        removed_path = os.path.join(self.directory, 'removed')
+        docker_client = MagicMock()
+        docker_client.containers.create.return_value = RecordingContainer(
+            removed_path,
+        )
+
+        def run_container(argv):
+            return docker_run(docker_client, 'image-id', argv, '/tmp', {})[0]
+
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        self.addCleanup(os.close, devnull)
+        environment = dict(os.environ)
+        environment.pop(CONTAINER_CLEANUP_VARIABLE, None)
+        with patch('cdflow.main', run_container), \
+                patch.dict(os.environ, environment, clear=True):
+            self.serve()
+            exit_status = forward_to_daemon(
+                self.socket_path, ['deploy', 'live', '42'],
+                fds=(0, devnull, 2),
+            )
+
+        deadline = time.monotonic() + 5
+        while not os.path.exists(removed_path) and \
+                time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert exit_status == 0
+        with open(removed_path) as removed:
+            assert removed.read() == 'removed\n'
+
+    def test_socket_is_private_to_the_user(self):
+        self.serve()
+
+        assert os.stat(self.socket_path).st_mode & 0o077 == 0
+
+    def test_falls_back_when_daemon_is_not_running(self):
+        exit_status = forward_to_daemon(self.socket_path, ['release'])
+
+        assert exit_status is None
+
+    def test_daemon_requires_socket_path(self):
+        with patch.dict(os.environ, clear=True), \
+                patch('cdflow.print') as print_:
+            exit_status = main(['daemon'])
+
+        assert exit_status == 1
+        assert DAEMON_SOCKET_VARIABLE in print_.call_args[0][0]
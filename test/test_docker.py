@@ -1,5 +1,13 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 from hashlib import sha256
+from io import BytesIO
+from os import path
 from string import printable
 from copy import deepcopy
 
@@ -11,14 +19,18 @@ from docker.models.images import Image
 from requests.exceptions import ReadTimeout
 
 from cdflow import (
-    _remove_container, docker_run, get_environment, get_image_sha,
-    CDFLOW_IMAGE_ID,
+    _remove_container, container_reaper, docker_run, fetch_manifest_digest,
+    get_environment, get_image_sha, parse_image_reference, resolve_image_sha,
+    CacheStore, CDFLOW_IMAGE_ID, COMPONENT_LABEL, CONTAINER_CLEANUP_VARIABLE,
+    DOCKER_HUB_REGISTRY, FRAME_HEADER, HOST_LABEL, PID_LABEL, STARTED_LABEL,
+    STDERR, STDOUT, ContainerReaper,
 )
 from hypothesis import assume, given
 from hypothesis.strategies import (
     dictionaries, fixed_dictionaries, integers, lists, text
 )
-from mock import MagicMock, patch
+from mock import ANY, MagicMock, patch
+from test.registry import FakeRegistry
 from test.strategies import VALID_ALPHABET, filepath, image_id
 
 
@@ -109,12 +121,9 @@ class TestDockerRun(unittest.TestCase):
         environment_variables = fixtures['environment_variables']
 
         container = MagicMock(spec=Container)
-        container.attrs = {
-            'State': {
-                'ExitCode': 0
-            }
-        }
-        docker_client.containers.run.return_value = container
+        container.wait.return_value = {'StatusCode': 0}
+        docker_client.containers.create.return_value = container
+        container.attach_socket.return_value = BytesIO()
 
         exit_status, output = docker_run(
             docker_client,
@@ -145,13 +154,13 @@ class TestDockerRun(unittest.TestCase):
                 'mode': 'ro',
             }
 
-        docker_client.containers.run.assert_called_once_with(
+        docker_client.containers.create.assert_called_once_with(
             image_id,
             command=command,
             environment=environment_variables,
-            detach=True,
             volumes=expected_volumes,
             working_dir=project_root,
+            labels=ANY,
         )
 
     @given(fixed_dictionaries({
@@ -175,12 +184,9 @@ class TestDockerRun(unittest.TestCase):
         environment_variables = fixtures['environment_variables']
 
         container = MagicMock(spec=Container)
-        container.attrs = {
-            'State': {
-                'ExitCode': 0
-            }
-        }
-        docker_client.containers.run.return_value = container
+        container.wait.return_value = {'StatusCode': 0}
+        docker_client.containers.create.return_value = container
+        container.attach_socket.return_value = BytesIO()
 
         exit_status, output = docker_run(
             docker_client,
@@ -193,11 +199,10 @@ class TestDockerRun(unittest.TestCase):
         assert exit_status == 0
         assert output == ''
 
-        docker_client.containers.run.assert_called_once_with(
+        docker_client.containers.create.assert_called_once_with(
             image_id,
             command=command,
             environment=environment_variables,
-            detach=True,
             volumes={
                 project_root: {
                     'bind': project_root,
@@ -209,8 +214,140 @@ class TestDockerRun(unittest.TestCase):
                 },
             },
             working_dir=project_root,
+            labels=ANY,
         )
 
+    @given(fixed_dictionaries({
+        'image_id': image_id(),
+        'project_root': filepath(),
+        'release_artifact': filepath(),
+    }))
+    def test_release_artifact_is_mounted_read_only(self, fixtures):
+        assume(fixtures['release_artifact'] != fixtures['project_root'])
+        docker_client = MagicMock(spec=DockerClient)
+        container = MagicMock(spec=Container)
+        container.wait.return_value = {'StatusCode': 0}
+        docker_client.containers.create.return_value = container
+        container.attach_socket.return_value = BytesIO()
+        project_root = fixtures['project_root']
+        release_artifact = fixtures['release_artifact']
+
+        docker_run(
+            docker_client, fixtures['image_id'], ['deploy'], project_root,
+            {}, release_artifact=release_artifact,
+        )
+
+        volumes = docker_client.containers.create.call_args[1]['volumes']
+        assert volumes[release_artifact] == {
+            'bind': release_artifact,
+            'mode': 'ro',
+        }
+
+    def test_log_stages_apply_to_each_stream(self):
+        docker_client = MagicMock(spec=DockerClient)
+        container = MagicMock(spec=Container)
+        container.wait.return_value = {'StatusCode': 0}
+        docker_client.containers.create.return_value = container
+        container.attach_socket.return_value = BytesIO(
+            FRAME_HEADER.pack(STDOUT, 5) + b'plan\n' +
+            FRAME_HEADER.pack(STDERR, 6) + b'error\n'
+        )
+
+        def tag_stage():
+            return lambda lines: (b'[app] ' + line for line in lines)
+
+        stdout = MagicMock(buffer=BytesIO())
+        stderr = MagicMock(buffer=BytesIO())
+        with patch('cdflow.sys.stdout', stdout), \
+                patch('cdflow.sys.stderr', stderr):
+            docker_run(
+                docker_client, 'image', ['deploy'], '/project', {},
+                log_stages=[tag_stage],
+            )
+
+        assert stdout.buffer.getvalue() == b'[app] plan\n'
+        assert stderr.buffer.getvalue() == b'[app] error\n'
+
+    def test_output_is_archived_with_the_exit_status(self):
+        docker_client = MagicMock(spec=DockerClient)
+        container = MagicMock(spec=Container)
+        container.wait.return_value = {'StatusCode': 2}
+        docker_client.containers.create.return_value = container
+        container.attach_socket.return_value = BytesIO(
+            FRAME_HEADER.pack(STDOUT, 5) + b'plan\n' +
+            FRAME_HEADER.pack(STDERR, 6) + b'error\n'
+        )
+        log_archive = MagicMock()
+        archived = []
+        log_archive.writelines.side_effect = archived.extend
+
+        with patch('cdflow.sys.stdout', MagicMock(buffer=BytesIO())), \
+                patch('cdflow.sys.stderr', MagicMock(buffer=BytesIO())):
+            docker_run(
+                docker_client, 'image', ['deploy'], '/project', {},
+                log_archive=log_archive,
+            )
+
+        assert b''.join(archived) == b'plan\nerror\n'
+        log_archive.close.assert_called_once_with(2)
+
+    def test_output_is_archived_when_relaying_fails(self):
+        docker_client = MagicMock(spec=DockerClient)
+        container = MagicMock(spec=Container)
+        container.wait.return_value = {'StatusCode': 0}
+        docker_client.containers.create.return_value = container
+        container.attach_socket.return_value = BytesIO(
+            FRAME_HEADER.pack(STDOUT, 5) + b'plan\n'
+        )
+        log_archive = MagicMock()
+        stdout = MagicMock()
+        stdout.buffer.write.side_effect = BrokenPipeError()
+
+        with patch('cdflow.sys.stdout', stdout), \
+                patch('cdflow.sys.stderr', MagicMock(buffer=BytesIO())):
+            self.assertRaises(
+                BrokenPipeError, docker_run, docker_client, 'image',
+                ['deploy'], '/project', {}, log_archive=log_archive,
+            )
+
+        log_archive.close.assert_called_once_with(None)
+
+    def test_failure_reports_the_end_of_the_output(self):
+        docker_client = MagicMock(spec=DockerClient)
+        container = MagicMock(spec=Container)
+        container.wait.return_value = {'StatusCode': 1}
+        docker_client.containers.create.return_value = container
+        lines = ['line {}\n'.format(number) for number in range(5000)]
+        container.attach_socket.return_value = BytesIO(b''.join(
+            FRAME_HEADER.pack(STDOUT, len(line)) + line.encode()
+            for line in lines[:-1]
+        ) + FRAME_HEADER.pack(STDERR, 11) + b'Error: boom')
+
+        with patch('cdflow.sys.stdout', MagicMock(buffer=BytesIO())), \
+                patch('cdflow.sys.stderr', MagicMock(buffer=BytesIO())):
+            exit_status, output = docker_run(
+                docker_client, 'image', ['deploy'], '/project', {},
+            )
+
+        assert exit_status == 1
+        assert output.splitlines() == [
+            'cdflow: exited with status 1; the last 30 lines of output were:',
+        ] + [line.strip() for line in lines[-30:-1]] + ['Error: boom']
+
+    def test_success_reports_nothing(self):
+        docker_client = MagicMock(spec=DockerClient)
+        container = MagicMock(spec=Container)
+        container.wait.return_value = {'StatusCode': 0}
+        docker_client.containers.create.return_value = container
+        container.attach_socket.return_value = BytesIO(
+            FRAME_HEADER.pack(STDOUT, 5) + b'done\n'
+        )
+
+        with patch('cdflow.sys.stdout', MagicMock(buffer=BytesIO())):
+            assert docker_run(
+                docker_client, 'image', ['deploy'], '/project', {},
+            ) == (0, '')
+
     @given(fixed_dictionaries({
         'environment_variables': fixed_dictionaries({
             'AWS_ACCESS_KEY_ID': text(alphabet=printable, min_size=10),
@@ -232,11 +369,7 @@ class TestDockerRun(unittest.TestCase):
         environment_variables = fixtures['environment_variables']
 
         container = MagicMock(spec=Container)
-        container.attrs = {
-            'State': {
-                'ExitCode': 0
-            }
-        }
+        container.wait.return_value = {'StatusCode': 0}
         docker_client.containers.create.return_value = container
 
         with patch('cdflow.dockerpty') as dockerpty, patch(
@@ -279,6 +412,7 @@ class TestDockerRun(unittest.TestCase):
             working_dir=project_root,
             tty=True,
             stdin_open=True,
+            labels=ANY,
         )
 
     @given(fixed_dictionaries({
@@ -303,7 +437,7 @@ class TestDockerRun(unittest.TestCase):
         environment_variables = fixtures['environment_variables']
 
         docker_client = MagicMock(spec=DockerClient)
-        docker_client.containers.run.side_effect = DockerException
+        docker_client.containers.create.side_effect = DockerException
 
         exit_status, output = docker_run(
             docker_client,
@@ -332,37 +466,48 @@ class TestDockerRun(unittest.TestCase):
         docker_client = MagicMock(spec=DockerClient)
 
         container = MagicMock(spec=Container)
-        logs = MagicMock()
-        messages = [m.encode('utf-8') for m in ('Running', 'the', 'command')]
-        logs.__iter__.return_value = iter(messages)
-        container.logs.return_value = logs
-
-        container.attrs = {
-            'State': {
-                'ExitCode': 0
-            }
-        }
+        container.attach_socket.return_value = BytesIO(
+            FRAME_HEADER.pack(STDOUT, 8) + b'Running ' +
+            FRAME_HEADER.pack(STDERR, 8) + b'warning\n' +
+            FRAME_HEADER.pack(STDOUT, 12) + b'the command\n'
+        )
 
-        docker_client.containers.run.return_value = container
+        container.wait.return_value = {'StatusCode': 0}
 
-        with patch('cdflow.print') as print_:
+        docker_client.containers.create.return_value = container
+
+        stdout = MagicMock(buffer=BytesIO())
+        stderr = MagicMock(buffer=BytesIO())
+        with patch('cdflow.sys.stdout', stdout), \
+                patch('cdflow.sys.stderr', stderr):
             docker_run(
                 docker_client, fixtures['image_id'], fixtures['command'],
                 fixtures['project_root'], fixtures['environment_variables'],
                 fixtures['platform_config_paths'],
             )
 
-            container.logs.assert_called_once_with(
-                stream=True, follow=True, stdout=True, stderr=True
-            )
+            container.attach_socket.assert_called_once_with(params={
+                'stdout': 1, 'stderr': 1, 'stream': 1, 'logs': 1,
+            })
+
+            assert stdout.buffer.getvalue() == b'Running the command\n'
+            assert stderr.buffer.getvalue() == b'warning\n'
+
+    def test_output_is_attached_before_the_container_starts(self):
+        docker_client = MagicMock(spec=DockerClient)
+        container = MagicMock(spec=Container)
+        container.attach_socket.return_value = BytesIO()
+        container.wait.return_value = {'StatusCode': 3}
+        docker_client.containers.create.return_value = container
 
-            assert print_.call_args_list[0][1]['end'] == ''
-            assert print_.call_args_list[0][0][0] == messages[0]\
-                .decode('utf-8')
-            assert print_.call_args_list[1][0][0] == messages[1]\
-                .decode('utf-8')
-            assert print_.call_args_list[2][0][0] == messages[2]\
-                .decode('utf-8')
+        exit_status, output = docker_run(
+            docker_client, 'image-id', ['deploy'], '/tmp/project', {},
+        )
+
+        calls = [name for name, args, kwargs in container.mock_calls]
+        assert calls == ['attach_socket', 'start', 'wait']
+        assert exit_status == 3
+        docker_client.containers.run.assert_not_called()
 
     @given(fixed_dictionaries({
         'image_id': image_id(),
@@ -378,13 +523,10 @@ class TestDockerRun(unittest.TestCase):
     def test_container_can_be_removed_at_script_exit(self, fixtures):
         docker_client = MagicMock(spec=DockerClient)
         container = MagicMock(spec=Container)
-        container.attrs = {
-            'State': {
-                'ExitCode': 0
-            }
-        }
+        container.wait.return_value = {'StatusCode': 0}
 
-        docker_client.containers.run.return_value = container
+        docker_client.containers.create.return_value = container
+        container.attach_socket.return_value = BytesIO()
 
         with patch('cdflow.atexit') as atexit:
             docker_run(
@@ -397,6 +539,49 @@ class TestDockerRun(unittest.TestCase):
                 _remove_container, container
             )
 
+    def test_containers_are_labelled_with_their_wrapper(self):
+        docker_client = MagicMock(spec=DockerClient)
+        container = MagicMock(spec=Container)
+        container.attach_socket.return_value = BytesIO()
+        container.wait.return_value = {'StatusCode': 0}
+        docker_client.containers.create.return_value = container
+
+        docker_run(
+            docker_client, 'image-id', ['deploy'], '/tmp/project', {},
+            component_name='a-component',
+        )
+
+        labels = docker_client.containers.create.call_args[1]['labels']
+        assert labels == {
+            PID_LABEL: str(os.getpid()),
+            HOST_LABEL: socket.gethostname(),
+            COMPONENT_LABEL: 'a-component',
+            STARTED_LABEL: ANY,
+        }
+        assert abs(int(labels[STARTED_LABEL]) - time.time()) < 60
+
+    def test_reaper_removes_container_once_exit_status_is_read(self):
+        docker_client = MagicMock(spec=DockerClient)
+        container = MagicMock(spec=Container)
+        container.attach_socket.return_value = BytesIO()
+        docker_client.containers.create.return_value = container
+        events = []
+        container.wait.side_effect = lambda: (
+            events.append('wait') or {'StatusCode': 0}
+        )
+        reaper = MagicMock(spec=ContainerReaper)
+        reaper.put.side_effect = lambda container: events.append('put')
+
+        with patch('cdflow.atexit') as atexit, \
+                patch('cdflow.container_reaper', return_value=reaper):
+            docker_run(
+                docker_client, 'image-id', ['deploy'], '/tmp/project', {},
+            )
+
+        reaper.put.assert_called_once_with(container)
+        assert events == ['wait', 'put']
+        atexit.register.assert_not_called()
+
     def test_remove_container(self):
         container = MagicMock(spec=Container)
 
@@ -435,13 +620,10 @@ class TestDockerRun(unittest.TestCase):
         docker_client = MagicMock(spec=DockerClient)
         container = MagicMock(spec=Container)
 
-        container.attrs = {
-            'State': {
-                'ExitCode': fixtures['exit_code'],
-            }
-        }
+        container.wait.return_value = {'StatusCode': fixtures['exit_code']}
 
-        docker_client.containers.run.return_value = container
+        docker_client.containers.create.return_value = container
+        container.attach_socket.return_value = BytesIO()
 
         exit_status, output = docker_run(
             docker_client, fixtures['image_id'], fixtures['command'],
@@ -451,3 +633,165 @@ class TestDockerRun(unittest.TestCase):
 
         assert exit_status == fixtures['exit_code']
         assert output == ''
+
+
+class TestContainerReaper(unittest.TestCase):
+
+    def test_containers_are_removed_in_the_background(self):
+        reaper = ContainerReaper()
+        containers = [MagicMock(spec=Container) for _ in range(3)]
+
+        for container in containers:
+            reaper.put(container)
+
+        assert reaper.drain(timeout=5)
+        for container in containers:
+            container.remove.assert_called_once_with(force=True)
+
+    def test_failed_removal_does_not_stop_the_reaper(self):
+        reaper = ContainerReaper()
+        failing, container = MagicMock(spec=Container), \
+            MagicMock(spec=Container)
+        failing.remove.side_effect = DockerException
+
+        reaper.put(failing)
+        reaper.put(container)
+
+        assert reaper.drain(timeout=5)
+        container.remove.assert_called_once_with(force=True)
+
+    def test_drain_gives_up_after_the_timeout(self):
+        reaper = ContainerReaper()
+        released = threading.Event()
+        container = MagicMock(spec=Container)
+        container.remove.side_effect = lambda force: released.wait()
+
+        reaper.put(container)
+
+        assert not reaper.drain(timeout=0.05)
+        released.set()
+        assert reaper.drain(timeout=5)
+
+    def test_put_waits_for_room(self):
+        reaper = ContainerReaper(max_pending=1)
+        released = threading.Event()
+        removing = MagicMock(spec=Container)
+        removing.remove.side_effect = lambda force: released.wait()
+        reaper.put(removing)
+        reaper.put(MagicMock(spec=Container))
+        put = threading.Thread(target=reaper.put, args=(
+            MagicMock(spec=Container),
+        ))
+
+        put.start()
+        put.join(timeout=0.05)
+        assert put.is_alive()
+        released.set()
+        put.join(timeout=5)
+        assert not put.is_alive()
+
+    def test_reaper_is_opt_in(self):
+        assert container_reaper({}) is None
+        assert container_reaper({CONTAINER_CLEANUP_VARIABLE: 'exit'}) is None
+
+    def test_one_reaper_per_process_drained_at_exit(self):
+        environment = {CONTAINER_CLEANUP_VARIABLE: 'reaper'}
+        with patch.dict('cdflow._reapers', clear=True), \
+                patch('cdflow.atexit') as atexit:
+            reaper = container_reaper(environment)
+
+            assert container_reaper(environment) is reaper
+            atexit.register.assert_called_once_with(reaper.drain)
+
+
+class TestResolveImageSha(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = CacheStore(path.join(self.cache_dir, 'cache.db'))
+        self.digest = 'sha256:{}'.format(sha256(b'manifest').hexdigest())
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def docker_client_with_local_image(self, repo_digests):
+        docker_client = MagicMock(spec=DockerClient)
+        image = MagicMock(spec=Image)
+        image.attrs = {'RepoDigests': repo_digests}
+        docker_client.images.get.return_value = image
+        docker_client.images.pull.return_value = image
+        return docker_client
+
+    def test_up_to_date_local_image_is_not_pulled(self):
+        with FakeRegistry({'/v2/team/app/manifests/1.2': self.digest}) as \
+                registry:
+            repository = '{}/team/app'.format(registry.address)
+            repo_digest = '{}@{}'.format(repository, self.digest)
+            docker_client = self.docker_client_with_local_image([repo_digest])
+
+            image_sha = resolve_image_sha(
+                docker_client, '{}:1.2'.format(repository), self.cache,
+            )
+
+        assert image_sha == repo_digest
+        docker_client.images.pull.assert_not_called()
+
+    def test_image_is_pulled_when_registry_has_a_newer_digest(self):
+        with FakeRegistry({'/v2/team/app/manifests/1.2': self.digest}) as \
+                registry:
+            image_id = '{}/team/app:1.2'.format(registry.address)
+            docker_client = self.docker_client_with_local_image(
+                ['{}/team/app@sha256:older'.format(registry.address)],
+            )
+
+            resolve_image_sha(docker_client, image_id, self.cache)
+
+        docker_client.images.pull.assert_called_once_with(image_id)
+
+    def test_falls_back_to_pull_when_registry_is_unavailable(self):
+        docker_client = self.docker_client_with_local_image(['pulled'])
+
+        image_sha = resolve_image_sha(
+            docker_client, '127.0.0.1:1/team/app:1.2', self.cache,
+        )
+
+        assert image_sha == 'pulled'
+        docker_client.images.pull.assert_called_once_with(
+            '127.0.0.1:1/team/app:1.2',
+        )
+
+    def test_digest_is_cached_until_ttl_expires(self):
+        with FakeRegistry({'/v2/team/app/manifests/1.2': self.digest}) as \
+                registry:
+            image_id = '{}/team/app:1.2'.format(registry.address)
+            docker_client = self.docker_client_with_local_image(
+                ['{}/team/app@{}'.format(registry.address, self.digest)],
+            )
+
+            resolve_image_sha(docker_client, image_id, self.cache, ttl=60)
+            resolve_image_sha(docker_client, image_id, self.cache, ttl=60)
+            resolve_image_sha(docker_client, image_id, self.cache, ttl=-1)
+
+        assert len(registry.requests) == 2
+
+    def test_authenticates_with_registry_token(self):
+        with FakeRegistry(
+            {'/v2/team/app/manifests/latest': self.digest}, token='secret',
+        ) as registry:
+            digest = fetch_manifest_digest(
+                '{}/team/app'.format(registry.address),
+            )
+
+        assert digest == self.digest
+        assert [method for method, _ in registry.requests] == \
+            ['HEAD', 'GET', 'HEAD']
+
+    def test_parse_image_reference(self):
+        assert parse_image_reference('mergermarket/cdflow-commands') == \
+            (DOCKER_HUB_REGISTRY, 'mergermarket/cdflow-commands', 'latest')
+        assert parse_image_reference('python:3.7') == \
+            (DOCKER_HUB_REGISTRY, 'library/python', '3.7')
+        assert parse_image_reference('localhost:5000/a/b:c') == \
+            ('localhost:5000', 'a/b', 'c')
+        assert parse_image_reference('123.dkr.ecr.amazonaws.com/a:1') == \
+            ('123.dkr.ecr.amazonaws.com', 'a', '1')
@@ -1,10 +1,13 @@
+import shutil
+import tempfile
 import unittest
+from os import path
 from random import shuffle
 from itertools import chain
 
 from cdflow import (
     fetch_release_metadata, get_component_name, get_version,
-    get_platform_config_paths, MissingPlatformConfigError,
+    get_platform_config_paths, CacheStore, MissingPlatformConfigError,
 )
 from hypothesis import given
 from hypothesis.strategies import fixed_dictionaries, lists, sampled_from, text
@@ -16,6 +19,10 @@ class TestGetComponentName(unittest.TestCase):
 
     def setUp(self):
         self.argv = ['deploy', '42']
+        # Exercise the git subprocess, whatever repository the tests are in.
+        patcher = patch('cdflow.read_git_remote_url', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     @given(text(
         alphabet=VALID_ALPHABET, min_size=1, max_size=100
@@ -224,9 +231,8 @@ class TestFetchReleaseMetadata(unittest.TestCase):
         }
 
         s3_resource = Mock()
-        key = Mock()
-        key.metadata = expected_metadata
-        s3_resource.Object.return_value = key
+        s3_client = s3_resource.meta.client
+        s3_client.head_object.return_value = {'Metadata': expected_metadata}
 
         metadata = fetch_release_metadata(
             s3_resource, bucket_name, component_name, version
@@ -234,8 +240,8 @@ class TestFetchReleaseMetadata(unittest.TestCase):
 
         assert metadata == expected_metadata
 
-        s3_resource.Object.assert_called_once_with(
-            bucket_name, '{}/{}-{}.zip'.format(
+        s3_client.head_object.assert_called_once_with(
+            Bucket=bucket_name, Key='{}/{}-{}.zip'.format(
                 component_name, component_name, version,
             )
         )
@@ -256,9 +262,8 @@ class TestFetchReleaseMetadata(unittest.TestCase):
         }
 
         s3_resource = Mock()
-        key = Mock()
-        key.metadata = expected_metadata
-        s3_resource.Object.return_value = key
+        s3_client = s3_resource.meta.client
+        s3_client.head_object.return_value = {'Metadata': expected_metadata}
 
         metadata = fetch_release_metadata(
             s3_resource, bucket_name, component_name, version, team_name,
@@ -266,8 +271,32 @@ class TestFetchReleaseMetadata(unittest.TestCase):
 
         assert metadata == expected_metadata
 
-        s3_resource.Object.assert_called_once_with(
-            bucket_name, '{}/{}/{}-{}.zip'.format(
+        s3_client.head_object.assert_called_once_with(
+            Bucket=bucket_name, Key='{}/{}/{}-{}.zip'.format(
                 team_name, component_name, component_name, version,
             )
         )
+
+    def test_release_metadata_is_cached_forever(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = CacheStore(path.join(cache_dir, 'cache.db'))
+        expected_metadata = {
+            'cdflow_image_digest': 'sha:12345asdfg'
+        }
+        s3_resource = Mock()
+        s3_resource.meta.client.head_object.return_value = {
+            'Metadata': expected_metadata,
+        }
+
+        fetch_release_metadata(
+            s3_resource, 'releases', 'a-component', '42', 'a-team', cache,
+        )
+        later_s3_resource = Mock()
+        metadata = fetch_release_metadata(
+            later_s3_resource, 'releases', 'a-component', '42', 'a-team',
+            cache,
+        )
+
+        assert metadata == expected_metadata
+        later_s3_resource.meta.client.head_object.assert_not_called()
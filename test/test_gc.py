@@ -0,0 +1,183 @@
+import io
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stdout
+
+from cdflow import (
+    COMPONENT_LABEL, GcUsageError, HOST_LABEL, PID_LABEL, POOL_LABEL,
+    STARTED_LABEL, open_cache, orphaned_containers, run_gc_command
+)
+from docker.api.client import APIClient
+from docker.client import DockerClient
+from docker.errors import NotFound
+from docker.models.containers import Container
+from mock import MagicMock, patch
+
+
+def finished_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def labelled_container(pid, started=None, component='a-component'):
+    if started is None:
+        started = time.time()
+    container = MagicMock(spec=Container)
+    container.id = '{:064x}'.format(pid)
+    container.attrs = {
+        'Id': container.id,
+        'Labels': {
+            PID_LABEL: str(pid),
+            HOST_LABEL: socket.gethostname(),
+            COMPONENT_LABEL: component,
+            STARTED_LABEL: str(int(started)),
+        },
+    }
+    return container
+
+
+class TestOrphanedContainers(unittest.TestCase):
+
+    def setUp(self):
+        self.docker_client = MagicMock(spec=DockerClient)
+
+    def orphans(self, *containers, pooled=()):
+        self.docker_client.containers.list.return_value = list(containers)
+        return orphaned_containers(self.docker_client, pooled=pooled)
+
+    def test_only_labelled_containers_from_this_host_are_listed(self):
+        self.orphans()
+
+        self.docker_client.containers.list.assert_called_once_with(
+            all=True, sparse=True, filters={'label': [
+                PID_LABEL, '{}={}'.format(HOST_LABEL, socket.gethostname()),
+            ]},
+        )
+
+    def test_container_whose_wrapper_has_gone_is_orphaned(self):
+        container = labelled_container(finished_pid())
+
+        assert self.orphans(container) == [container]
+
+    def test_container_whose_wrapper_is_running_is_kept(self):
+        assert self.orphans(labelled_container(os.getpid())) == []
+
+    def test_container_whose_wrapper_pid_was_reused_is_orphaned(self):
+        container = labelled_container(os.getpid(), started=1)
+
+        with patch('cdflow._process_start_time', return_value=60):
+            assert self.orphans(container) == [container]
+
+    def test_pooled_container_is_left_to_the_pool(self):
+        container = labelled_container(finished_pid())
+        container.attrs['Labels'][POOL_LABEL] = 'key'
+
+        assert self.orphans(container, pooled={container.id}) == []
+
+    def test_pooled_container_the_pool_lost_track_of_is_orphaned(self):
+        container = labelled_container(finished_pid())
+        container.attrs['Labels'][POOL_LABEL] = 'key'
+
+        assert self.orphans(container) == [container]
+
+    def test_pooled_container_still_being_added_to_the_pool_is_kept(self):
+        container = labelled_container(os.getpid())
+        container.attrs['Labels'][POOL_LABEL] = 'key'
+
+        assert self.orphans(container) == []
+
+    def test_container_with_unreadable_labels_is_kept(self):
+        container = labelled_container(finished_pid())
+        container.attrs['Labels'][PID_LABEL] = 'not a pid'
+
+        assert self.orphans(container) == []
+
+
+class TestGcCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.docker_client = MagicMock(spec=DockerClient)
+        self.orphan = labelled_container(finished_pid())
+        self.running = labelled_container(os.getpid())
+        self.docker_client.containers.list.return_value = [
+            self.orphan, self.running,
+        ]
+        patcher = patch(
+            'cdflow.get_docker_client', return_value=self.docker_client,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.environment = {'CDFLOW_CACHE_DIR': cache_dir}
+
+    def gc(self, *args):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            assert run_gc_command(['gc'] + list(args), self.environment) == 0
+        return output.getvalue()
+
+    def test_removes_idle_pooled_containers_once_the_pool_is_off(self):
+        cache = open_cache(self.environment)
+        cache.put_warm_container('pooled', 'key', [], os.getpid())
+        cache.release_warm_container('pooled')
+        self.docker_client.api = MagicMock(spec=APIClient)
+
+        self.gc()
+
+        self.docker_client.api.remove_container.assert_called_once_with(
+            'pooled', force=True,
+        )
+
+    def test_keeps_pooled_containers_in_use(self):
+        pooled = labelled_container(finished_pid())
+        pooled.attrs['Labels'][POOL_LABEL] = 'key'
+        self.docker_client.containers.list.return_value = [pooled]
+        cache = open_cache(self.environment)
+        cache.put_warm_container(pooled.id, 'key', [], os.getpid())
+
+        self.gc()
+
+        pooled.remove.assert_not_called()
+
+    def test_removes_pooled_containers_missing_from_the_pool(self):
+        pooled = labelled_container(finished_pid())
+        pooled.attrs['Labels'][POOL_LABEL] = 'key'
+        self.docker_client.containers.list.return_value = [pooled]
+
+        self.gc()
+
+        pooled.remove.assert_called_once_with(force=True)
+
+    def test_removes_orphans(self):
+        output = self.gc()
+
+        self.orphan.remove.assert_called_once_with(force=True)
+        self.running.remove.assert_not_called()
+        assert output.startswith('Removing {} a-component'.format(
+            self.orphan.id[:12],
+        ))
+
+    def test_dry_run_removes_nothing(self):
+        output = self.gc('--dry-run')
+
+        self.orphan.remove.assert_not_called()
+        assert output.startswith('Would remove {}'.format(
+            self.orphan.id[:12],
+        ))
+
+    def test_container_removed_meanwhile_is_skipped(self):
+        self.orphan.remove.side_effect = NotFound('gone')
+
+        self.gc()
+
+    def test_usage(self):
+        with self.assertRaises(GcUsageError):
+            run_gc_command(['gc', 'everything'], self.environment)
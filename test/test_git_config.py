@@ -0,0 +1,110 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from os import path
+
+from cdflow import (
+    find_git_dir, get_component_name, parse_git_remote_url,
+    read_git_remote_url
+)
+from mock import patch
+
+
+def git(*args, cwd):
+    subprocess.check_call(
+        ('git',) + args, cwd=cwd,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+class TestParseGitRemoteUrl(unittest.TestCase):
+
+    def test_origin_url(self):
+        assert parse_git_remote_url(
+            '[core]\n'
+            '\tbare = false\n'
+            '[remote "upstream"]\n'
+            '\turl = git@github.com:org/upstream.git\n'
+            '[remote "origin"]\n'
+            '\turl = git@github.com:org/component.git\n'
+            '\tfetch = +refs/heads/*:refs/remotes/origin/*\n'
+        ) == 'git@github.com:org/component.git'
+
+    def test_quotes_comments_and_case(self):
+        assert parse_git_remote_url(
+            '[Remote "origin"]\n'
+            '  URL = "https://example.com/org/a;b.git" ; comment\n'
+        ) == 'https://example.com/org/a;b.git'
+
+    def test_last_url_wins(self):
+        assert parse_git_remote_url(
+            '[remote "origin"]\n\turl = first\n\turl = second\n'
+        ) == 'second'
+
+    def test_missing_remote(self):
+        assert parse_git_remote_url('[remote "upstream"]\n\turl = x\n') \
+            is None
+
+
+class TestReadGitRemoteUrl(unittest.TestCase):
+
+    def setUp(self):
+        self.root = path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root)
+        self.repo = path.join(self.root, 'repo')
+        os.mkdir(self.repo)
+        git('init', '-q', cwd=self.repo)
+        git(
+            'remote', 'add', 'origin', 'git@github.com:org/component.git',
+            cwd=self.repo,
+        )
+        patcher = patch.dict('cdflow.os.environ')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ.pop('GIT_DIR', None)
+
+    def test_reads_remote_from_a_subdirectory(self):
+        subdirectory = path.join(self.repo, 'infra', 'modules')
+        os.makedirs(subdirectory)
+
+        assert find_git_dir(subdirectory) == path.join(self.repo, '.git')
+        assert read_git_remote_url(subdirectory) == \
+            'git@github.com:org/component.git'
+
+    def test_reads_remote_from_a_worktree(self):
+        git('-c', 'user.name=a', '-c', 'user.email=a@b', 'commit', '-q',
+            '--allow-empty', '-m', 'initial', cwd=self.repo)
+        worktree = path.join(self.root, 'worktree')
+        git('worktree', 'add', '-q', worktree, cwd=self.repo)
+
+        assert read_git_remote_url(worktree) == \
+            'git@github.com:org/component.git'
+
+    def test_follows_gitdir_file(self):
+        checkout = path.join(self.root, 'checkout')
+        os.mkdir(checkout)
+        with open(path.join(checkout, '.git'), 'w') as gitdir_file:
+            gitdir_file.write('gitdir: ../repo/.git\n')
+
+        assert read_git_remote_url(checkout) == \
+            'git@github.com:org/component.git'
+
+    def test_no_repository(self):
+        assert read_git_remote_url(self.root) is None
+
+    def test_component_name_without_running_git(self):
+        with patch('cdflow.os.getcwd', return_value=self.repo), \
+                patch('cdflow.check_output') as check_output:
+            assert get_component_name(['deploy', 'aslive', '1']) == \
+                'component'
+
+        check_output.assert_not_called()
+
+    def test_falls_back_to_git(self):
+        with patch('cdflow.os.getcwd', return_value=self.root), \
+                patch('cdflow.check_output') as check_output:
+            check_output.return_value = b'git@github.com:org/other.git\n'
+
+            assert get_component_name(['deploy', 'aslive', '1']) == 'other'
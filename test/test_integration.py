@@ -1,5 +1,6 @@
 import json
 import unittest
+from io import BytesIO
 from unittest.mock import ANY, MagicMock, Mock, patch
 from string import printable
 from _io import TextIOWrapper
@@ -10,8 +11,8 @@ from docker.client import DockerClient
 from docker.errors import ContainerError
 from docker.models.images import Image
 
-from cdflow import CDFLOW_IMAGE_ID, main, logger
-from hypothesis import given
+from cdflow import CDFLOW_IMAGE_ID, WATCH_FLAG, WRAPPER_COMMANDS, main, logger
+from hypothesis import assume, given
 from hypothesis.strategies import dictionaries, fixed_dictionaries, lists, text
 
 from test.strategies import (
@@ -19,8 +20,25 @@ from test.strategies import (
 )
 
 
+def isolate_from_host(test_case):
+    for target in (
+        'cdflow.open_cache', 'cdflow.fetch_manifest_digest',
+        'cdflow.resolve_aws_credentials', 'cdflow.read_git_remote_url',
+    ):
+        patcher = patch(target, return_value=None)
+        patcher.start()
+        test_case.addCleanup(patcher.stop)
+    for dictionary in ('cdflow._warm_clients', 'cdflow._manifests'):
+        patcher = patch.dict(dictionary, clear=True)
+        patcher.start()
+        test_case.addCleanup(patcher.stop)
+
+
 class TestIntegration(unittest.TestCase):
 
+    def setUp(self):
+        isolate_from_host(self)
+
     @given(filepath())
     def test_release(self, project_root):
         argv = ['release', '--platform-config', '../path/to/config',
@@ -38,11 +56,10 @@ class TestIntegration(unittest.TestCase):
                 'RepoDigests': ['hash']
             }
 
-            docker.from_env.return_value.containers.run.return_value.attrs = {
-                'State': {
-                    'ExitCode': 0,
-                }
-            }
+            docker.from_env.return_value.containers.create.return_value.\
+                attach_socket.return_value = BytesIO()
+            docker.from_env.return_value.containers.create.return_value.\
+                wait.return_value = {'StatusCode': 0}
 
             os.getcwd.return_value = project_root
             os.getenv.return_value = False
@@ -61,7 +78,7 @@ class TestIntegration(unittest.TestCase):
         docker.from_env.return_value.images.pull.assert_called_once_with(
             'mergermarket/cdflow-commands:latest'
         )
-        docker.from_env.return_value.containers.run.assert_called_once_with(
+        docker.from_env.return_value.containers.create.assert_called_once_with(
             'mergermarket/cdflow-commands:latest',
             command=argv,
             environment={
@@ -75,7 +92,6 @@ class TestIntegration(unittest.TestCase):
                 'DATADOG_APP_KEY': ANY,
                 'DATADOG_API_KEY': ANY,
             },
-            detach=True,
             volumes={
                 project_root: {
                     'bind': project_root,
@@ -90,16 +106,14 @@ class TestIntegration(unittest.TestCase):
                     'mode': 'ro',
                 },
             },
-            working_dir=project_root
+            working_dir=project_root,
+            labels=ANY,
         )
 
-        docker.from_env.return_value.containers.run.return_value.logs.\
-            assert_called_once_with(
-                stream=True,
-                follow=True,
-                stdout=True,
-                stderr=True,
-            )
+        docker.from_env.return_value.containers.create.return_value.\
+            attach_socket.assert_called_once_with(params={
+                'stdout': 1, 'stderr': 1, 'stream': 1, 'logs': 1,
+            })
 
     @given(fixed_dictionaries({
         'project_root': filepath(),
@@ -130,11 +144,10 @@ class TestIntegration(unittest.TestCase):
                 'RepoDigests': ['hash']
             }
 
-            docker.from_env.return_value.containers.run.return_value.attrs = {
-                'State': {
-                    'ExitCode': 0,
-                }
-            }
+            docker.from_env.return_value.containers.create.return_value.\
+                attach_socket.return_value = BytesIO()
+            docker.from_env.return_value.containers.create.return_value.\
+                wait.return_value = {'StatusCode': 0}
 
             os.getcwd.return_value = project_root
             os.getenv.return_value = False
@@ -154,7 +167,7 @@ class TestIntegration(unittest.TestCase):
         docker.from_env.return_value.images.pull.assert_called_once_with(
             pinned_image_id
         )
-        docker.from_env.return_value.containers.run.assert_called_once_with(
+        docker.from_env.return_value.containers.create.assert_called_once_with(
             pinned_image_id,
             command=argv,
             environment={
@@ -168,7 +181,6 @@ class TestIntegration(unittest.TestCase):
                 'DATADOG_APP_KEY': ANY,
                 'DATADOG_API_KEY': ANY,
             },
-            detach=True,
             volumes={
                 project_root: {
                     'bind': project_root,
@@ -183,7 +195,8 @@ class TestIntegration(unittest.TestCase):
                     'mode': 'ro',
                 },
             },
-            working_dir=project_root
+            working_dir=project_root,
+            labels=ANY,
         )
 
     @given(fixed_dictionaries({
@@ -198,8 +211,7 @@ class TestIntegration(unittest.TestCase):
     def test_classic_deploy(self, fixtures):
         argv = ['deploy', 'aslive', '42']
 
-        with patch('cdflow.Session') as Session, \
-                patch('cdflow.BytesIO') as BytesIO, \
+        with patch('boto3.session.Session') as Session, \
                 patch('cdflow.docker') as docker, \
                 patch('cdflow.os') as os, \
                 patch('cdflow.open') as open_:
@@ -207,18 +219,21 @@ class TestIntegration(unittest.TestCase):
             s3_resource = Mock()
 
             image_digest = 'sha:12345asdfg'
-            s3_resource.Object.return_value.metadata = {
-                'cdflow_image_digest': image_digest
+            s3_resource.meta.client.head_object.return_value = {
+                'Metadata': {'cdflow_image_digest': image_digest},
             }
 
             Session.return_value.resource.return_value = s3_resource
 
-            BytesIO.return_value.__enter__.return_value.read.return_value = '''
-                {{
-                    "release-bucket": "{}",
-                    "classic-metadata-handling": true
-                }}
-            '''.format(fixtures['release_bucket'])
+            s3_resource.meta.client.get_object.return_value = {
+                'Body': BytesIO('''
+                    {{
+                        "release-bucket": "{}",
+                        "classic-metadata-handling": true
+                    }}
+                '''.format(fixtures['release_bucket']).encode('utf-8')),
+                'ETag': '"account-scheme"',
+            }
 
             config_file = MagicMock(spec=TextIOWrapper)
             config_file.read.return_value = yaml.dump({
@@ -231,11 +246,10 @@ class TestIntegration(unittest.TestCase):
 
             docker_client = MagicMock(spec=DockerClient)
             docker.from_env.return_value = docker_client
-            docker.from_env.return_value.containers.run.return_value.attrs = {
-                'State': {
-                    'ExitCode': 0,
-                }
-            }
+            docker.from_env.return_value.containers.create.return_value.\
+                attach_socket.return_value = BytesIO()
+            docker.from_env.return_value.containers.create.return_value.\
+                wait.return_value = {'StatusCode': 0}
 
             project_root = fixtures['project_root']
             os.getcwd.return_value = project_root
@@ -244,30 +258,27 @@ class TestIntegration(unittest.TestCase):
 
             assert exit_status == 0
 
-            s3_resource.Object.assert_any_call(
-                fixtures['s3_bucket_and_key'][0],
-                fixtures['s3_bucket_and_key'][1],
+            s3_resource.meta.client.get_object.assert_any_call(
+                Bucket=fixtures['s3_bucket_and_key'][0],
+                Key=fixtures['s3_bucket_and_key'][1],
             )
 
-            docker_client.containers.run.assert_called_once_with(
+            docker_client.containers.create.assert_called_once_with(
                 image_digest,
                 command=argv,
                 environment=ANY,
-                detach=True,
                 volumes={
                     project_root: ANY,
                     '/var/run/docker.sock': ANY
                 },
                 working_dir=project_root,
+                labels=ANY,
             )
 
-            docker.from_env.return_value.containers.run.return_value.logs.\
-                assert_called_once_with(
-                    stream=True,
-                    follow=True,
-                    stdout=True,
-                    stderr=True,
-                )
+            docker.from_env.return_value.containers.create.return_value.\
+                attach_socket.assert_called_once_with(params={
+                    'stdout': 1, 'stderr': 1, 'stream': 1, 'logs': 1,
+                })
 
     @given(fixed_dictionaries({
         'project_root': filepath(),
@@ -293,8 +304,7 @@ class TestIntegration(unittest.TestCase):
         component_name = fixtures['component_name']
         argv = ['deploy', 'aslive', version, '--component', component_name]
 
-        with patch('cdflow.Session') as Session, \
-                patch('cdflow.BytesIO') as BytesIO, \
+        with patch('boto3.session.Session') as Session, \
                 patch('cdflow.docker') as docker, \
                 patch('cdflow.os') as os, \
                 patch('cdflow.open') as open_:
@@ -302,17 +312,20 @@ class TestIntegration(unittest.TestCase):
             s3_resource = Mock()
 
             image_digest = 'sha:12345asdfg'
-            s3_resource.Object.return_value.metadata = {
-                'cdflow_image_digest': image_digest
+            s3_resource.meta.client.head_object.return_value = {
+                'Metadata': {'cdflow_image_digest': image_digest},
             }
 
             Session.return_value.resource.return_value = s3_resource
 
-            BytesIO.return_value.__enter__.return_value.read.return_value = '''
-                {{
-                    "release-bucket": "{}"
-                }}
-            '''.format(fixtures['release_bucket'])
+            s3_resource.meta.client.get_object.return_value = {
+                'Body': BytesIO('''
+                    {{
+                        "release-bucket": "{}"
+                    }}
+                '''.format(fixtures['release_bucket']).encode('utf-8')),
+                'ETag': '"account-scheme"',
+            }
 
             config_file = MagicMock(spec=TextIOWrapper)
             config_file.read.return_value = yaml.dump({
@@ -325,11 +338,10 @@ class TestIntegration(unittest.TestCase):
 
             docker_client = MagicMock(spec=DockerClient)
             docker.from_env.return_value = docker_client
-            docker.from_env.return_value.containers.run.return_value.attrs = {
-                'State': {
-                    'ExitCode': 0,
-                }
-            }
+            docker.from_env.return_value.containers.create.return_value.\
+                attach_socket.return_value = BytesIO()
+            docker.from_env.return_value.containers.create.return_value.\
+                wait.return_value = {'StatusCode': 0}
 
             project_root = fixtures['project_root']
             os.getcwd.return_value = project_root
@@ -338,14 +350,14 @@ class TestIntegration(unittest.TestCase):
 
             assert exit_status == 0
 
-            s3_resource.Object.assert_any_call(
-                fixtures['s3_bucket_and_key'][0],
-                fixtures['s3_bucket_and_key'][1],
+            s3_resource.meta.client.get_object.assert_any_call(
+                Bucket=fixtures['s3_bucket_and_key'][0],
+                Key=fixtures['s3_bucket_and_key'][1],
             )
 
-            s3_resource.Object.assert_any_call(
-                fixtures['release_bucket'],
-                '{}/{}/{}-{}.zip'.format(
+            s3_resource.meta.client.head_object.assert_any_call(
+                Bucket=fixtures['release_bucket'],
+                Key='{}/{}/{}-{}.zip'.format(
                     fixtures['team_name'],
                     component_name,
                     component_name,
@@ -353,28 +365,28 @@ class TestIntegration(unittest.TestCase):
                 ),
             )
 
-            docker_client.containers.run.assert_called_once_with(
+            docker_client.containers.create.assert_called_once_with(
                 image_digest,
                 command=argv,
                 environment=ANY,
-                detach=True,
                 volumes={
                     project_root: ANY,
                     '/var/run/docker.sock': ANY
                 },
                 working_dir=project_root,
+                labels=ANY,
             )
 
-            docker.from_env.return_value.containers.run.return_value.logs.\
-                assert_called_once_with(
-                    stream=True,
-                    follow=True,
-                    stdout=True,
-                    stderr=True,
-                )
+            docker.from_env.return_value.containers.create.return_value.\
+                attach_socket.assert_called_once_with(params={
+                    'stdout': 1, 'stderr': 1, 'stream': 1, 'logs': 1,
+                })
 
     @given(lists(elements=text(alphabet=printable, max_size=3), max_size=3))
     def test_invalid_arguments_passed_to_container_to_handle(self, argv):
+        # The wrapper's own commands are handled without a container.
+        assume(not argv or argv[0] not in WRAPPER_COMMANDS)
+        assume(WATCH_FLAG not in argv)
         with patch('cdflow.docker') as docker, \
                 patch('cdflow.os') as os, \
                 patch('cdflow.open') as open_:
@@ -393,19 +405,19 @@ class TestIntegration(unittest.TestCase):
                 image=CDFLOW_IMAGE_ID,
                 stderr='help text'
             )
-            docker.from_env.return_value.containers.run.side_effect = error
+            docker.from_env.return_value.containers.create.side_effect = error
             os.path.abspath.return_value = '/'
             exit_status = main(argv)
 
         assert exit_status == 1
 
-        docker.from_env.return_value.containers.run.assert_called_once_with(
+        docker.from_env.return_value.containers.create.assert_called_once_with(
             CDFLOW_IMAGE_ID,
             command=argv,
             environment=ANY,
-            detach=True,
             volumes=ANY,
-            working_dir=ANY
+            working_dir=ANY,
+            labels=ANY,
         )
 
 
@@ -415,6 +427,9 @@ class TestIntegration(unittest.TestCase):
 @patch('cdflow.open')
 class TestVerboseLogging(unittest.TestCase):
 
+    def setUp(self):
+        isolate_from_host(self)
+
     def setup_mocks(self, open_, abspath, os, docker):
         config_file = MagicMock(spec=TextIOWrapper)
         config_file.read.return_value = yaml.dump({
@@ -431,11 +446,10 @@ class TestVerboseLogging(unittest.TestCase):
             'RepoDigests': ['hash']
         }
 
-        docker.from_env.return_value.containers.run.return_value.attrs = {
-            'State': {
-                'ExitCode': 0,
-            }
-        }
+        docker.from_env.return_value.containers.create.return_value.\
+            attach_socket.return_value = BytesIO()
+        docker.from_env.return_value.containers.create.return_value.\
+            wait.return_value = {'StatusCode': 0}
 
         os.getcwd.return_value = '/tmp/project'
         os.getenv.return_value = False
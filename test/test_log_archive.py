@@ -0,0 +1,213 @@
+import gzip
+import io
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stdout
+from os import path
+
+from cdflow import (
+    CacheStore, LogArchive, LogNotFoundError, LogsUsageError,
+    copy_log_archive, list_log_archives, open_log_archive, read_log_index,
+    rotate_log_archives, run_logs_command
+)
+from hypothesis import given, settings
+from hypothesis.strategies import integers
+from mock import MagicMock, patch
+
+OUTPUT = b''.join(
+    'line {}\n'.format(number).encode() for number in range(2000)
+)
+
+TERRAFORM_OUTPUT = (
+    b'Initializing the backend...\n'
+    b'data.aws_region.current: Refreshing state...\n'
+    b'[ok] Terraform will perform the following actions:\n'
+    b'aws_ecs_service.service: Modifying... [id=svc]\n'
+)
+
+
+class TestLogArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.log_dir)
+        self.path = path.join(self.log_dir, 'run.log.gz')
+
+    def archive(self, data, block_size=1024, chunk_size=100):
+        archive = LogArchive(self.path, ['deploy', 'aslive', '1'], block_size)
+        for offset in range(0, len(data), chunk_size):
+            archive.writelines([data[offset:offset + chunk_size]])
+        archive.close(3)
+        return read_log_index(self.path)
+
+    def read(self, offset=0):
+        output = io.BytesIO()
+        copy_log_archive(self.path, read_log_index(self.path), output, offset)
+        return output.getvalue()
+
+    def test_archive_is_a_gzip_file_of_line_aligned_blocks(self):
+        index = self.archive(OUTPUT)
+
+        with open(self.path, 'rb') as archive_file:
+            assert gzip.decompress(archive_file.read()) == OUTPUT
+        assert len(index['blocks']) > 1
+        for start, _ in index['blocks'][1:]:
+            assert OUTPUT[start - 1:start] == b'\n'
+        assert index['size'] == len(OUTPUT)
+        assert index['exit_status'] == 3
+        assert index['command'] == ['deploy', 'aslive', '1']
+        assert not os.stat(self.path).st_mode & (stat.S_IRGRP | stat.S_IROTH)
+
+    @settings(max_examples=20)
+    @given(integers(min_value=0, max_value=len(OUTPUT)))
+    def test_reads_from_an_offset(self, offset):
+        if not path.exists(self.path):
+            self.archive(OUTPUT)
+
+        assert self.read(offset) == OUTPUT[offset:]
+
+    def test_records_where_phases_start(self):
+        index = self.archive(TERRAFORM_OUTPUT, block_size=64, chunk_size=7)
+
+        assert {
+            phase: TERRAFORM_OUTPUT[offset:].split(b'\n')[0]
+            for phase, offset in index['phases'].items()
+        } == {
+            'init': b'Initializing the backend...',
+            'refresh': b'data.aws_region.current: Refreshing state...',
+            'plan': b'[ok] Terraform will perform the following actions:',
+            'apply': b'aws_ecs_service.service: Modifying... [id=svc]',
+        }
+
+    def test_unfinished_run_is_read_as_one_block(self):
+        self.archive(OUTPUT)
+        os.remove(self.path + '.idx')
+
+        assert self.read(10) == OUTPUT[10:]
+
+    def test_nothing_is_written_until_there_is_output(self):
+        LogArchive(self.path, ['deploy'])
+
+        assert os.listdir(self.log_dir) == []
+
+    def test_run_without_output_is_recorded(self):
+        assert self.archive(b'')['blocks'] == []
+        assert self.read() == b''
+
+
+class TestLogRetention(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.cache = CacheStore(path.join(self.cache_dir, 'cache.db'))
+
+    def make_run(self, name, age=0):
+        os.makedirs(self.cache.log_dir, exist_ok=True)
+        archive = path.join(self.cache.log_dir, name + '.log.gz')
+        for created in (archive, archive + '.idx'):
+            with open(created, 'w'):
+                pass
+            mtime = time.time() - age
+            os.utime(created, (mtime, mtime))
+        return archive
+
+    def test_keeps_the_newest_runs(self):
+        runs = [
+            self.make_run('2020010{}T000000Z-1'.format(i)) for i in range(5)
+        ]
+
+        rotate_log_archives(self.cache.log_dir, 2, 60)
+
+        assert list_log_archives(self.cache.log_dir) == runs[:2:-1]
+        assert sorted(os.listdir(self.cache.log_dir)) == sorted(
+            path.basename(run) + suffix
+            for run in runs[3:] for suffix in ('', '.idx')
+        )
+
+    def test_removes_runs_older_than_max_age(self):
+        self.make_run('20200101T000000Z-1', age=120)
+        recent = self.make_run('20200102T000000Z-1')
+
+        rotate_log_archives(self.cache.log_dir, 10, 60)
+
+        assert list_log_archives(self.cache.log_dir) == [recent]
+
+    def test_new_run_makes_room_within_retention(self):
+        for i in range(3):
+            self.make_run('2020010{}T000000Z-1'.format(i))
+
+        archive = open_log_archive(
+            self.cache, ['deploy'], {'CDFLOW_LOG_RETENTION': '2'},
+        )
+        archive.close(0)
+
+        assert len(list_log_archives(self.cache.log_dir)) == 2
+        assert list_log_archives(self.cache.log_dir)[0] == archive.path
+
+    def test_archiving_can_be_turned_off(self):
+        assert open_log_archive(
+            self.cache, ['deploy'], {'CDFLOW_LOG_RETENTION': '0'},
+        ) is None
+        assert open_log_archive(None, ['deploy'], {}) is None
+
+
+class TestLogsCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.environment = {'CDFLOW_CACHE_DIR': self.cache_dir}
+        cache = CacheStore(path.join(self.cache_dir, 'cache.db'))
+        os.makedirs(cache.log_dir)
+        for number, argv in enumerate((['release', '1'], ['deploy', 'live'])):
+            archive = LogArchive(
+                path.join(cache.log_dir, '2020010{}-1.log.gz'.format(number)),
+                argv,
+            )
+            archive.writelines([TERRAFORM_OUTPUT])
+            archive.close(number)
+
+    def run_logs(self, *args):
+        stdout = MagicMock(buffer=io.BytesIO())
+        with patch('cdflow.sys.stdout', stdout):
+            assert run_logs_command(['logs'] + list(args), self.environment) \
+                == 0
+        return stdout.buffer.getvalue()
+
+    def test_lists_runs_newest_first(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            run_logs_command(['logs'], self.environment)
+
+        lines = output.getvalue().splitlines()
+        assert lines[1].split()[0] == '1'
+        assert lines[1].endswith('deploy live')
+        assert lines[1].split()[3:5] == ['1', str(len(TERRAFORM_OUTPUT))]
+        assert lines[2].endswith('release 1')
+
+    def test_prints_a_run(self):
+        assert self.run_logs('2') == TERRAFORM_OUTPUT
+
+    def test_prints_from_a_phase(self):
+        assert self.run_logs('1', '--phase', 'plan') == \
+            TERRAFORM_OUTPUT[TERRAFORM_OUTPUT.index(b'[ok]'):]
+
+    def test_prints_from_an_offset(self):
+        assert self.run_logs('1', '--offset', '5') == TERRAFORM_OUTPUT[5:]
+
+    def test_missing_run_or_phase(self):
+        for args in (['3'], ['1', '--phase', 'destroy']):
+            with self.assertRaises(LogNotFoundError):
+                self.run_logs(*args)
+
+    def test_usage(self):
+        for args in (
+            ['one'], ['1', '2'], ['1', '--offset'], ['--offset', 'x'],
+        ):
+            with self.assertRaises(LogsUsageError):
+                self.run_logs(*args)
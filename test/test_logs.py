@@ -0,0 +1,404 @@
+import io
+import socket
+import threading
+import time
+import unittest
+
+from cdflow import (
+    FRAME_HEADER, STDERR, STDOUT, CoalescingWriter, CollapseRefreshing,
+    FrameParser, LinePipeline, LogStageError, SpillingBuffer, TailBuffer,
+    binary_stream, get_log_stages, mask_lines, relay_frames, timestamp_lines
+)
+from hypothesis import given
+from hypothesis.strategies import (
+    binary, integers, lists, sampled_from, text, tuples
+)
+from mock import MagicMock, patch
+
+
+class RecordingStream(object):
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def flush(self):
+        pass
+
+
+class TestCoalescingWriter(unittest.TestCase):
+
+    def test_small_writes_are_combined(self):
+        stream = RecordingStream()
+        writer = CoalescingWriter(stream, max_size=1024, max_delay=60)
+
+        for chunk in (b'Running', b' the', b' command\n'):
+            writer.write(chunk)
+        writer.close()
+
+        assert stream.writes == [b'Running the command\n']
+
+    def test_writes_once_the_size_bound_is_reached(self):
+        stream = RecordingStream()
+        writer = CoalescingWriter(stream, max_size=4, max_delay=60)
+
+        writer.write(b'abc')
+        assert stream.writes == []
+        writer.write(b'def')
+        assert stream.writes == [b'abcdef']
+
+        writer.close()
+
+    def test_quiet_stream_is_written_after_the_delay(self):
+        stream = RecordingStream()
+        writer = CoalescingWriter(stream, max_size=1024, max_delay=0.01)
+
+        writer.write(b'Refreshing state...\n')
+        deadline = time.time() + 5
+        while not stream.writes and time.time() < deadline:
+            time.sleep(0.01)
+
+        assert stream.writes == [b'Refreshing state...\n']
+        writer.close()
+
+    @given(lists(text()), integers(min_value=1, max_value=64))
+    def test_output_is_unchanged(self, messages, max_size):
+        stream = RecordingStream()
+        writer = CoalescingWriter(stream, max_size=max_size, max_delay=60)
+        data = ''.join(messages).encode('utf-8')
+
+        for message in messages:
+            writer.write(message.encode('utf-8'))
+        writer.close()
+
+        assert b''.join(stream.writes) == data
+
+
+class TestBinaryStream(unittest.TestCase):
+
+    def test_uses_the_underlying_buffer(self):
+        stdout = MagicMock(buffer=io.BytesIO())
+
+        assert binary_stream(stdout) is stdout.buffer
+        stdout.flush.assert_called_once_with()
+
+    def test_text_stream_receives_whole_characters(self):
+        stdout = io.StringIO()
+        writer = CoalescingWriter(binary_stream(stdout), max_size=1)
+        data = 'état ✓\n'.encode('utf-8')
+
+        for i in range(len(data)):
+            writer.write(data[i:i + 1])
+        writer.close()
+
+        assert stdout.getvalue() == 'état ✓\n'
+
+
+frames = lists(tuples(sampled_from([STDOUT, STDERR]), binary(max_size=32)))
+
+
+def multiplexed(frames):
+    return b''.join(
+        FRAME_HEADER.pack(stream, len(payload)) + payload
+        for stream, payload in frames
+    )
+
+
+def expected(frames, stream):
+    return b''.join(payload for s, payload in frames if s == stream)
+
+
+class TestFrameParser(unittest.TestCase):
+
+    @given(frames, lists(integers(min_value=0, max_value=200)))
+    def test_streams_are_separated_however_data_is_split(self, frames, cuts):
+        data = multiplexed(frames)
+        writers = {STDOUT: io.BytesIO(), STDERR: io.BytesIO()}
+        parser = FrameParser(writers)
+
+        offset = 0
+        for cut in sorted(cuts) + [len(data)]:
+            parser.feed(data[offset:cut])
+            offset = max(offset, cut)
+
+        assert writers[STDOUT].getvalue() == expected(frames, STDOUT)
+        assert writers[STDERR].getvalue() == expected(frames, STDERR)
+
+    def test_other_streams_go_to_stdout(self):
+        writers = {STDOUT: io.BytesIO(), STDERR: io.BytesIO()}
+
+        FrameParser(writers).feed(FRAME_HEADER.pack(0, 2) + b'in')
+
+        assert writers[STDOUT].getvalue() == b'in'
+
+    def test_pending_output_is_flushed_when_the_stream_changes(self):
+        stdout, stderr = RecordingStream(), RecordingStream()
+        writers = {
+            STDOUT: CoalescingWriter(stdout, max_delay=60),
+            STDERR: CoalescingWriter(stderr, max_delay=60),
+        }
+
+        FrameParser(writers).feed(multiplexed([
+            (STDOUT, b'plan'), (STDERR, b'error'),
+        ]))
+
+        assert stdout.writes == [b'plan']
+        assert stderr.writes == []
+
+
+class TestRelayFrames(unittest.TestCase):
+
+    @given(frames)
+    def test_relays_from_a_socket(self, frames):
+        reader, writer = socket.socketpair()
+        self.addCleanup(reader.close)
+        data = multiplexed(frames)
+
+        def send():
+            writer.sendall(data)
+            writer.close()
+
+        threading.Thread(target=send).start()
+        writers = {STDOUT: io.BytesIO(), STDERR: io.BytesIO()}
+        relay_frames(reader, writers, SpillingBuffer(16, read_size=16))
+
+        assert writers[STDOUT].getvalue() == expected(frames, STDOUT)
+        assert writers[STDERR].getvalue() == expected(frames, STDERR)
+
+    def test_reads_ahead_of_a_slow_writer(self):
+        data = multiplexed([(STDOUT, b'x' * 100)] * 10)
+        release = threading.Event()
+
+        class SlowStream(io.BytesIO):
+            def writelines(self, lines):
+                release.wait()
+                return super().writelines(lines)
+
+        writers = {STDOUT: SlowStream(), STDERR: io.BytesIO()}
+        buffer = SpillingBuffer(max_memory=256)
+        relay = threading.Thread(
+            target=relay_frames, args=(io.BytesIO(data), writers, buffer),
+        )
+        relay.start()
+        deadline = time.time() + 5
+        while not buffer.finished and time.time() < deadline:
+            time.sleep(0.01)
+
+        assert buffer.finished
+        release.set()
+        relay.join()
+        assert writers[STDOUT].getvalue() == b'x' * 1000
+        assert buffer.spilled > 0
+
+
+class TestSpillingBuffer(unittest.TestCase):
+
+    def drain(self, buffer):
+        chunks = []
+        data = buffer.get()
+        while data:
+            chunks.append(data)
+            data = buffer.get()
+        return b''.join(chunks)
+
+    @given(lists(binary(max_size=32)), integers(min_value=0, max_value=64))
+    def test_chunks_come_out_in_order(self, chunks, max_memory):
+        buffer = SpillingBuffer(max_memory, read_size=8)
+
+        for chunk in chunks:
+            buffer.put(chunk)
+        buffer.finish()
+
+        assert self.drain(buffer) == b''.join(chunks)
+        buffer.close()
+
+    def test_metrics(self):
+        buffer = SpillingBuffer(max_memory=10)
+
+        for chunk in (b'12345', b'12345', b'overflow', b'more'):
+            buffer.put(chunk)
+        buffer.finish()
+        self.drain(buffer)
+
+        assert buffer.high_water == 10
+        assert buffer.spilled == 12
+
+    def test_spill_file_is_reused_once_drained(self):
+        buffer = SpillingBuffer(max_memory=0)
+
+        buffer.put(b'first')
+        assert buffer.get() == b'first'
+        buffer.put(b'second')
+        buffer.finish()
+
+        assert self.drain(buffer) == b'second'
+        assert buffer.spill_end == 0
+        buffer.close()
+
+    def test_read_error_is_raised_after_the_data(self):
+        buffer = SpillingBuffer()
+
+        buffer.put(b'partial')
+        buffer.finish(ConnectionResetError())
+
+        assert buffer.get() == b'partial'
+        with self.assertRaises(ConnectionResetError):
+            buffer.get()
+
+
+class TestLinePipeline(unittest.TestCase):
+
+    def pipeline(self, *stages):
+        writer = MagicMock()
+        written = []
+        writer.writelines.side_effect = lambda lines: written.extend(lines)
+        return LinePipeline(writer, list(stages)), written
+
+    def test_only_complete_lines_pass_through_stages(self):
+        pipeline, written = self.pipeline(lambda lines: (
+            b'> ' + line for line in lines
+        ))
+
+        pipeline.write(b'first\nsec')
+        pipeline.write(b'ond\nthi')
+        assert written == [b'> first\n', b'> second\n']
+
+        pipeline.close()
+        assert written == [b'> first\n', b'> second\n', b'> thi']
+        pipeline.writer.close.assert_called_once_with()
+
+    @given(lists(binary()), integers(min_value=1, max_value=16))
+    def test_output_is_unchanged_without_stages(self, chunks, size):
+        pipeline, written = self.pipeline()
+        data = b''.join(chunks)
+
+        for offset in range(0, len(data), size):
+            pipeline.write(data[offset:offset + size])
+        pipeline.close()
+
+        assert b''.join(written) == data
+
+    def test_held_back_lines_pass_through_later_stages(self):
+        pipeline, written = self.pipeline(
+            CollapseRefreshing(),
+            lambda lines: (b'> ' + line for line in lines),
+        )
+
+        pipeline.write(b'a: Refreshing state...\nb: Refreshing state...\n')
+        pipeline.close()
+
+        assert written == [
+            b'> a: Refreshing state...\n',
+            b'> (1 more "Refreshing state..." lines)\n',
+        ]
+
+
+class TestLogStages(unittest.TestCase):
+
+    def test_collapse_refreshing(self):
+        stage = CollapseRefreshing()
+        lines = [
+            b'Refreshing Terraform state in-memory prior to plan...\n',
+            b'data.aws_region.current: Refreshing state...\n',
+            b'module.a.aws_ecs_service.b: Refreshing state... [id=b]\n',
+            b'module.a.aws_iam_role.c: Refreshing state... [id=c]\n',
+            b'No changes. Infrastructure is up-to-date.\n',
+        ]
+
+        assert list(stage(lines)) == [
+            lines[0], lines[1],
+            b'(2 more "Refreshing state..." lines)\n',
+            lines[4],
+        ]
+        assert stage.finish() == []
+
+    def test_mask_secrets(self):
+        stage = mask_lines({b'secret', b'secret-key'})
+
+        assert list(stage([b'key=secret-key token=secret\n'])) == \
+            [b'key=**** token=****\n']
+
+    def test_no_secrets_to_mask(self):
+        assert list(mask_lines(set())([b'line\n'])) == [b'line\n']
+
+    def test_timestamps(self):
+        with patch('cdflow.time.gmtime', return_value=time.gmtime(0)):
+            assert list(timestamp_lines([b'line\n'])) == \
+                [b'1970-01-01T00:00:00Z line\n']
+
+
+class TestGetLogStages(unittest.TestCase):
+
+    def build(self, names, argv=('deploy', 'aslive', '1')):
+        factories = get_log_stages(
+            {'log-stages': names},
+            {'AWS_SECRET_ACCESS_KEY': 'hunter22', 'GITHUB_TOKEN': None,
+             'COLUMNS': '80'},
+            list(argv),
+        )
+        return [factory() for factory in factories]
+
+    def run_stages(self, stages, line):
+        lines = [line]
+        for stage in stages:
+            lines = stage(lines)
+        return list(lines)
+
+    def test_stages_are_applied_in_order(self):
+        with patch('cdflow.get_component_name', return_value='app'):
+            stages = self.build(['mask-secrets', 'tags'])
+
+        assert self.run_stages(stages, b'password hunter22 80\n') == \
+            [b'[app/aslive] password **** 80\n']
+
+    def test_release_tag_has_no_environment(self):
+        with patch('cdflow.get_component_name', return_value='app'):
+            stages = self.build(['tags'], argv=['release', '1'])
+
+        assert self.run_stages(stages, b'line\n') == [b'[app] line\n']
+
+    def test_each_stream_gets_its_own_stateful_stages(self):
+        factory, = get_log_stages(
+            {'log-stages': ['collapse-refreshing']}, {}, ['deploy'],
+        )
+
+        assert factory() is not factory()
+
+    def test_no_stages_configured(self):
+        assert get_log_stages({}, {}, ['deploy']) == []
+
+    def test_unknown_stage(self):
+        with self.assertRaises(LogStageError):
+            get_log_stages({'log-stages': ['colour']}, {}, ['deploy'])
+
+        with self.assertRaises(LogStageError):
+            get_log_stages({'log-stages': 'tags'}, {}, ['deploy'])
+
+
+class TestTailBuffer(unittest.TestCase):
+
+    @given(lists(binary(max_size=40)), integers(min_value=1, max_value=32))
+    def test_keeps_the_last_bytes_written(self, chunks, size):
+        tail = TailBuffer(size)
+
+        tail.writelines(chunks)
+
+        assert tail.getvalue() == b''.join(chunks)[-size:]
+        assert len(tail.ring) == size
+
+    def test_lines_leave_out_a_line_cut_short(self):
+        tail = TailBuffer(16)
+
+        tail.write(b'first line\nsecond\nthird\n')
+
+        assert tail.lines(5) == ['second', 'third']
+        assert tail.lines(1) == ['third']
+
+    def test_lines_before_wrapping(self):
+        tail = TailBuffer(64)
+
+        tail.write(b'only line\n')
+
+        assert tail.lines(5) == ['only line']
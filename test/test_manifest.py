@@ -0,0 +1,119 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+from os import path
+
+import cdflow
+import yaml
+from cdflow import CacheStore, get_manifest_data
+from hypothesis import given
+from hypothesis.strategies import (
+    booleans, dictionaries, floats, integers, lists, none, recursive, text
+)
+from mock import patch
+
+MANIFEST = '''
+team: a-team
+account-scheme-url: s3://bucket/key
+defaults: &defaults
+  memory: 512
+  enabled: yes
+  mode: 0755
+service:
+  <<: *defaults
+  ports: [80, 443]
+released: 2020-01-02
+empty:
+'''
+
+yaml_data = recursive(
+    none() | booleans() | integers() | text() |
+    floats(allow_nan=False),
+    lambda children: lists(children) | dictionaries(text(), children),
+    max_leaves=20,
+)
+
+
+class TestYAMLLoaders(unittest.TestCase):
+
+    def setUp(self):
+        if not hasattr(yaml, 'CSafeLoader'):
+            self.skipTest('PyYAML built without libyaml')
+
+    def assert_loaders_agree(self, text):
+        assert yaml.load(text, Loader=yaml.CSafeLoader) == \
+            yaml.load(text, Loader=yaml.SafeLoader)
+
+    def test_manifest_features(self):
+        self.assert_loaders_agree(MANIFEST)
+
+    @given(yaml_data)
+    def test_dumped_data(self, data):
+        self.assert_loaders_agree(yaml.dump(data))
+        self.assert_loaders_agree(yaml.dump(data, default_flow_style=True))
+
+
+class TestGetManifestData(unittest.TestCase):
+
+    def setUp(self):
+        self.project_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.project_dir)
+        self.manifest_path = path.join(self.project_dir, 'cdflow.yml')
+        self.write_manifest('team: a-team\n')
+        self.cache = CacheStore(path.join(self.project_dir, 'cache.db'))
+        self.parsed = []
+        load_yaml = cdflow.load_yaml
+
+        def spy(text):
+            self.parsed.append(text)
+            return load_yaml(text)
+
+        for patcher in (
+            patch('cdflow.MANIFEST_PATH', self.manifest_path),
+            patch('cdflow.load_yaml', spy),
+            patch.dict('cdflow._manifests', clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_manifest(self, text, mtime=None):
+        with open(self.manifest_path, 'w') as manifest_file:
+            manifest_file.write(text)
+        if mtime:
+            os.utime(self.manifest_path, (mtime, mtime))
+
+    def test_unchanged_manifest_is_parsed_once(self):
+        assert get_manifest_data() == {'team': 'a-team'}
+        assert get_manifest_data() == {'team': 'a-team'}
+        assert len(self.parsed) == 1
+
+    def test_changed_manifest_is_parsed_again(self):
+        get_manifest_data()
+        self.write_manifest('team: b-team\n', mtime=1)
+
+        assert get_manifest_data() == {'team': 'b-team'}
+        assert len(self.parsed) == 2
+
+    def test_parsed_manifest_is_shared_through_the_cache(self):
+        get_manifest_data(self.cache)
+        cdflow._manifests.clear()
+
+        assert get_manifest_data(self.cache) == {'team': 'a-team'}
+        assert len(self.parsed) == 1
+
+    def test_manifest_that_cannot_be_cached_is_still_parsed(self):
+        self.write_manifest(MANIFEST)
+
+        manifest = get_manifest_data(self.cache)
+        cdflow._manifests.clear()
+
+        assert get_manifest_data(self.cache) == manifest
+        assert manifest['released'] == datetime.date(2020, 1, 2)
+        assert len(self.parsed) == 2
+
+    def test_missing_manifest(self):
+        os.remove(self.manifest_path)
+
+        assert get_manifest_data(self.cache) == {}
@@ -0,0 +1,175 @@
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from cdflow import LogStageError, Pipeline, _SerialExecutor, preflight
+from docker.errors import ImageNotFound
+from mock import MagicMock, patch
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_steps_get_the_results_of_their_dependencies(self):
+        with ThreadPoolExecutor(4) as executor:
+            pipeline = Pipeline(executor)
+            pipeline.add('a', lambda: 1)
+            pipeline.add('b', lambda: 2)
+            pipeline.add('sum', lambda a, b: a + b, 'a', 'b')
+
+            assert pipeline.result('sum') == 3
+
+    def test_independent_steps_overlap(self):
+        with ThreadPoolExecutor(4) as executor:
+            pipeline = Pipeline(executor)
+            for name in ('a', 'b', 'c'):
+                pipeline.add(name, lambda: time.sleep(0.2))
+            start = time.monotonic()
+            for name in ('a', 'b', 'c'):
+                pipeline.result(name)
+
+        assert time.monotonic() - start < 0.5
+        assert set(pipeline.timings) == {'a', 'b', 'c'}
+
+    def test_errors_reach_dependent_steps(self):
+        def fail():
+            raise ValueError('failed')
+
+        with ThreadPoolExecutor(4) as executor:
+            pipeline = Pipeline(executor)
+            pipeline.add('a', fail)
+            pipeline.add('b', lambda a: a, 'a')
+
+            self.assertRaises(ValueError, pipeline.result, 'b')
+
+    def test_steps_not_started_when_another_fails_are_skipped(self):
+        calls = []
+
+        def fail():
+            raise ValueError('failed')
+
+        with ThreadPoolExecutor(4) as executor:
+            pipeline = Pipeline(executor)
+            pipeline.add('slow', lambda: time.sleep(0.2))
+            pipeline.add('a', fail)
+            pipeline.add('b', lambda slow: calls.append('b'), 'slow')
+
+            self.assertRaises(ValueError, pipeline.result, 'b')
+
+        assert calls == []
+        assert set(pipeline.timings) == {'slow', 'a'}
+
+    def test_serial_executor_skips_steps_after_a_failure(self):
+        calls = []
+
+        def fail():
+            raise ValueError('failed')
+
+        pipeline = Pipeline(_SerialExecutor())
+        pipeline.add('a', fail)
+        pipeline.add('b', lambda: calls.append('b'))
+
+        self.assertRaises(ValueError, pipeline.result, 'b')
+        assert calls == []
+
+    def test_serial_executor_runs_steps_in_order(self):
+        calls = []
+        pipeline = Pipeline(_SerialExecutor())
+        pipeline.add('a', lambda: calls.append('a'))
+        pipeline.add('b', lambda a: calls.append('b'), 'a')
+
+        pipeline.result('b')
+
+        assert calls == ['a', 'b']
+
+
+class TestDeployPreflight(unittest.TestCase):
+
+    def setUp(self):
+        self.docker_client = MagicMock()
+        self.docker_client.images.get.side_effect = ImageNotFound('missing')
+        self.events = []
+        for target, value in (
+            ('cdflow.get_docker_client', self.docker_client),
+            ('cdflow.open_cache', None),
+            ('cdflow.resolve_aws_credentials', None),
+            ('cdflow.get_manifest_data', {
+                'team': 'a-team', 'account-scheme-url': 's3://a/b',
+            }),
+            ('cdflow.get_component_name', 'a-component'),
+            ('cdflow.get_s3_resource', MagicMock()),
+        ):
+            patcher = patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for target, function in (
+            ('cdflow.fetch_config_account_scheme', self.account_scheme),
+            ('cdflow.fetch_release_image_id', self.release_image_id),
+        ):
+            patcher = patch(target, function)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.docker_client.images.pull.side_effect = \
+            lambda image_id: self.events.append(('pull', image_id))
+
+    def account_scheme(self, s3_resource, config, component_name, cache):
+        self.events.append(('account scheme', component_name))
+        return MagicMock()
+
+    def release_image_id(self, s3_resource, account_scheme, config,
+                         component_name, version, cache):
+        self.events.append(('release', version))
+        return 'image@sha256:abc'
+
+    def test_pulls_the_image_from_the_release(self):
+        kwargs = preflight(['deploy', 'aslive', '42'])
+
+        assert kwargs['image_id'] == 'image@sha256:abc'
+        assert kwargs['docker_client'] is self.docker_client
+        assert self.events == [
+            ('account scheme', 'a-component'),
+            ('release', '42'),
+            ('pull', 'image@sha256:abc'),
+        ]
+
+    def test_serial_preflight_gives_the_same_result(self):
+        with patch.dict('cdflow.os.environ', {'CDFLOW_PREFLIGHT': 'serial'}):
+            kwargs = preflight(['deploy', 'aslive', '42'])
+
+        assert kwargs['image_id'] == 'image@sha256:abc'
+        assert self.events[-1] == ('pull', 'image@sha256:abc')
+
+    def test_present_image_is_not_pulled(self):
+        self.docker_client.images.get.side_effect = None
+
+        preflight(['deploy', 'aslive', '42'])
+
+        self.docker_client.images.pull.assert_not_called()
+
+    def test_failed_step_stops_the_pull(self):
+        def release_image_id(*args):
+            time.sleep(0.2)
+            return self.release_image_id(*args)
+
+        def log_stages(*args):
+            time.sleep(0.1)
+            raise LogStageError()
+
+        with patch('cdflow.fetch_release_image_id', release_image_id), \
+                patch('cdflow.get_log_stages', log_stages):
+            self.assertRaises(
+                LogStageError, preflight, ['deploy', 'aslive', '42'],
+            )
+
+        assert ('release', '42') in self.events
+        self.docker_client.images.pull.assert_not_called()
+
+    def test_one_worker_for_each_step(self):
+        with patch(
+            'cdflow.ThreadPoolExecutor', wraps=ThreadPoolExecutor,
+        ) as executor_class:
+            preflight(['destroy', 'aslive'])
+            preflight(['deploy', 'aslive', '42'])
+
+        assert [
+            call[1]['max_workers'] for call in executor_class.call_args_list
+        ] == [10, 16]
@@ -0,0 +1,158 @@
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+from os import path
+
+import boto3
+from cdflow import (
+    RELEASE_PREFETCH_VARIABLE, AccountScheme, CacheStore,
+    fetch_release_artifact, prefetch_release_artifact
+)
+from mock import patch
+from moto import mock_s3
+
+RELEASE = b'PK release zip contents'
+RELEASE_KEY = 'a-team/a-component/a-component-1.zip'
+
+
+class TestPrefetchReleaseArtifact(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_s3 = mock_s3()
+        self.mock_s3.start()
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = CacheStore(path.join(self.cache_dir, 'cache.db'))
+        self.s3_resource = boto3.resource('s3')
+        self.s3_resource.create_bucket(Bucket='releases')
+        self.s3_resource.Object('releases', RELEASE_KEY).put(Body=RELEASE)
+
+    def tearDown(self):
+        self.mock_s3.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def prefetch(self, key=RELEASE_KEY):
+        return prefetch_release_artifact(
+            self.s3_resource, 'releases', key, self.cache,
+        )
+
+    def test_release_is_stored_read_only_by_content(self):
+        artifact = self.prefetch()
+
+        assert artifact == path.join(
+            self.cache_dir, 'releases',
+            '{}.zip'.format(hashlib.sha256(RELEASE).hexdigest()),
+        )
+        with open(artifact, 'rb') as f:
+            assert f.read() == RELEASE
+        assert not os.stat(artifact).st_mode & stat.S_IWUSR
+        assert os.listdir(path.dirname(artifact)) == [path.basename(artifact)]
+
+    def test_cached_release_is_not_downloaded_again(self):
+        artifact = self.prefetch()
+        self.s3_resource.Object('releases', RELEASE_KEY).delete()
+
+        assert self.prefetch() == artifact
+
+    def test_identical_releases_share_a_file(self):
+        other_key = 'a-team/a-component/a-component-2.zip'
+        self.s3_resource.Object('releases', other_key).put(Body=RELEASE)
+
+        assert self.prefetch() == self.prefetch(other_key)
+
+    def test_prune_removes_releases_not_used_within_max_age(self):
+        artifact = self.prefetch()
+        self.cache.max_age = 60
+
+        with patch('cdflow.time.time', return_value=time.time() + 120):
+            self.cache.prune()
+
+        assert not path.exists(artifact)
+        assert self.cache.get_release_artifact('releases', RELEASE_KEY) \
+            is None
+
+    def test_releases_count_towards_the_size_limit(self):
+        artifact = self.prefetch()
+        self.cache.max_size = len(RELEASE) + 5
+
+        with patch('cdflow.time.time', return_value=time.time() + 1):
+            self.cache.put_object('bucket', 'newer', b'0123456789')
+
+        assert not path.exists(artifact)
+        assert self.cache.get_object('bucket', 'newer') is not None
+
+    def test_release_put_in_place_is_never_taken_for_unreferenced(self):
+        replace = os.replace
+
+        def replace_then_prune(source, destination):
+            replace(source, destination)
+            self.cache.prune()
+
+        with patch('cdflow.os.replace', replace_then_prune):
+            artifact = self.prefetch()
+
+        assert path.exists(artifact)
+
+    def test_release_larger_than_the_cache_is_left_to_the_container(self):
+        self.cache.put_object('accounts', 'scheme.json', b'{}', etag='"1"')
+        self.cache.max_size = len(RELEASE) - 1
+
+        assert self.prefetch() is None
+
+        assert self.cache.get_object('accounts', 'scheme.json') is not None
+        assert self.cache.get_release_artifact('releases', RELEASE_KEY) \
+            is None
+        assert os.listdir(self.cache.artifact_dir) == []
+
+    def test_release_grown_past_the_cache_is_not_recorded(self):
+        self.cache.put_object('accounts', 'scheme.json', b'{}', etag='"1"')
+        self.cache.max_size = len(RELEASE) + 5
+        larger = RELEASE + b' and more besides'
+
+        with patch(
+            'cdflow._download_part',
+            return_value=(self.part(larger), 'digest', len(larger)),
+        ):
+            assert self.prefetch() is None
+
+        assert self.cache.get_object('accounts', 'scheme.json') is not None
+        assert os.listdir(self.cache.artifact_dir) == []
+
+    def part(self, contents):
+        os.makedirs(self.cache.artifact_dir)
+        part = path.join(self.cache.artifact_dir, 'download.part')
+        with open(part, 'wb') as f:
+            f.write(contents)
+        return part
+
+    def fetch(self, version='1', cache=True, **environment):
+        account_scheme = AccountScheme({'release-bucket': 'releases'})
+        with patch.dict(os.environ, environment):
+            return fetch_release_artifact(
+                self.s3_resource, account_scheme, {'team': 'a-team'},
+                'a-component', version, self.cache if cache else None,
+            )
+
+    def test_release_is_prefetched_when_asked(self):
+        artifact = self.fetch(**{RELEASE_PREFETCH_VARIABLE: '1'})
+
+        assert artifact == self.prefetch()
+
+    def test_release_is_not_prefetched_by_default(self):
+        with patch.dict(os.environ):
+            os.environ.pop(RELEASE_PREFETCH_VARIABLE, None)
+            assert self.fetch() is None
+
+    def test_missing_release_is_left_to_the_container(self):
+        artifact = self.fetch('404', **{RELEASE_PREFETCH_VARIABLE: '1'})
+
+        assert artifact is None
+        assert os.listdir(self.cache.artifact_dir) == []
+
+    def test_nothing_is_prefetched_without_a_cache(self):
+        assert self.fetch(
+            cache=False, **{RELEASE_PREFETCH_VARIABLE: '1'}
+        ) is None
@@ -0,0 +1,161 @@
+import shutil
+import tempfile
+import time
+import unittest
+from os import path
+
+import boto3
+import cdflow
+from cdflow import (
+    CacheStore, S3DeadlineError, download_account_scheme,
+    fetch_release_metadata, get_s3_resource
+)
+from mock import Mock, patch
+from moto import mock_s3
+from test.s3 import DelayedS3
+
+
+class TestS3Requests(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_s3 = mock_s3()
+        self.mock_s3.start()
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = CacheStore(path.join(self.cache_dir, 'cache.db'))
+        self.s3_requests = cdflow._S3Requests()
+        self.s3_client = boto3.client('s3', region_name='us-east-1')
+        self.s3_client.create_bucket(Bucket='releases')
+        self.s3_client.put_object(Bucket='releases', Key='key', Body=b'{}')
+        self.s3_requests.register(self.s3_client.meta.events)
+        self.urls = []
+        self.s3_client.meta.events.register(
+            'before-send.s3',
+            lambda request, **kwargs: self.urls.append(request.url),
+        )
+
+    def tearDown(self):
+        self.mock_s3.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_counts_round_trips(self):
+        self.s3_client.get_object(Bucket='releases', Key='key')
+        self.s3_client.head_object(Bucket='releases', Key='key')
+
+        assert self.s3_requests.round_trips == 2
+
+    def test_records_region_reported_by_s3(self):
+        self.s3_requests.use_cache(self.cache)
+        response = Mock(headers={'x-amz-bucket-region': 'eu-west-2'})
+
+        self.s3_requests.record_region(
+            {'context': {'cdflow_bucket': 'releases'}}, (response, {}),
+        )
+
+        assert self.s3_requests.regions == {'releases': 'eu-west-2'}
+        assert self.cache.get_bucket_regions() == {'releases': 'eu-west-2'}
+
+    def test_known_region_is_used_without_a_redirect(self):
+        self.cache.put_bucket_region('releases', 'eu-west-2')
+        self.s3_requests.use_cache(self.cache)
+
+        self.s3_client.get_object(Bucket='releases', Key='key')
+
+        assert len(self.urls) == 1
+        assert 'eu-west-2' in self.urls[0]
+
+
+class TestSharedS3Resource(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.dict('cdflow._warm_clients', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_resource_is_shared_and_tuned(self):
+        with patch.dict('cdflow.os.environ', {
+            'CDFLOW_S3_MAX_POOL_CONNECTIONS': '32',
+            'CDFLOW_S3_MAX_ATTEMPTS': '3',
+        }):
+            s3_resource = get_s3_resource()
+            assert get_s3_resource() is s3_resource
+
+        config = s3_resource.meta.client.meta.config
+        assert config.max_pool_connections == 32
+        assert config.tcp_keepalive
+        assert config.retries == {'mode': 'adaptive', 'total_max_attempts': 3}
+
+    def test_new_resource_when_environment_changes(self):
+        s3_resource = get_s3_resource()
+
+        with patch.dict('cdflow.os.environ', {'AWS_REGION': 'eu-west-2'}):
+            assert get_s3_resource() is not s3_resource
+
+
+class TestDeadlineBoundedReads(unittest.TestCase):
+
+    metadata_path = '/releases/a-team/a-component/a-component-1.zip'
+
+    def setUp(self):
+        self.s3_requests = cdflow._S3Requests()
+        patcher = patch('cdflow._s3_requests', self.s3_requests)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch_metadata(self, s3):
+        return fetch_release_metadata(
+            s3.resource(), 'releases', 'a-component', '1', 'a-team',
+        )
+
+    def test_slow_request_is_hedged(self):
+        objects = {self.metadata_path: (b'', {'digest': 'sha:1'})}
+
+        with DelayedS3(objects, delays=[2, 0]) as s3, \
+                patch.dict('cdflow.os.environ', {'CDFLOW_S3_HEDGE': '1'}):
+            start = time.monotonic()
+            metadata = self.fetch_metadata(s3)
+            elapsed = time.monotonic() - start
+
+        assert metadata == {'digest': 'sha:1'}
+        assert [method for method, _ in s3.requests] == ['HEAD', 'HEAD']
+        assert elapsed < 1.5
+        assert len(self.s3_requests.latencies) == 1
+
+    def test_requests_are_not_hedged_by_default(self):
+        objects = {self.metadata_path: (b'', {'digest': 'sha:1'})}
+
+        with DelayedS3(objects, delays=[0.6]) as s3:
+            assert self.fetch_metadata(s3) == {'digest': 'sha:1'}
+
+        assert len(s3.requests) == 1
+
+    def test_read_fails_after_the_deadline(self):
+        objects = {'/accounts/scheme.json': (b'{}', {})}
+
+        with DelayedS3(objects, delays=[2, 2]) as s3, \
+                patch.dict('cdflow.os.environ', {'CDFLOW_S3_DEADLINE': '0.2'}):
+            self.assertRaises(
+                S3DeadlineError, download_account_scheme,
+                s3.resource(), 'accounts', 'scheme.json',
+            )
+
+    def test_hedge_delay_is_the_p95_of_recent_reads(self):
+        assert self.s3_requests.hedge_delay() == \
+            cdflow.DEFAULT_S3_HEDGE_DELAY
+
+        for milliseconds in range(1, 101):
+            self.s3_requests.record_latency(milliseconds / 1000.0)
+
+        assert self.s3_requests.hedge_delay() == 0.095
+
+    def test_latencies_are_kept_in_the_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = CacheStore(path.join(cache_dir, 'cache.db'))
+        self.s3_requests.use_cache(cache)
+
+        for seconds in range(cdflow.S3_LATENCY_SAMPLES + 5):
+            self.s3_requests.record_latency(seconds)
+
+        assert cache.get_s3_latencies() == list(
+            range(5, cdflow.S3_LATENCY_SAMPLES + 5),
+        )
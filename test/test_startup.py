@@ -0,0 +1,89 @@
+import shutil
+import sys
+import tempfile
+import unittest
+from os import path
+from subprocess import check_output, run
+
+from test.engine import fake_host
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+CDFLOW = path.join(ROOT, 'cdflow.py')
+
+
+def modules_loaded_by(code):
+    output = check_output([
+        sys.executable, '-c',
+        'import sys\n{}\nprint(" ".join(sorted(sys.modules)))'.format(code),
+    ])
+    return set(output.decode('utf-8').split())
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_importing_wrapper_does_not_load_heavy_dependencies(self):
+        loaded = modules_loaded_by('import cdflow')
+
+        assert 'cdflow' in loaded
+        for module in ('boto3', 'botocore', 'docker', 'dockerpty', 'yaml'):
+            assert module not in loaded, '{} was imported'.format(module)
+
+    def test_lazy_module_imports_on_first_use(self):
+        loaded = modules_loaded_by('import cdflow\ncdflow.yaml.safe_load')
+
+        assert 'yaml' in loaded
+        assert 'boto3' not in loaded
+
+
+class TestCommandImports(unittest.TestCase):
+
+    def setUp(self):
+        self.project = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.project)
+        host = fake_host(self.project)
+        self.environment, self.engine, self.s3 = host.__enter__()
+        self.addCleanup(host.__exit__, None, None, None)
+
+    def modules_loaded_by(self, *argv):
+        modules = path.join(self.project, 'modules')
+        code = (
+            'import atexit, runpy, sys\n'
+            'atexit.register(lambda: open({!r}, "w").write(\n'
+            '    " ".join(sorted(sys.modules))))\n'
+            'sys.argv = {!r}\n'
+            'runpy.run_path({!r}, run_name="__main__")\n'
+        ).format(modules, [CDFLOW] + list(argv), CDFLOW)
+        process = run(
+            [sys.executable, '-c', code], cwd=self.project,
+            env=self.environment, capture_output=True, timeout=60,
+        )
+        assert process.returncode == 0, process.stderr.decode('utf-8')
+        assert process.stdout == b'Done\n\n'
+        with open(modules) as f:
+            return set(f.read().split())
+
+    def test_release_does_not_load_aws_sdk(self):
+        loaded = self.modules_loaded_by(
+            'release', '--platform-config', 'platform-config', '1',
+        )
+
+        assert {'docker', 'yaml'} <= loaded
+        for module in ('boto3', 'botocore', 'dockerpty'):
+            assert module not in loaded, '{} was imported'.format(module)
+
+    def test_destroy_does_not_load_aws_sdk(self):
+        loaded = self.modules_loaded_by('destroy', 'aslive')
+
+        assert 'docker' in loaded
+        for module in ('boto3', 'botocore', 'dockerpty'):
+            assert module not in loaded, '{} was imported'.format(module)
+
+    def test_deploy_loads_aws_sdk_but_not_dockerpty(self):
+        loaded = self.modules_loaded_by(
+            'deploy', 'aslive', '1', '--component', 'service',
+        )
+
+        assert {'boto3', 'docker', 'yaml'} <= loaded
+        assert 'dockerpty' not in loaded
+        assert ('HEAD', '/releases/platform/service/service-1.zip') in \
+            self.s3.requests
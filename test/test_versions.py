@@ -0,0 +1,161 @@
+import json
+import shutil
+import tempfile
+import unittest
+from io import StringIO
+from os import path
+
+import boto3
+import cdflow
+from cdflow import CacheStore, index_release_versions, main
+from mock import patch
+from moto import mock_s3
+
+
+class TestIndexReleaseVersions(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_s3 = mock_s3()
+        self.mock_s3.start()
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = CacheStore(path.join(self.cache_dir, 'cache.db'))
+        self.s3_client = boto3.client('s3')
+        self.s3_client.create_bucket(Bucket='releases')
+        self.heads = []
+        head_release_metadata = cdflow._head_release_metadata
+
+        def spy(s3_client, bucket_name, key):
+            self.heads.append(key)
+            return head_release_metadata(s3_client, bucket_name, key)
+
+        patcher = patch('cdflow._head_release_metadata', spy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.mock_s3.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def put_release(self, key, digest):
+        self.s3_client.put_object(
+            Bucket='releases', Key=key, Body=b'zip',
+            Metadata={'cdflow_image_digest': digest},
+        )
+
+    def versions(self, prefix, **kwargs):
+        return [
+            (version, digest) for _, version, digest, _
+            in index_release_versions(
+                self.s3_client, 'releases', prefix, self.cache, **kwargs
+            )
+        ]
+
+    def test_lists_team_prefixed_releases_with_digests(self):
+        self.put_release('a-team/a-component/a-component-1.zip', 'sha:1')
+        self.put_release('a-team/a-component/a-component-2.zip', 'sha:2')
+        self.put_release('a-team/other/other-1.zip', 'sha:3')
+
+        assert self.versions('a-team/a-component/a-component-') == [
+            ('1', 'sha:1'), ('2', 'sha:2'),
+        ]
+
+    def test_lists_classic_releases(self):
+        self.put_release('a-component/a-component-1.zip', 'sha:1')
+        self.put_release('a-component/a-component-1.json', 'sha:2')
+
+        assert self.versions('a-component/a-component-') == [('1', 'sha:1')]
+
+    def test_only_new_releases_are_fetched_again(self):
+        self.put_release('a-component/a-component-1.zip', 'sha:1')
+        self.versions('a-component/a-component-')
+        self.put_release('a-component/a-component-2.zip', 'sha:2')
+        self.heads = []
+
+        versions = self.versions('a-component/a-component-')
+
+        assert versions == [('1', 'sha:1'), ('2', 'sha:2')]
+        assert self.heads == ['a-component/a-component-2.zip']
+
+    def test_finds_releases_sorted_before_the_index(self):
+        self.put_release('a-component/a-component-9.zip', 'sha:9')
+        self.versions('a-component/a-component-')
+        self.put_release('a-component/a-component-10.zip', 'sha:10')
+        self.heads = []
+
+        versions = self.versions('a-component/a-component-')
+
+        assert versions == [('9', 'sha:9'), ('10', 'sha:10')]
+        assert self.heads == ['a-component/a-component-10.zip']
+
+    def test_fast_mode_only_lists_after_the_index(self):
+        self.put_release('a-component/a-component-9.zip', 'sha:9')
+        self.versions('a-component/a-component-')
+        self.put_release('a-component/a-component-10.zip', 'sha:10')
+
+        versions = self.versions('a-component/a-component-', fast=True)
+
+        assert versions == [('9', 'sha:9')]
+
+    def test_deleted_releases_are_not_listed(self):
+        self.put_release('a-component/a-component-1.zip', 'sha:1')
+        self.put_release('a-component/a-component-2.zip', 'sha:2')
+        self.versions('a-component/a-component-')
+        self.s3_client.delete_object(
+            Bucket='releases', Key='a-component/a-component-1.zip',
+        )
+
+        assert self.versions('a-component/a-component-') == [('2', 'sha:2')]
+
+    def test_works_without_a_cache(self):
+        self.put_release('a-component/a-component-1.zip', 'sha:1')
+
+        assert [
+            (version, digest) for _, version, digest, _
+            in index_release_versions(
+                self.s3_client, 'releases', 'a-component/a-component-',
+            )
+        ] == [('1', 'sha:1')]
+
+
+class TestVersionsCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_s3 = mock_s3()
+        self.mock_s3.start()
+        s3_client = boto3.client('s3')
+        s3_client.create_bucket(Bucket='accounts')
+        s3_client.put_object(
+            Bucket='accounts', Key='account-scheme.json',
+            Body=json.dumps({'release-bucket': 'releases'}).encode('utf-8'),
+        )
+        s3_client.create_bucket(Bucket='releases')
+        s3_client.put_object(
+            Bucket='releases', Key='a-team/a-component/a-component-1.zip',
+            Body=b'zip', Metadata={'cdflow_image_digest': 'sha:1'},
+        )
+        for patcher in (
+            patch('cdflow.get_manifest_data', return_value={
+                'team': 'a-team',
+                'account-scheme-url': 's3://accounts/account-scheme.json',
+            }),
+            patch.dict('cdflow._warm_clients', clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.mock_s3.stop()
+
+    def test_prints_versions_and_digests(self):
+        with patch('cdflow.sys.stdout', new_callable=StringIO) as stdout:
+            exit_status = main(['versions', '--component', 'a-component'])
+
+        assert exit_status == 0
+        assert stdout.getvalue().split() == ['1', 'sha:1']
+
+    def test_unexpected_arguments(self):
+        with patch('cdflow.sys.stderr', new_callable=StringIO) as stderr:
+            exit_status = main(['versions', 'extra'])
+
+        assert exit_status == 1
+        assert stderr.getvalue().startswith('usage: cdflow versions')
@@ -0,0 +1,309 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from io import BytesIO
+from os import path
+
+from cdflow import (
+    CacheStore, FRAME_HEADER, POOL_LABEL, STDOUT, WARM_CONTAINER_ENTRYPOINT,
+    WARM_POOL_VARIABLE, SessionPool, WarmPool, docker_run, open_warm_pool,
+    warm_pool_key
+)
+from docker.api.client import APIClient
+from docker.client import DockerClient
+from docker.errors import NotFound
+from docker.models.containers import Container
+from mock import ANY, MagicMock, patch
+
+VOLUMES = {'/project': {'bind': '/project', 'mode': 'rw'}}
+ENVIRONMENT = {'AWS_SESSION_TOKEN': 'token'}
+
+
+def frames(*chunks):
+    return BytesIO(b''.join(
+        FRAME_HEADER.pack(STDOUT, len(chunk)) + chunk for chunk in chunks
+    ))
+
+
+class WarmPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.cache = CacheStore(path.join(self.cache_dir, 'cache.db'))
+        self.pool = WarmPool(self.cache, max_size=2, idle_timeout=60)
+        self.docker_client = MagicMock(spec=DockerClient)
+        self.api = self.docker_client.api = MagicMock(spec=APIClient)
+        self.api.inspect_image.return_value = {
+            'Id': 'sha256:1', 'Config': {'Entrypoint': ['cdflow']},
+        }
+        self.created = []
+        self.docker_client.containers.create.side_effect = self.create
+        self.api.exec_create.return_value = {'Id': 'exec-id'}
+        self.api.exec_start.side_effect = lambda *args, **kwargs: frames(
+            b'Plan: 0 to add\n',
+        )
+        self.api.exec_inspect.return_value = {
+            'Running': False, 'ExitCode': 0,
+        }
+        self.stdout = MagicMock(buffer=BytesIO())
+        patcher = patch('cdflow.sys.stdout', self.stdout)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create(self, *args, **kwargs):
+        container = MagicMock(spec=Container)
+        container.id = 'container-{}'.format(len(self.created))
+        self.created.append(container)
+        return container
+
+    def add_idle(self, container_id, last_used):
+        self.cache.put_warm_container(container_id, 'key', [], os.getpid())
+        self.cache.release_warm_container(container_id)
+        self.cache.connection.execute(
+            'UPDATE warm_containers SET last_used = ? '
+            'WHERE container_id = ?',
+            (last_used, container_id),
+        )
+
+    def remaining(self):
+        return [row[0] for row in self.cache.get_warm_containers()]
+
+    def removed(self):
+        return [
+            call[0][0] for call in self.api.remove_container.call_args_list
+        ]
+
+    def run_command(
+        self, command=('deploy', 'live'), volumes=VOLUMES, log_archive=None,
+    ):
+        return self.pool.run(
+            self.docker_client, 'cdflow-commands:latest', list(command),
+            '/project',
+            ENVIRONMENT, volumes, {'cdflow.pid': '1'}, log_archive=log_archive,
+        )
+
+
+class TestWarmPoolRun(WarmPoolTestCase):
+
+    def test_first_command_starts_a_pooled_container(self):
+        assert self.run_command() == (0, '')
+
+        self.docker_client.containers.create.assert_called_once_with(
+            'sha256:1',
+            entrypoint=WARM_CONTAINER_ENTRYPOINT,
+            volumes=VOLUMES,
+            working_dir='/project',
+            labels={'cdflow.pid': '1', POOL_LABEL: ANY},
+        )
+        self.created[0].start.assert_called_once_with()
+        self.api.exec_create.assert_called_once_with(
+            'container-0', ['cdflow', 'deploy', 'live'],
+            environment=ENVIRONMENT, workdir='/project',
+        )
+        self.api.exec_start.assert_called_once_with('exec-id', socket=True)
+        assert self.stdout.buffer.getvalue() == b'Plan: 0 to add\n'
+
+    def test_next_command_reuses_the_container(self):
+        self.run_command()
+        self.run_command(('release', '2'))
+
+        assert len(self.created) == 1
+        self.api.exec_create.assert_called_with(
+            'container-0', ['cdflow', 'release', '2'],
+            environment=ENVIRONMENT, workdir='/project',
+        )
+
+    def test_commands_with_other_mounts_get_their_own_container(self):
+        self.run_command()
+        self.run_command(volumes=dict(VOLUMES, **{
+            '/platform-config': {'bind': '/platform-config', 'mode': 'ro'},
+        }))
+
+        assert len(self.created) == 2
+
+    def test_tag_pulled_again_gets_a_container_of_the_new_image(self):
+        self.run_command()
+        self.api.inspect_image.return_value = dict(
+            self.api.inspect_image.return_value, Id='sha256:2',
+        )
+
+        self.run_command()
+
+        assert len(self.created) == 2
+        assert self.docker_client.containers.create.call_args[0] == (
+            'sha256:2',
+        )
+
+    def test_container_in_use_is_not_shared(self):
+        self.run_command()
+        key = warm_pool_key('sha256:1', '/project', VOLUMES)
+        assert self.cache.claim_warm_container(key, os.getppid())
+
+        self.run_command()
+
+        assert len(self.created) == 2
+
+    def test_failure_reports_the_end_of_the_output(self):
+        self.api.exec_inspect.return_value = {
+            'Running': False, 'ExitCode': 2,
+        }
+
+        exit_status, output = self.run_command()
+
+        assert exit_status == 2
+        assert output.endswith('\nPlan: 0 to add')
+
+    def test_exit_code_recorded_after_the_output_ends(self):
+        self.api.exec_inspect.side_effect = [
+            {'Running': True, 'ExitCode': None},
+            {'Running': False, 'ExitCode': 3},
+        ]
+
+        assert self.run_command()[0] == 3
+
+    def test_unusable_container_is_replaced(self):
+        self.run_command()
+        self.api.exec_create.side_effect = [
+            NotFound('gone'), {'Id': 'exec-id'},
+        ]
+
+        assert self.run_command() == (0, '')
+
+        assert len(self.created) == 2
+        self.api.remove_container.assert_called_once_with(
+            'container-0', force=True,
+        )
+
+    def test_interrupted_command_is_not_left_in_the_pool(self):
+        self.api.exec_start.side_effect = KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            self.run_command()
+
+        self.api.remove_container.assert_called_once_with(
+            'container-0', force=True,
+        )
+        assert self.cache.get_warm_containers() == []
+
+    def test_output_is_archived_when_relaying_fails(self):
+        self.stdout.buffer = MagicMock()
+        self.stdout.buffer.write.side_effect = BrokenPipeError()
+        log_archive = MagicMock()
+
+        with self.assertRaises(BrokenPipeError):
+            self.run_command(log_archive=log_archive)
+
+        log_archive.close.assert_called_once_with(None)
+
+
+class TestWarmPoolEviction(WarmPoolTestCase):
+
+    def test_idle_containers_are_removed_after_the_timeout(self):
+        self.add_idle('recent', time.time())
+        self.add_idle('stale', time.time() - 120)
+
+        self.pool.evict(self.docker_client)
+
+        assert self.remaining() == ['recent']
+        assert self.removed() == ['stale']
+
+    def test_least_recently_used_beyond_the_size_limit_are_removed(self):
+        now = time.time()
+        for age, container_id in enumerate(('newest', 'newer', 'oldest')):
+            self.add_idle(container_id, now - age)
+
+        self.pool.evict(self.docker_client)
+
+        assert self.remaining() == ['newest', 'newer']
+        assert self.removed() == ['oldest']
+
+    def test_container_left_in_use_by_a_killed_wrapper_is_removed(self):
+        self.cache.put_warm_container('abandoned', 'key', [], 2 ** 22 + 1)
+        self.cache.put_warm_container('in-use', 'key', [], os.getpid())
+
+        with patch('cdflow._process_exists', lambda pid: pid == os.getpid()):
+            self.pool.evict(self.docker_client)
+
+        assert self.remaining() == ['in-use']
+        assert self.removed() == ['abandoned']
+
+    def test_a_container_is_only_claimed_once(self):
+        self.add_idle('idle', time.time())
+
+        assert self.cache.claim_warm_container('key', 1) == ('idle', [])
+        assert self.cache.claim_warm_container('key', 2) is None
+
+
+class TestSessionPool(WarmPoolTestCase):
+
+    def setUp(self):
+        super(TestSessionPool, self).setUp()
+        self.pool = SessionPool(self.cache)
+
+    def test_containers_of_other_sessions_are_left_alone(self):
+        self.add_idle('other-session', time.time())
+        self.run_command()
+
+        self.pool.close(self.docker_client)
+
+        assert self.remaining() == ['other-session']
+        assert self.removed() == ['container-0']
+
+    def test_plans_share_one_container(self):
+        self.run_command()
+        self.run_command()
+
+        assert len(self.created) == 1
+        assert self.removed() == []
+
+    def test_container_of_a_previous_image_is_removed(self):
+        self.run_command()
+        self.api.inspect_image.return_value = dict(
+            self.api.inspect_image.return_value, Id='sha256:2',
+        )
+
+        self.run_command()
+
+        assert self.remaining() == ['container-1']
+        assert self.removed() == ['container-0']
+
+    def test_container_claimed_by_another_process_is_not_removed(self):
+        self.run_command()
+        self.cache.claim_warm_container(
+            warm_pool_key('sha256:1', '/project', VOLUMES), 1,
+        )
+
+        self.pool.close(self.docker_client)
+
+        assert self.remaining() == ['container-0']
+        assert self.removed() == []
+
+
+class TestOpenWarmPool(unittest.TestCase):
+
+    def test_pool_is_opt_in(self):
+        cache = MagicMock(spec=CacheStore)
+
+        assert open_warm_pool(cache, {}) is None
+        assert open_warm_pool(cache, {WARM_POOL_VARIABLE: '0'}) is None
+        assert open_warm_pool(None, {WARM_POOL_VARIABLE: '4'}) is None
+        assert open_warm_pool(cache, {WARM_POOL_VARIABLE: '4'}).max_size == 4
+
+    def test_docker_run_uses_the_pool(self):
+        docker_client = MagicMock(spec=DockerClient)
+        pool = MagicMock(spec=WarmPool)
+        pool.run.return_value = (0, '')
+
+        assert docker_run(
+            docker_client, 'image-id', ['deploy', 'live'], '/project',
+            ENVIRONMENT, warm_pool=pool,
+        ) == (0, '')
+
+        pool.run.assert_called_once_with(
+            docker_client, 'image-id', ['deploy', 'live'], '/project',
+            ENVIRONMENT, ANY, ANY, (), None,
+        )
+        docker_client.containers.create.assert_not_called()
@@ -0,0 +1,187 @@
+import os
+import shutil
+import tempfile
+import unittest
+from os import path
+
+from cdflow import (
+    InotifyWatcher, LogStageError, PollingWatcher, SessionPool, WarmPool,
+    run_command, wait_for_changes,
+)
+from mock import ANY, MagicMock, patch
+
+
+class FakeWatcher(object):
+
+    def __init__(self, *changes):
+        self.pending = list(changes)
+        self.closed = False
+
+    def changes(self, timeout=None):
+        if timeout is not None:
+            return set()
+        if not self.pending:
+            raise KeyboardInterrupt
+        return self.pending.pop(0)
+
+    def close(self):
+        self.closed = True
+
+
+class WatcherTestCase(object):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.mkdir(path.join(self.root, 'infra'))
+        self.watcher = self.watcher_class(self.root)
+        self.addCleanup(self.watcher.close)
+
+    def write(self, name):
+        with open(path.join(self.root, name), 'w') as f:
+            f.write('changed {}'.format(name))
+
+    def changes(self):
+        changed = set()
+        for _ in range(20):
+            changed |= self.watcher.changes(0.05)
+        return changed
+
+    def test_changed_file_is_reported(self):
+        self.write(path.join('infra', 'main.tf'))
+
+        assert self.changes() == {path.join('infra', 'main.tf')}
+
+    def test_files_in_new_directories_are_reported(self):
+        os.mkdir(path.join(self.root, 'modules'))
+        self.watcher.changes(0.05)
+
+        self.write(path.join('modules', 'dns.tf'))
+
+        assert path.join('modules', 'dns.tf') in self.changes()
+
+    def test_hidden_files_and_directories_are_ignored(self):
+        os.mkdir(path.join(self.root, 'infra', '.terraform'))
+        self.write(path.join('infra', '.terraform', 'terraform.tfstate'))
+        self.write('.main.tf.swp')
+        self.write('cdflow.yml')
+
+        assert self.changes() == {'cdflow.yml'}
+
+    def test_nothing_changed(self):
+        assert self.watcher.changes(0.05) == set()
+
+
+class TestInotifyWatcher(WatcherTestCase, unittest.TestCase):
+    watcher_class = InotifyWatcher
+
+
+class TestPollingWatcher(WatcherTestCase, unittest.TestCase):
+
+    def watcher_class(self, root):
+        return PollingWatcher(root, interval=0.01)
+
+
+class TestWaitForChanges(unittest.TestCase):
+
+    def test_changes_are_gathered_until_there_are_no_more(self):
+        watcher = MagicMock()
+        watcher.changes.side_effect = [
+            set(), {'a.tf'}, {'b.tf'}, set(),
+        ]
+
+        assert wait_for_changes(watcher, 0.1) == {'a.tf', 'b.tf'}
+        assert [call[0] for call in watcher.changes.call_args_list] == [
+            (), (), (0.1,), (0.1,),
+        ]
+
+
+class TestRunWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.docker_client = MagicMock()
+        self.preflight = MagicMock(side_effect=self.prepare)
+        self.docker_run = MagicMock(return_value=(0, ''))
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        for target, value in (
+            ('cdflow.preflight', self.preflight),
+            ('cdflow.docker_run', self.docker_run),
+            ('cdflow.sys.stderr', MagicMock()),
+            ('cdflow.sys.stdout', MagicMock()),
+        ):
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.dict(os.environ, {'CDFLOW_CACHE_DIR': self.cache_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def prepare(self, argv):
+        return {
+            'docker_client': self.docker_client,
+            'command': argv,
+            'project_root': '/project',
+        }
+
+    def watch(self, *changes, argv=('deploy', 'aslive', '1', '-p')):
+        self.watcher = FakeWatcher(*changes)
+        with patch('cdflow.watch_project', return_value=self.watcher):
+            return run_command(list(argv) + ['--watch'])
+
+    def test_plans_again_on_each_change(self):
+        assert self.watch({'infra/main.tf'}, {'infra/dns.tf'}) == 130
+
+        assert self.watcher.closed
+        assert self.docker_run.call_count == 3
+        self.preflight.assert_called_once_with(['deploy', 'aslive', '1', '-p'])
+        self.docker_run.assert_called_with(
+            docker_client=self.docker_client,
+            command=['deploy', 'aslive', '1', '-p'],
+            project_root='/project',
+            warm_pool=ANY,
+        )
+
+    def test_plans_in_one_kept_container(self):
+        self.watch()
+
+        warm_pool = self.docker_run.call_args[1]['warm_pool']
+        assert isinstance(warm_pool, WarmPool)
+        assert warm_pool.max_size == 1
+
+    def test_session_keeps_its_container_across_preflights(self):
+        self.watch({'cdflow.yml'})
+
+        first, second = [
+            call[1]['warm_pool'] for call in self.docker_run.call_args_list
+        ]
+        assert first is second
+
+    def test_only_the_sessions_container_is_removed_at_the_end(self):
+        with patch.object(SessionPool, 'close') as close, \
+                patch.object(WarmPool, 'evict') as evict:
+            self.watch()
+
+        close.assert_called_once_with(self.docker_client)
+        evict.assert_not_called()
+
+    def test_changed_manifest_repeats_the_preflight(self):
+        self.watch({'cdflow.yml'})
+
+        assert self.preflight.call_count == 2
+        assert self.docker_run.call_count == 2
+
+    def test_nothing_is_planned_until_a_broken_manifest_is_fixed(self):
+        self.preflight.side_effect = [
+            self.prepare(['deploy', 'aslive', '1', '-p']),
+            LogStageError(),
+            self.prepare(['deploy', 'aslive', '1', '-p']),
+        ]
+
+        self.watch({'cdflow.yml'}, {'cdflow.yml'})
+
+        assert self.docker_run.call_count == 2
+
+    def test_only_plans_can_be_watched(self):
+        assert self.watch(argv=('deploy', 'aslive', '1')) == 1
+        self.docker_run.assert_not_called()